@@ -13,6 +13,7 @@ from typing import Tuple, Optional
 import toml
 from fastapi import APIRouter, BackgroundTasks, Request
 from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 import mikazuki.process as process
 from mikazuki import launch_utils
@@ -25,6 +26,7 @@ from mikazuki.tagger.interrogator import (available_interrogators,
 from mikazuki.tasks import tm
 from mikazuki.utils import train_utils
 from mikazuki.utils.devices import printable_devices
+from mikazuki.utils.file_index import file_indexer
 from mikazuki.utils.tk_window import (open_directory_selector,
                                       open_file_selector)
 
@@ -128,6 +130,14 @@ async def create_toml_file(request: Request):
     train_utils.fix_config_types(config)
 
     gpu_ids = config.pop("gpu_ids", None)
+    try:
+        priority = int(config.pop("priority", 0) or 0)
+        num_gpus = config.pop("num_gpus", None)
+        num_gpus = int(num_gpus) if num_gpus else None
+    except (TypeError, ValueError):
+        return APIResponseFail(message="priority and num_gpus must be integers / priority 和 num_gpus 必须是整数")
+    if num_gpus is not None and num_gpus < 1:
+        return APIResponseFail(message="num_gpus must be at least 1 / num_gpus 必须大于等于 1")
 
     suggest_cpu_threads = 8 if len(train_utils.get_total_images(config["train_data_dir"])) > 200 else 2
     model_train_type = config.pop("model_train_type", "sd-lora")
@@ -158,7 +168,8 @@ async def create_toml_file(request: Request):
     with open(toml_file, "w", encoding="utf-8") as f:
         f.write(toml.dumps(config))
 
-    result = process.run_train(toml_file, trainer_file, gpu_ids, suggest_cpu_threads)
+    result = process.run_train(toml_file, trainer_file, gpu_ids, suggest_cpu_threads,
+                               priority=priority, num_gpus=num_gpus)
 
     return result
 
@@ -208,7 +219,8 @@ async def run_interrogate(req: TaggerInterrogateRequest, background_tasks: Backg
         replace_underscore=req.replace_underscore,
         replace_underscore_excludes=req.replace_underscore_excludes,
         escape_tag=req.escape_tag,
-        unload_model_after_running=True
+        unload_model_after_running=True,
+        batch_size=req.batch_size
     )
     return APIResponseSuccess()
 
@@ -230,68 +242,82 @@ async def pick_file(picker_type: str):
     })
 
 
-@router.get("/get_files")
-async def get_files(pick_type) -> APIResponse:
-    pick_preset = {
-        "model-file": {
-            "type": "file",
-            "path": "./sd-models",
-            "filter": "(.safetensors|.ckpt|.pt)"
-        },
-        "model-saved-file": {
-            "type": "file",
-            "path": "./output",
-            "filter": "(.safetensors|.ckpt|.pt)"
-        },
-        "train-dir": {
-            "type": "folder",
-            "path": "./train",
-            "filter": None
-        },
-    }
+file_pick_presets = {
+    "model-file": {
+        "type": "file",
+        "path": "./sd-models",
+        "filter": "(.safetensors|.ckpt|.pt)"
+    },
+    "model-saved-file": {
+        "type": "file",
+        "path": "./output",
+        "filter": "(.safetensors|.ckpt|.pt)"
+    },
+    "train-dir": {
+        "type": "folder",
+        "path": "./train",
+        "filter": None
+    },
+}
 
+
+@router.get("/get_files")
+async def get_files(pick_type,
+                    offset: int = 0,
+                    limit: Optional[int] = None,
+                    search: Optional[str] = None,
+                    model_type: Optional[str] = None,
+                    refresh: bool = False) -> APIResponse:
     folder_blacklist = [".ipynb_checkpoints", ".DS_Store"]
 
-    def list_path_or_files(preset_info):
+    def list_folders(preset_info):
         path = Path(preset_info["path"])
-        file_type = preset_info["type"]
-        regex_filter = preset_info["filter"]
         result_list = []
-
-        if file_type == "file":
-            if regex_filter:
-                pattern = re.compile(regex_filter)
-                files = [f for f in path.glob("**/*") if f.is_file() and pattern.search(f.name)]
-            else:
-                files = [f for f in path.glob("**/*") if f.is_file()]
-            for file in files:
-                result_list.append({
-                    "path": str(file.resolve().absolute()).replace("\\", "/"),
-                    "name": file.name,
-                    "size": f"{round(file.stat().st_size / (1024**3),2)} GB"
-                })
-        elif file_type == "folder":
-            folders = [f for f in path.iterdir() if f.is_dir()]
-            for folder in folders:
-                if folder.name in folder_blacklist:
-                    continue
-                result_list.append({
-                    "path": str(folder.resolve().absolute()).replace("\\", "/"),
-                    "name": folder.name,
-                    "size": 0
-                })
-
+        folders = [f for f in path.iterdir() if f.is_dir()]
+        for folder in folders:
+            if folder.name in folder_blacklist:
+                continue
+            result_list.append({
+                "path": str(folder.resolve().absolute()).replace("\\", "/"),
+                "name": folder.name,
+                "size": 0
+            })
         return result_list
 
-    if pick_type not in pick_preset:
+    if pick_type not in file_pick_presets:
         return APIResponseFail(message="Invalid request")
 
-    dirs = list_path_or_files(pick_preset[pick_type])
+    preset_info = file_pick_presets[pick_type]
+    if preset_info["type"] == "folder":
+        files = await asyncio.to_thread(list_folders, preset_info)
+    else:
+        # served from the background index, only the first request waits for the scan
+        index = file_indexer.get_index(preset_info["path"], preset_info["filter"])
+        # with refresh, wait for a scan which starts after this request, not for the one which may be running
+        generation = file_indexer.request_refresh(index) if refresh else 0
+        await asyncio.to_thread(index.wait, generation, 60)
+        files = index.list()
+
+    if search:
+        search = search.lower()
+        files = [f for f in files if search in f["name"].lower()]
+    if model_type:
+        files = [f for f in files if f.get("model_type") == model_type]
+
+    total = len(files)
+    files = files[offset:offset + limit] if limit is not None else files[offset:]
     return APIResponseSuccess(data={
-        "files": dirs
+        "files": files,
+        "total": total
     })
 
 
+def start_file_indexes():
+    for preset_info in file_pick_presets.values():
+        if preset_info["type"] == "file":
+            file_indexer.get_index(preset_info["path"], preset_info["filter"])
+
+
 @router.get("/tasks", response_model_exclude_none=True)
 async def get_tasks() -> APIResponse:
     return APIResponseSuccess(data={
@@ -299,6 +325,55 @@ async def get_tasks() -> APIResponse:
     })
 
 
+@router.get("/tasks/{task_id}/logs", response_model_exclude_none=True)
+async def get_task_logs(task_id: str, after: int = -1) -> APIResponse:
+    task = tm.tasks.get(task_id)
+    if task is None or not hasattr(task, "output"):
+        return APIResponseFail(message="Task not found / 任务不存在")
+
+    lines, progress, metrics, closed = task.output.read(after)
+    return APIResponseSuccess(data={
+        "lines": [{"seq": seq, "text": text} for seq, text in lines],
+        "progress": progress,
+        "metrics": metrics,
+        "closed": closed,
+    })
+
+
+@router.get("/tasks/{task_id}/logs/stream")
+async def stream_task_logs(task_id: str, request: Request, after: int = -1):
+    """
+    server-sent events of a task output: "log" (id is the line seq, resumable with Last-Event-ID),
+    "progress" (the latest progress bar), "metrics" (step, loss, lr, it_per_sec...) and "end".
+    """
+    task = tm.tasks.get(task_id)
+    if task is None or not hasattr(task, "output"):
+        return APIResponseFail(message="Task not found / 任务不存在")
+
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id is not None and last_event_id.isdigit():
+        after = int(last_event_id)
+
+    async def events():
+        async for kind, payload in task.output.follow(after):
+            if await request.is_disconnected():
+                break
+            if kind == "line":
+                seq, text = payload
+                yield f"id: {seq}\nevent: log\ndata: {json.dumps({'seq': seq, 'text': text}, ensure_ascii=False)}\n\n"
+            elif kind == "heartbeat":
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {kind}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        else:
+            yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
 @router.get("/tasks/terminate/{task_id}", response_model_exclude_none=True)
 async def terminate_task(task_id: str):
     tm.terminate_task(task_id)
@@ -340,13 +415,28 @@ async def get_all_schemas() -> APIResponse:
 
 
 @router.get("/presets")
-async def get_presets() -> APIResponse:
+async def get_presets(model: Optional[str] = None) -> APIResponse:
     if os.environ.get("MIKAZUKI_SCHEMA_HOT_RELOAD", "0") == "1":
         log.info("Hot reloading presets")
         await load_presets()
 
+    presets = avaliable_presets
+    if model and os.path.isfile(model):
+        # suggest presets for the selected model. the model type is cached, so the file is read only once
+        try:
+            model_type = await asyncio.to_thread(train_utils.guess_model_type, model)
+        except Exception as e:
+            log.warning(f"model file {model} can't open: {e}")
+            model_type = None
+        train_types = train_utils.suggest_train_types(model_type)
+        if train_types is not None:
+            presets = [
+                p for p in presets
+                if not p.get("metadata", {}).get("train_type") or p["metadata"]["train_type"] in train_types
+            ]
+
     return APIResponseSuccess(data={
-        "presets": avaliable_presets
+        "presets": presets
     })
 
 
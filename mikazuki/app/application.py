@@ -12,7 +12,7 @@ from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException
 
 from mikazuki.app.config import app_config
-from mikazuki.app.api import load_schemas, load_presets
+from mikazuki.app.api import load_schemas, load_presets, start_file_indexes
 from mikazuki.app.api import router as api_router
 # from mikazuki.app.ipc import router as ipc_router
 from mikazuki.app.proxy import router as proxy_router
@@ -38,6 +38,7 @@ async def app_startup():
 
     await load_schemas()
     await load_presets()
+    start_file_indexes()
     await asyncio.to_thread(check_torch_gpu)
 
     if sys.platform == "win32" and os.environ.get("MIKAZUKI_DEV", "0") != "1":
@@ -21,6 +21,10 @@ class TaggerInterrogateRequest(BaseModel):
     replace_underscore_excludes: str = Field(
         default="0_0, (o)_(o), +_+, +_-, ._., <o>_<o>, <|>_<|>, =_=, >_<, 3_3, 6_9, >_o, @_@, ^_^, o_o, u_u, x_x, |_|, ||_||"
     )
+    batch_size: int = Field(
+        default=8,
+        ge=1
+    )
 
 
 class APIResponse(BaseModel):
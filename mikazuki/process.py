@@ -1,20 +1,24 @@
 
-import asyncio
 import os
 import sys
 from typing import Optional
 
 from mikazuki.app.models import APIResponse
 from mikazuki.log import log
-from mikazuki.tasks import tm
+from mikazuki.tasks import TaskStatus, tm
 from mikazuki.launch_utils import base_dir_path
 
 
 def run_train(toml_path: str,
               trainer_file: str = "./scripts/train_network.py",
               gpu_ids: Optional[list] = None,
-              cpu_threads: Optional[int] = 2):
-    log.info(f"Training started with config file / 训练开始，使用配置文件: {toml_path}")
+              cpu_threads: Optional[int] = 2,
+              priority: int = 0,
+              num_gpus: Optional[int] = None):
+    """
+    queue a training task. without gpu_ids, the task manager picks num_gpus (default 1) free GPUs when it starts.
+    """
+    log.info(f"Training queued with config file / 训练已加入队列，使用配置文件: {toml_path}")
     args = [
         sys.executable, "-m", "accelerate.commands.launch",  # use -m to avoid python script executable error
         "--num_cpu_threads_per_process", str(cpu_threads),  # cpu threads
@@ -29,30 +33,32 @@ def run_train(toml_path: str,
     customize_env["PYTHONWARNINGS"] = "ignore::FutureWarning,ignore::UserWarning"
 
     if gpu_ids:
-        customize_env["CUDA_VISIBLE_DEVICES"] = ",".join(gpu_ids)
+        num_gpus = len(gpu_ids)
         log.info(f"Using GPU(s) / 使用 GPU: {gpu_ids}")
+    num_gpus = max(1, num_gpus or 1)
 
-        if len(gpu_ids) > 1:
-            args[3:3] = ["--multi_gpu", "--num_processes", str(len(gpu_ids))]
-            if sys.platform == "win32":
-                customize_env["USE_LIBUV"] = "0"
-                args[3:3] = ["--rdzv_backend", "c10d"]
-
-    if not (task := tm.create_task(args, customize_env)):
-        return APIResponse(status="error", message="Failed to create task / 无法创建训练任务")
-
-    def _run():
-        try:
-            task.execute()
-            result = task.communicate()
-            if result.returncode != 0:
-                log.error(f"Training failed / 训练失败")
-            else:
-                log.info(f"Training finished / 训练完成")
-        except Exception as e:
-            log.error(f"An error occurred when training / 训练出现致命错误: {e}")
-
-    coro = asyncio.to_thread(_run)
-    asyncio.create_task(coro)
+    # CUDA_VISIBLE_DEVICES is set by the task manager when the task is started
+    if num_gpus > 1:
+        args[3:3] = ["--multi_gpu", "--num_processes", str(num_gpus)]
+        if sys.platform == "win32":
+            customize_env["USE_LIBUV"] = "0"
+            args[3:3] = ["--rdzv_backend", "c10d"]
 
+    def _on_exit(task):
+        if task.status == TaskStatus.TERMINATED:
+            log.info(f"Training terminated / 训练已终止 ID: {task.task_id}")
+        elif task.returncode != 0:
+            log.error(f"Training failed / 训练失败 ID: {task.task_id}")
+        else:
+            log.info(f"Training finished / 训练完成 ID: {task.task_id}")
+
+    try:
+        task = tm.submit_task(args, customize_env, name="train", priority=priority,
+                              gpu_ids=gpu_ids, num_gpus=num_gpus, on_exit=_on_exit)
+    except ValueError as e:
+        log.error(f"Failed to create task / 无法创建训练任务: {e}")
+        return APIResponse(status="error", message=f"Failed to create task / 无法创建训练任务: {e}")
+
+    if task.status == TaskStatus.QUEUED:
+        return APIResponse(status="success", message=f"Training queued / 训练已加入队列 ID: {task.task_id}")
     return APIResponse(status="success", message=f"Training started / 训练开始 ID: {task.task_id}")
@@ -0,0 +1,69 @@
+# micro-benchmark: per-image Interrogator.postprocess_tags vs batched TagPostprocessor
+# usage: python -m mikazuki.scripts.benchmark_tagger_postprocess [--images 1000] [--tags 10000]
+import argparse
+import random
+import time
+
+import numpy as np
+
+from mikazuki.tagger.interrogator import Interrogator, TagPostprocessor
+
+
+def make_vocabulary(num_tags, seed):
+    rng = random.Random(seed)
+    words = ['hair', 'eyes', 'long', 'short', 'smile', 'open', 'mouth', 'dress', '(cosplay)', 'blue', 'red', 'o']
+    names = set()
+    while len(names) < num_tags:
+        names.add('_'.join(rng.choice(words) for _ in range(rng.randint(1, 3))) + f'_{len(names)}')
+    return np.array(sorted(names), dtype=object)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=10000)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    tag_names = make_vocabulary(args.tags, args.seed)
+    rng = np.random.default_rng(args.seed)
+    # most confidences are tiny, a few dozen per image are above the threshold
+    confidents = (rng.random((args.images, args.tags), dtype=np.float32) ** 40).astype(np.float32)
+
+    opts = (
+        0.35,
+        [str(tag_names[0]), 'extra_tag'],
+        [str(tag_names[1])],
+        False,
+        False,
+        True,
+        [str(tag_names[2])],
+        True
+    )
+
+    start = time.perf_counter()
+    expected = []
+    for row in confidents:
+        tags = dict(zip(tag_names.tolist(), row.tolist()))
+        expected.append(', '.join(Interrogator.postprocess_tags(tags, *opts)))
+    per_image = time.perf_counter() - start
+
+    start = time.perf_counter()
+    postprocessor = TagPostprocessor(tag_names, *opts)
+    actual = []
+    for i in range(0, args.images, args.batch_size):
+        actual.extend(postprocessor(confidents[i:i + args.batch_size]))
+    batched = time.perf_counter() - start
+
+    if actual != expected:
+        mismatch = next(i for i, (a, e) in enumerate(zip(actual, expected)) if a != e)
+        raise AssertionError(f'outputs differ at image {mismatch}:\n{actual[mismatch]}\n{expected[mismatch]}')
+
+    print(f'{args.images} images x {args.tags} tags, outputs are identical')
+    print(f'per-image: {per_image:.3f}s ({per_image / args.images * 1000:.3f} ms/image)')
+    print(f'batched:   {batched:.3f}s ({batched / args.images * 1000:.3f} ms/image), {per_image / batched:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
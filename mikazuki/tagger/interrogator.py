@@ -2,7 +2,8 @@
 import json
 import os
 import re
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from pathlib import Path
 from typing import Dict, List, Tuple
@@ -14,6 +15,7 @@ from PIL import UnidentifiedImageError
 from huggingface_hub import hf_hub_download
 
 from mikazuki.tagger import dbimutils, format
+from mikazuki.tasks import tm
 
 tag_escape_pattern = re.compile(r'([\\()])')
 
@@ -71,12 +73,48 @@ class Interrogator:
 
         return tags
 
+    @staticmethod
+    def postprocess_tags_batch(
+            confidents: np.ndarray,
+            tag_names: np.ndarray,
+
+            threshold=0.35,
+            additional_tags: List[str] = [],
+            exclude_tags: List[str] = [],
+            sort_by_alphabetical_order=False,
+            add_confident_as_weight=False,
+            replace_underscore=False,
+            replace_underscore_excludes: List[str] = [],
+            escape_tag=False
+    ) -> List[str]:
+        """
+        batch version of postprocess_tags. confidents is (N, len(tag_names)),
+        returns N caption strings, same as ', '.join(postprocess_tags(...)) for each row.
+        use TagPostprocessor directly to reuse the precomputed vocabulary over many batches.
+        """
+        postprocessor = TagPostprocessor(
+            tag_names,
+            threshold,
+            additional_tags,
+            exclude_tags,
+            sort_by_alphabetical_order,
+            add_confident_as_weight,
+            replace_underscore,
+            replace_underscore_excludes,
+            escape_tag
+        )
+        return postprocessor(confidents)
+
     def __init__(self, name: str) -> None:
         self.name = name
 
     def load(self):
         raise NotImplementedError()
 
+    def ensure_loaded(self) -> None:
+        if not hasattr(self, 'model') or self.model is None:
+            self.load()
+
     def unload(self) -> bool:
         unloaded = False
 
@@ -88,6 +126,9 @@ class Interrogator:
         if hasattr(self, 'tags'):
             del self.tags
 
+        if hasattr(self, 'tag_names'):
+            del self.tag_names
+
         return unloaded
 
     def interrogate(
@@ -99,6 +140,122 @@ class Interrogator:
     ]:
         raise NotImplementedError()
 
+    def preprocess(self, image: Image) -> np.ndarray:
+        """convert an image to an input of the model. thread safe, called from the loader threads"""
+        raise NotImplementedError()
+
+    def interrogate_batch(self, images: List[np.ndarray], pad_to: int = None) -> np.ndarray:
+        """returns confidents of (len(images), len(self.tag_names)), ratings first"""
+        raise NotImplementedError()
+
+    def max_batch_size(self) -> int:
+        return None
+
+
+class TagPostprocessor:
+    """
+    Interrogator.postprocess_tags over a whole (N, num_tags) confidence matrix.
+    Formatted tag names (underscore replacement, escaping) and the exclude mask are computed once per vocabulary,
+    thresholding and sorting are done with numpy for all rows at once.
+    """
+
+    def __init__(
+            self,
+            tag_names: np.ndarray,
+
+            threshold=0.35,
+            additional_tags: List[str] = [],
+            exclude_tags: List[str] = [],
+            sort_by_alphabetical_order=False,
+            add_confident_as_weight=False,
+            replace_underscore=False,
+            replace_underscore_excludes: List[str] = [],
+            escape_tag=False
+    ) -> None:
+        self.threshold = threshold
+        self.sort_by_alphabetical_order = sort_by_alphabetical_order
+        self.add_confident_as_weight = add_confident_as_weight
+
+        # additional tags are the columns after the vocabulary, unless they are already in it
+        names = list(tag_names)
+        self.num_tags = len(names)
+        index = {t: i for i, t in enumerate(names)}
+        self.additional_columns = []
+        for t in additional_tags:
+            if t not in index:
+                index[t] = len(names)
+                names.append(t)
+            self.additional_columns.append(index[t])
+        self.additional_columns = np.array(self.additional_columns, dtype=np.int64)
+
+        exclude_tags = set(exclude_tags)
+        self.keep = np.array([t not in exclude_tags for t in names], dtype=bool)
+
+        replace_underscore_excludes = set(replace_underscore_excludes)
+        display_names = []
+        for tag in names:
+            new_tag = tag
+            if replace_underscore and tag not in replace_underscore_excludes:
+                new_tag = new_tag.replace('_', ' ')
+            if escape_tag:
+                new_tag = tag_escape_pattern.sub(r'\\\1', new_tag)
+            display_names.append(new_tag)
+        self.display_names = display_names
+
+        # different tags may be formatted to the same string, e.g. "a_b" and "a b"
+        self.has_duplicates = len(set(display_names)) < len(display_names)
+
+        # rank of each tag in alphabetical order
+        self.alphabetical_rank = np.empty(len(names), dtype=np.int64)
+        self.alphabetical_rank[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+
+    def __call__(self, confidents: np.ndarray) -> List[str]:
+        return self.process(confidents)[0]
+
+    def process(self, confidents: np.ndarray) -> Tuple[List[str], List[int]]:
+        """returns captions and the number of tags in each caption"""
+        confidents = np.asarray(confidents)
+        num_rows = confidents.shape[0]
+        if confidents.shape[1] != self.num_tags:
+            raise ValueError(f'expected {self.num_tags} tags, got {confidents.shape[1]}')
+
+        if len(self.keep) > self.num_tags:
+            extra = np.zeros((num_rows, len(self.keep) - self.num_tags), dtype=confidents.dtype)
+            confidents = np.concatenate([confidents, extra], axis=1)
+        elif len(self.additional_columns) > 0:
+            confidents = confidents.copy()
+        if len(self.additional_columns) > 0:
+            confidents[:, self.additional_columns] = 1.0
+
+        # compare in float64 like the per-image path, which compares python floats
+        rows, columns = np.nonzero((confidents >= np.float64(self.threshold)) & self.keep)
+        values = confidents[rows, columns]
+
+        # order in each row: by name, or by confidence (descending, ties keep the vocabulary order)
+        if self.sort_by_alphabetical_order:
+            order = np.lexsort((self.alphabetical_rank[columns], rows))
+        else:
+            order = np.lexsort((columns, -values, rows))
+        rows, columns, values = rows[order], columns[order], values[order]
+
+        bounds = np.searchsorted(rows, np.arange(num_rows + 1))
+        columns = columns.tolist()
+        values = values.tolist()
+
+        display_names = self.display_names
+        captions, counts = [], []
+        for i in range(num_rows):
+            start, end = bounds[i], bounds[i + 1]
+            if self.add_confident_as_weight:
+                tags = [f'({display_names[c]}:{v})' for c, v in zip(columns[start:end], values[start:end])]
+            else:
+                tags = [display_names[c] for c in columns[start:end]]
+            if self.has_duplicates:
+                tags = list(dict.fromkeys(tags))
+            captions.append(', '.join(tags))
+            counts.append(len(tags))
+        return captions, counts
+
 
 class WaifuDiffusionInterrogator(Interrogator):
     def __init__(
@@ -150,24 +307,22 @@ class WaifuDiffusionInterrogator(Interrogator):
         print(f'Loaded {self.name} model from {model_path}')
 
         self.tags = pd.read_csv(tags_path)
+        self.tag_names = self.tags['name'].to_numpy(dtype=object)
 
-    def interrogate(
-            self,
-            image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
+    def input_size(self) -> int:
+        _, height, _, _ = self.model.get_inputs()[0].shape
+        return height
+
+    def max_batch_size(self) -> int:
+        # some exported models have a fixed batch dimension
+        batch_dim = self.model.get_inputs()[0].shape[0]
+        return batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
 
+    def preprocess(self, image: Image) -> np.ndarray:
         # code for converting the image and running the model is taken from the link below
         # thanks, SmilingWolf!
         # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
-
-        # convert an image to fit the model
-        _, height, _, _ = self.model.get_inputs()[0].shape
+        height = self.input_size()
 
         # alpha to white
         image = image.convert('RGBA')
@@ -181,22 +336,39 @@ class WaifuDiffusionInterrogator(Interrogator):
 
         image = dbimutils.make_square(image, height)
         image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        return image.astype(np.float32)
+
+    def interrogate_batch(self, images: List[np.ndarray], pad_to: int = None) -> np.ndarray:
+        self.ensure_loaded()
+
+        batch = np.stack(images)
+        if pad_to is not None and len(images) < pad_to:
+            # keep the input shape fixed, so the execution provider does not re-plan for the last batch
+            padding = np.zeros((pad_to - len(images),) + batch.shape[1:], dtype=batch.dtype)
+            batch = np.concatenate([batch, padding])
 
-        # evaluate model
         input_name = self.model.get_inputs()[0].name
         label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
+        confidents = self.model.run([label_name], {input_name: batch})[0]
+        return confidents[:len(images)]
+
+    def interrogate(
+            self,
+            image: Image
+    ) -> Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]:
+        # init model
+        self.ensure_loaded()
 
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
+        confidents = self.interrogate_batch([self.preprocess(image)])[0].tolist()
 
         # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
+        ratings = dict(zip(self.tag_names[:4], confidents[:4]))
 
         # rest are regular tags
-        tags = dict(tags[4:].values)
+        tags = dict(zip(self.tag_names[4:], confidents[4:]))
 
         return ratings, tags
 
@@ -246,6 +418,101 @@ def split_str(s: str, separator=',') -> List[str]:
     return [x.strip() for x in s.split(separator) if x]
 
 
+def write_output(
+        output_path: Path,
+        plain_tags: str,
+        batch_output_action_on_conflict: str,
+        batch_remove_duplicated_tag: bool
+):
+    output = []
+
+    if output_path.is_file():
+        output.append(output_path.read_text(errors='ignore').strip())
+
+    if batch_output_action_on_conflict == 'copy':
+        output = [plain_tags]
+    elif batch_output_action_on_conflict == 'prepend':
+        output.insert(0, plain_tags)
+    else:
+        output.append(plain_tags)
+
+    if batch_remove_duplicated_tag:
+        output_path.write_text(
+            ', '.join(
+                OrderedDict.fromkeys(
+                    map(str.strip, ','.join(output).split(','))
+                )
+            ),
+            encoding='utf-8'
+        )
+    else:
+        output_path.write_text(
+            ', '.join(output),
+            encoding='utf-8'
+        )
+
+
+def iter_preprocessed_batches(
+        interrogator: Interrogator,
+        jobs: List[Tuple[Path, Path]],
+        batch_size: int,
+        num_workers: int = None,
+        task=None
+):
+    """
+    decode and preprocess images in a thread pool (PIL decoding and cv2 resizing release the GIL),
+    yielding (jobs, images) in batches of batch_size. images which cannot be read are skipped.
+    """
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+
+    def load(path: Path):
+        try:
+            with Image.open(path) as image:
+                return interrogator.preprocess(image)
+        except (UnidentifiedImageError, OSError) as e:
+            # just in case, user has mysterious file...
+            print(f'{path} is not supported image type: {e}')
+            return None
+
+    max_in_flight = max(batch_size * 2, num_workers)
+    executor = ThreadPoolExecutor(max(1, num_workers))
+    try:
+        pending = deque()
+        job_iter = iter(jobs)
+        for job in job_iter:
+            pending.append((job, executor.submit(load, job[0])))
+            if len(pending) >= max_in_flight:
+                break
+
+        batch_jobs, batch_images = [], []
+        while pending:
+            if task is not None and task.terminated:
+                return
+
+            job, future = pending.popleft()
+            next_job = next(job_iter, None)
+            if next_job is not None:
+                pending.append((next_job, executor.submit(load, next_job[0])))
+
+            image = future.result()
+            if image is None:
+                if task is not None:
+                    task.update()
+                continue
+
+            batch_jobs.append(job)
+            batch_images.append(image)
+            if len(batch_jobs) == batch_size:
+                yield batch_jobs, batch_images
+                batch_jobs, batch_images = [], []
+
+        if batch_jobs:
+            yield batch_jobs, batch_images
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def on_interrogate(
         image: Image,
         batch_input_glob: str,
@@ -266,7 +533,10 @@ def on_interrogate(
         replace_underscore_excludes: str,
         escape_tag: bool,
 
-        unload_model_after_running: bool
+        unload_model_after_running: bool,
+
+        batch_size: int = 8,
+        num_workers: int = None
 ):
     postprocess_opts = (
         threshold,
@@ -319,14 +589,9 @@ def on_interrogate(
 
         print(f'found {len(paths)} image(s)')
 
+        # resolve output paths first, so that skipped images are never decoded
+        jobs = []
         for path in paths:
-            try:
-                image = Image.open(path)
-            except UnidentifiedImageError:
-                # just in case, user has mysterious file...
-                print(f'${path} is not supported image type')
-                continue
-
             # guess the output path
             base_dir_last = Path(base_dir).parts[-1]
             base_dir_last_idx = path.parts.index(base_dir_last)
@@ -352,56 +617,58 @@ def on_interrogate(
                 formatted_output_filename
             )
 
-            output = []
-
-            if output_path.is_file():
-                output.append(output_path.read_text(errors='ignore').strip())
-
-                if batch_output_action_on_conflict == 'ignore':
-                    print(f'skipping {path}')
-                    continue
-
-            ratings, tags = interrogator.interrogate(image)
-            processed_tags = Interrogator.postprocess_tags(
-                tags,
-                *postprocess_opts
-            )
-
-            # TODO: switch for less print
-            print(
-                f'found {len(processed_tags)} tags out of {len(tags)} from {path}'
-            )
-
-            plain_tags = ', '.join(processed_tags)
-
-            if batch_output_action_on_conflict == 'copy':
-                output = [plain_tags]
-            elif batch_output_action_on_conflict == 'prepend':
-                output.insert(0, plain_tags)
-            else:
-                output.append(plain_tags)
+            if output_path.is_file() and batch_output_action_on_conflict == 'ignore':
+                print(f'skipping {path}')
+                continue
 
-            if batch_remove_duplicated_tag:
-                output_path.write_text(
-                    ', '.join(
-                        OrderedDict.fromkeys(
-                            map(str.strip, ','.join(output).split(','))
+            jobs.append((path, output_path))
+
+        interrogator.ensure_loaded()
+        max_batch_size = interrogator.max_batch_size()
+        if max_batch_size is not None:
+            batch_size = min(batch_size, max_batch_size)
+        batch_size = max(1, batch_size)
+
+        # rest of the tags after the 4 ratings
+        postprocessor = TagPostprocessor(interrogator.tag_names[4:], *postprocess_opts)
+
+        task = tm.create_progress_task('interrogate', total=len(jobs))
+        try:
+            for batch_jobs, batch_images in iter_preprocessed_batches(interrogator, jobs, batch_size, num_workers, task):
+                confidents = interrogator.interrogate_batch(batch_images, pad_to=batch_size)
+
+                captions, counts = postprocessor.process(confidents[:, 4:])
+
+                for (path, output_path), confident, plain_tags, count in zip(batch_jobs, confidents, captions, counts):
+                    # TODO: switch for less print
+                    print(
+                        f'found {count} tags out of {len(confident) - 4} from {path}'
+                    )
+
+                    write_output(
+                        output_path,
+                        plain_tags,
+                        batch_output_action_on_conflict,
+                        batch_remove_duplicated_tag
+                    )
+
+                    if batch_output_save_json:
+                        all_confidents = confident.tolist()
+                        output_path.with_suffix('.json').write_text(
+                            json.dumps([
+                                dict(zip(interrogator.tag_names[:4], all_confidents[:4])),
+                                dict(zip(interrogator.tag_names[4:], all_confidents[4:]))
+                            ])
                         )
-                    ),
-                    encoding='utf-8'
-                )
-            else:
-                output_path.write_text(
-                    ', '.join(output),
-                    encoding='utf-8'
-                )
 
-            if batch_output_save_json:
-                output_path.with_suffix('.json').write_text(
-                    json.dumps([ratings, tags])
-                )
+                task.update(len(batch_jobs))
+        finally:
+            task.finish()
 
-        print('all done / 识别完成')
+        if task.terminated:
+            print('interrogation terminated / 识别已终止')
+        else:
+            print('all done / 识别完成')
 
     if unload_model_after_running:
         interrogator.unload()
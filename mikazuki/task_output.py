@@ -0,0 +1,192 @@
+import asyncio
+import codecs
+import os
+import re
+import sys
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# tqdm progress bar of sd-scripts, e.g.
+# steps:  12%|█▏        | 120/1000 [01:23<10:12,  1.44it/s, avr_loss=0.0812]
+progress_pattern = re.compile(
+    r'(?P<desc>[^:\r\n]*?):\s*\d+%\|[^|]*\|\s*(?P<n>\d+)/(?P<total>\d+)\s*'
+    r'\[(?P<elapsed>[\d:]+)<(?P<remaining>[\d:?]+),\s*(?P<rate>[\d.]+|\?)(?P<unit>it/s|s/it)(?:,\s*(?P<postfix>[^\]]*))?\]'
+)
+postfix_pattern = re.compile(r'([\w/.\-]+)=([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+epoch_pattern = re.compile(r'^\s*epoch (\d+)/(\d+)')
+line_break_pattern = re.compile(r'(\r\n|\r|\n)')
+
+
+def parse_metrics(line: str) -> Optional[Dict]:
+    """parse training progress from a line of trainer output, returns None if the line has no metrics"""
+    match = epoch_pattern.match(line)
+    if match:
+        return {"epoch": int(match.group(1)), "total_epochs": int(match.group(2))}
+
+    match = progress_pattern.search(line)
+    if match is None or match.group("desc").strip() != "steps":
+        # validation and caching progress bars are not training steps
+        return None
+
+    metrics = {
+        "step": int(match.group("n")),
+        "total_steps": int(match.group("total")),
+        "elapsed": match.group("elapsed"),
+        "remaining": match.group("remaining"),
+    }
+    rate = match.group("rate")
+    if rate != "?" and float(rate) > 0:
+        metrics["it_per_sec"] = float(rate) if match.group("unit") == "it/s" else 1 / float(rate)
+
+    for key, value in postfix_pattern.findall(match.group("postfix") or ""):
+        metrics[key] = float(value)
+    if "loss" not in metrics and "avr_loss" in metrics:
+        metrics["loss"] = metrics["avr_loss"]
+    return metrics
+
+
+class TaskOutput:
+    """
+    Output of a task kept in a bounded ring buffer of lines, with the latest parsed metrics.
+
+    Lines ended with "\\r" (progress bar updates) are not stored as lines, only the latest one is kept as `progress`.
+    The reader thread appends, any number of asyncio clients follow it with `follow` without polling.
+    """
+
+    def __init__(self, max_lines: int = 2000):
+        self.lines = deque(maxlen=max_lines)  # (seq, text)
+        self.next_seq = 0
+        self.progress = None
+        self.metrics: Dict = {}
+        self.version = 0  # incremented on every change, for followers
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.waiters = set()  # (loop, asyncio.Event)
+
+    def _notify(self):
+        self.version += 1
+        for loop, event in list(self.waiters):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the event loop of the client is closed
+                self.waiters.discard((loop, event))
+
+    def _update_metrics(self, text: str):
+        metrics = parse_metrics(text)
+        if metrics:
+            self.metrics.update(metrics)
+
+    def append(self, text: str):
+        with self.lock:
+            self.lines.append((self.next_seq, text))
+            self.next_seq += 1
+            self._update_metrics(text)
+            self._notify()
+
+    def set_progress(self, text: str):
+        with self.lock:
+            if text == self.progress:
+                return
+            self.progress = text
+            self._update_metrics(text)
+            self._notify()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._notify()
+
+    def read(self, after: int = -1) -> Tuple[List[Tuple[int, str]], Optional[str], Dict, bool]:
+        """returns (lines with seq greater than after, progress, metrics, closed)"""
+        with self.lock:
+            lines = [item for item in self.lines if item[0] > after]
+            return lines, self.progress, dict(self.metrics), self.closed
+
+    async def follow(self, after: int = -1, heartbeat: float = 15):
+        """
+        async generator of ("line", (seq, text)), ("progress", text), ("metrics", dict) and ("heartbeat", None),
+        ends after the task output is closed.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        version = -1
+        last_progress, last_metrics = None, None
+        with self.lock:
+            self.waiters.add(waiter)
+        try:
+            while True:
+                event.clear()
+                with self.lock:
+                    changed = version != self.version
+                    version = self.version
+                if changed:
+                    lines, progress, metrics, closed = self.read(after)
+                    for item in lines:
+                        yield "line", item
+                        after = item[0]
+                    if progress is not None and progress != last_progress:
+                        yield "progress", progress
+                        last_progress = progress
+                    if metrics and metrics != last_metrics:
+                        yield "metrics", metrics
+                        last_metrics = metrics
+                    if closed:
+                        return
+
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield "heartbeat", None
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+
+def pump_output(stream, output: TaskOutput, echo=True):
+    """read the merged stdout/stderr of a process into output until EOF. runs in a thread"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    fd = stream.fileno()
+    pending = ""
+    after_cr = False
+    try:
+        while True:
+            chunk = os.read(fd, 65536)
+            if echo:
+                # keep the trainer output in the console as before
+                try:
+                    sys.stdout.buffer.write(chunk)
+                    sys.stdout.flush()
+                except Exception:
+                    pass
+            if not chunk:
+                break
+
+            data = pending + decoder.decode(chunk)
+            # "\r" at the end may be the first half of "\r\n"
+            held = "\r" if data.endswith("\r") else ""
+            parts = line_break_pattern.split(data[:len(data) - len(held)])
+            pending = parts.pop() + held
+            # parts are [text, separator, text, separator, ...]
+            for text, separator in zip(parts[0::2], parts[1::2]):
+                if separator == "\r":
+                    if text.strip():
+                        output.set_progress(text)
+                else:
+                    output.append(text)
+                after_cr = separator == "\r"
+
+            # tqdm writes "\r" before the bar, so show the bar now instead of at the next update
+            if after_cr and pending.strip("\r").strip():
+                output.set_progress(pending.rstrip("\r"))
+    except OSError:
+        pass
+    finally:
+        pending = (pending + decoder.decode(b"", final=True)).rstrip("\r")
+        if pending:
+            output.append(pending)
+        stream.close()
+        output.close()
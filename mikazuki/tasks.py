@@ -1,14 +1,20 @@
+import heapq
+import itertools
+import re
 import subprocess
 import sys
 import os
 import threading
+import time
 import uuid
 from enum import Enum
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 from subprocess import Popen, PIPE, TimeoutExpired, CalledProcessError, CompletedProcess
 import psutil
 
 from mikazuki.log import log
+from mikazuki.task_output import TaskOutput, pump_output
+from mikazuki.utils.devices import printable_devices
 
 try:
     import msvcrt
@@ -34,42 +40,71 @@ class TaskStatus(Enum):
     RUNNING = 1
     FINISHED = 2
     TERMINATED = 3
+    QUEUED = 4
+
+
+def parse_gpu_id(gpu_id) -> str:
+    # accepts 0, "0" or "GPU 0: NVIDIA ..." (an item of printable_devices)
+    match = re.search(r"\d+", str(gpu_id))
+    if match is None:
+        raise ValueError(f"Invalid GPU id / 无效的 GPU ID: {gpu_id}")
+    return match.group(0)
 
 
 class Task:
-    def __init__(self, task_id, command, environ=None):
+    def __init__(self, task_id, command, environ=None,
+                 name: str = "task",
+                 priority: int = 0,
+                 gpu_ids: Optional[List[str]] = None,
+                 num_gpus: int = 1,
+                 on_exit: Optional[Callable[["Task"], None]] = None,
+                 output_lines: int = 2000):
         self.task_id = task_id
         self.lock = threading.Lock()
         self.command = command
         self.status = TaskStatus.CREATED
         self.environ = environ or os.environ
 
-    def communicate(self, input=None, timeout=None):
-        try:
-            stdout, stderr = self.process.communicate(input, timeout=timeout)
-        except TimeoutExpired as exc:
-            self.process.kill()
-            if _mswindows:
-                exc.stdout, exc.stderr = self.process.communicate()
-            else:
-                self.process.wait()
-            raise
-        except:
-            self.process.kill()
-            raise
-        retcode = self.process.poll()
-        self.status = TaskStatus.FINISHED
-        return CompletedProcess(self.process.args, retcode, stdout, stderr)
-
-    def wait(self):
-        self.process.wait()
-        self.status = TaskStatus.FINISHED
+        self.name = name
+        self.priority = priority
+        self.gpu_ids = gpu_ids  # requested GPUs, None to let the scheduler choose
+        self.num_gpus = len(gpu_ids) if gpu_ids else num_gpus
+        self.assigned_gpus: List[str] = []
+        self.on_exit = on_exit
+        self.returncode = None
+
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.output = TaskOutput(max_lines=output_lines)
+        self.output_reader = None
+        self.finished = threading.Event()  # set by the task manager with finished_at
+
+    def wait(self, timeout=None) -> bool:
+        """wait until the task is finished or terminated, including the time in the queue. returns False on timeout"""
+        return self.finished.wait(timeout)
 
     def execute(self):
         self.status = TaskStatus.RUNNING
-        self.process = subprocess.Popen(self.command, env=self.environ)
+        self.started_at = time.time()
+        # stdout and stderr are merged and captured, the reader thread echoes them to the console
+        self.process = subprocess.Popen(self.command, env=self.environ, stdout=PIPE, stderr=subprocess.STDOUT)
+        self.output_reader = threading.Thread(
+            target=pump_output, args=(self.process.stdout, self.output), name=f"task-output-{self.task_id}", daemon=True
+        )
+        self.output_reader.start()
+
+    def poll(self):
+        """returns the return code if the process has exited, otherwise None"""
+        return self.process.poll()
 
     def terminate(self):
+        if self.status in (TaskStatus.CREATED, TaskStatus.QUEUED):
+            # not started yet, the scheduler drops it from the queue
+            self.status = TaskStatus.TERMINATED
+            return
+
         try:
             kill_proc_tree(self.process.pid, False)
         except Exception as e:
@@ -79,45 +114,287 @@ class Task:
             self.status = TaskStatus.TERMINATED
 
 
+class ProgressTask:
+    """
+    A task running in a thread of the GUI process (e.g. tagger) instead of a subprocess.
+    The worker calls `update` as items are done, and checks `terminated` to stop early.
+    """
+
+    def __init__(self, task_id, name, total=0):
+        self.task_id = task_id
+        self.name = name
+        self.lock = threading.Lock()
+        self.status = TaskStatus.RUNNING
+        self.total = total
+        self.done = 0
+
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def terminated(self):
+        return self.status == TaskStatus.TERMINATED
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+
+    def finish(self):
+        if self.status == TaskStatus.RUNNING:
+            self.status = TaskStatus.FINISHED
+        self.finished_at = time.time()
+
+    def terminate(self):
+        self.status = TaskStatus.TERMINATED
+
+
 class TaskManager:
-    def __init__(self, max_concurrent=1) -> None:
+    """
+    Priority queue of training tasks with per-GPU slot accounting.
+
+    Submitted tasks wait in the queue until GPUs are free: a task with `gpu_ids` waits for exactly those GPUs,
+    others take any `num_gpus` free GPUs. Higher priority first, FIFO within the same priority.
+    GPUs wanted by a waiting task are reserved, so later tasks cannot starve it.
+    A single scheduler thread polls the running processes and dispatches queued tasks when slots are freed.
+    Only the latest `max_finished` finished tasks are kept.
+
+    Without detected GPUs (printable_devices is empty), at most `max_concurrent` tasks run at once.
+    """
+
+    def __init__(self, max_concurrent=1, slots_per_gpu=1, max_finished=50, poll_interval=1.0, output_lines=2000) -> None:
         self.max_concurrent = max_concurrent
+        self.output_lines = output_lines
+        self.slots_per_gpu = slots_per_gpu
+        self.max_finished = max_finished
+        self.poll_interval = poll_interval
         self.tasks: Dict[Task] = {}
 
-    def create_task(self, command: List[str], environ):
-        running_tasks = [t for _, t in self.tasks.items() if t.status == TaskStatus.RUNNING]
-        if len(running_tasks) >= self.max_concurrent:
-            log.error(
-                f"Unable to create a task because there are already {len(running_tasks)} tasks running, reaching the maximum concurrent limit. / 无法创建任务，因为已经有 {len(running_tasks)} 个任务正在运行，已达到最大并发限制。")
-            return None
+        self.queue = []  # heap of (-priority, seq, task_id)
+        self.seq = itertools.count()
+        self.gpu_usage: Dict[str, int] = {}  # gpu id -> number of running tasks
+        self.cond = threading.Condition(threading.RLock())
+        self.scheduler = None
+
+    def available_gpus(self) -> List[str]:
+        return [parse_gpu_id(d.split(":")[0]) for d in printable_devices]
+
+    def submit_task(self, command: List[str], environ,
+                    name: str = "task",
+                    priority: int = 0,
+                    gpu_ids: Optional[List] = None,
+                    num_gpus: int = 1,
+                    on_exit: Optional[Callable[[Task], None]] = None) -> Task:
+        """
+        queue a task, it is started by the scheduler. CUDA_VISIBLE_DEVICES is set to the assigned GPUs on start,
+        so the command must be prepared for `task.num_gpus` processes.
+        """
+        if gpu_ids:
+            gpu_ids = [parse_gpu_id(g) for g in gpu_ids]
+            available = self.available_gpus()
+            unknown = [g for g in gpu_ids if available and g not in available]
+            if unknown:
+                raise ValueError(f"GPU(s) not found / 找不到 GPU: {unknown}")
+
         task_id = str(uuid.uuid4())
-        task = Task(task_id=task_id, command=command, environ=environ)
-        self.tasks[task_id] = task
-        # task.execute() # breaking change
-        log.info(f"Task {task_id} created")
+        task = Task(task_id=task_id, command=command, environ=environ, name=name,
+                    priority=priority, gpu_ids=gpu_ids or None, num_gpus=num_gpus, on_exit=on_exit,
+                    output_lines=self.output_lines)
+        task.status = TaskStatus.QUEUED
+
+        with self.cond:
+            self.tasks[task_id] = task
+            heapq.heappush(self.queue, (-priority, next(self.seq), task_id))
+            log.info(f"Task {task_id} queued")
+            self._dispatch()
+            self._ensure_scheduler()
+            self.cond.notify_all()
+        return task
+
+    def create_progress_task(self, name: str, total: int = 0) -> ProgressTask:
+        task_id = str(uuid.uuid4())
+        task = ProgressTask(task_id=task_id, name=name, total=total)
+        with self.cond:
+            self.tasks[task_id] = task
+            self._ensure_scheduler()
+        log.info(f"Task {task_id} ({name}) created")
         return task
 
+    def _ensure_scheduler(self):
+        if self.scheduler is None or not self.scheduler.is_alive():
+            self.scheduler = threading.Thread(target=self._schedule_loop, name="task-scheduler", daemon=True)
+            self.scheduler.start()
+
+    def _schedule_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait(timeout=self.poll_interval)
+                try:
+                    self._reap()
+                    self._dispatch()
+                    self._prune()
+                except Exception as e:
+                    log.error(f"Error in task scheduler: {e}")
+
+    def _running_tasks(self) -> List[Task]:
+        return [t for t in self.tasks.values() if isinstance(t, Task) and t.started_at is not None and t.finished_at is None]
+
+    def _release(self, task: Task):
+        for gpu_id in task.assigned_gpus:
+            self.gpu_usage[gpu_id] = max(0, self.gpu_usage.get(gpu_id, 0) - 1)
+
+    def _exit(self, task: Task, returncode):
+        task.returncode = returncode
+        task.finished_at = time.time()
+        if task.status != TaskStatus.TERMINATED:
+            task.status = TaskStatus.FINISHED
+        self._release(task)
+        task.finished.set()
+        if task.on_exit is not None:
+            try:
+                task.on_exit(task)
+            except Exception as e:
+                log.error(f"Error in exit callback of task {task.task_id}: {e}")
+
+    def _reap(self):
+        for task in self._running_tasks():
+            returncode = task.poll()
+            if returncode is not None:
+                self._exit(task, returncode)
+
+    def _free_gpus(self) -> List[str]:
+        return [g for g in self.available_gpus() if self.gpu_usage.get(g, 0) < self.slots_per_gpu]
+
+    def _dispatch(self):
+        gpus = self.available_gpus()
+        free = self._free_gpus()
+        reserved = set()
+        num_running = len(self._running_tasks())
+
+        waiting = []
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            task = self.tasks.get(item[2])
+            if task is None or task.status != TaskStatus.QUEUED:
+                continue  # terminated while queued
+
+            assigned = None
+            if not gpus:
+                if num_running < self.max_concurrent:
+                    assigned = task.gpu_ids or []
+            elif task.gpu_ids:
+                if all(g in free and g not in reserved for g in task.gpu_ids):
+                    assigned = task.gpu_ids
+                else:
+                    reserved.update(task.gpu_ids)
+            else:
+                candidates = [g for g in free if g not in reserved]
+                if len(candidates) >= task.num_gpus:
+                    assigned = candidates[:task.num_gpus]
+                else:
+                    reserved.update(candidates)
+
+            if assigned is None:
+                waiting.append(item)
+                continue
+
+            self._start(task, assigned)
+            num_running += 1
+            free = self._free_gpus()
+
+        for item in waiting:
+            heapq.heappush(self.queue, item)
+
+    def _start(self, task: Task, gpu_ids: List[str]):
+        task.assigned_gpus = list(gpu_ids)
+        for gpu_id in gpu_ids:
+            self.gpu_usage[gpu_id] = self.gpu_usage.get(gpu_id, 0) + 1
+
+        if gpu_ids:
+            task.environ = dict(task.environ)
+            task.environ["CUDA_VISIBLE_DEVICES"] = ",".join(gpu_ids)
+
+        try:
+            task.execute()
+            log.info(f"Task {task.task_id} started" + (f" on GPU(s) / 使用 GPU: {gpu_ids}" if gpu_ids else ""))
+        except Exception as e:
+            log.error(f"Failed to start task {task.task_id} / 任务启动失败: {e}")
+            task.started_at = task.started_at or time.time()
+            self._exit(task, -1)
+
+    def _prune(self):
+        finished = [t for t in self.tasks.values()
+                    if t.status in (TaskStatus.FINISHED, TaskStatus.TERMINATED) and t.finished_at is not None]
+        if len(finished) <= self.max_finished:
+            return
+        finished.sort(key=lambda t: t.finished_at)
+        for task in finished[:len(finished) - self.max_finished]:
+            del self.tasks[task.task_id]
+
     def add_task(self, task_id: str, task: Task):
         self.tasks[task_id] = task
 
     def terminate_task(self, task_id: str):
-        if task_id in self.tasks:
-            task = self.tasks[task_id]
-            task.terminate()
+        with self.cond:
+            if task_id in self.tasks:
+                task = self.tasks[task_id]
+                queued = task.status == TaskStatus.QUEUED
+                task.terminate()
+                if queued:
+                    task.finished_at = time.time()
+                    task.finished.set()
+                self.cond.notify_all()
 
     def wait_for_process(self, task_id: str):
         if task_id in self.tasks:
             task: Task = self.tasks[task_id]
             task.wait()
 
+    def queue_positions(self) -> Dict[str, int]:
+        queued = [item for item in sorted(self.queue)
+                  if item[2] in self.tasks and self.tasks[item[2]].status == TaskStatus.QUEUED]
+        return {item[2]: pos for pos, item in enumerate(queued, start=1)}
+
     def dump(self) -> List[Dict]:
-        return [
-            {
-                "id": task.task_id,
-                "status": task.status.name,
-            }
-            for task in self.tasks.values()
-        ]
+        with self.cond:
+            positions = self.queue_positions()
+            dumped = []
+            for task in self.tasks.values():
+                info = {
+                    "id": task.task_id,
+                    "status": task.status.name,
+                    "name": task.name,
+                    "created_at": task.created_at,
+                    "finished_at": task.finished_at,
+                }
+                if isinstance(task, ProgressTask):
+                    info.update({
+                        "done": task.done,
+                        "total": task.total,
+                    })
+                else:
+                    info.update({
+                        "metrics": task.output.metrics or None,
+                        "priority": task.priority,
+                        "queue_position": positions.get(task.task_id),
+                        "gpus": task.assigned_gpus or task.gpu_ids,
+                        "num_gpus": task.num_gpus,
+                        "started_at": task.started_at,
+                        "returncode": task.returncode,
+                    })
+                dumped.append(info)
+            return dumped
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
 
 
-tm = TaskManager()
+tm = TaskManager(
+    max_concurrent=_env_int("MIKAZUKI_MAX_CONCURRENT_TASKS", 1),
+    slots_per_gpu=_env_int("MIKAZUKI_TASKS_PER_GPU", 1),
+    max_finished=_env_int("MIKAZUKI_TASK_RETENTION", 50),
+    output_lines=_env_int("MIKAZUKI_TASK_LOG_LINES", 2000),
+)
@@ -0,0 +1,201 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from mikazuki.log import log
+from mikazuki.utils import train_utils
+
+
+class FileIndex:
+    """
+    In-memory index of the files under a directory, kept fresh by polling.
+
+    A directory is listed again only when its mtime is changed (files are added, removed or renamed).
+    Files modified recently (e.g. a checkpoint which is still being written) are stat-ed again on every refresh,
+    and everything is checked again every `full_rescan_interval` seconds.
+    Path resolving and model type detection are done once per new or changed file.
+    """
+
+    def __init__(self, path: str, regex_filter: Optional[str] = None, full_rescan_interval: float = 300):
+        self.path = path
+        self.pattern = re.compile(regex_filter) if regex_filter else None
+        self.full_rescan_interval = full_rescan_interval
+
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}  # file path -> entry
+        self.dir_mtimes: Dict[str, int] = {}  # dir path -> mtime_ns when listed
+        self.dir_contents: Dict[str, Tuple[List[str], List[str]]] = {}  # dir path -> (file paths, sub dirs) when listed
+        self.last_full_scan = 0
+        self.scanned = threading.Condition(self.lock)
+        self.requested_generation = 0  # incremented by request_refresh, a scan started after a request covers it
+        self.scanned_generation = -1  # generation covered by the last finished scan, -1 before the first scan
+
+    def _make_entry(self, file_path: str, st: os.stat_result, old: Optional[Dict]) -> Dict:
+        if old is not None and old["mtime"] == st.st_mtime_ns and old["size_bytes"] == st.st_size:
+            return old
+
+        model_type = train_utils.ModelType.UNKNOWN
+        try:
+            model_type = train_utils.guess_model_type(file_path) or train_utils.ModelType.UNKNOWN
+        except Exception:
+            # not a model, or still being written
+            pass
+
+        return {
+            "path": old["path"] if old is not None else os.path.realpath(file_path).replace("\\", "/"),
+            "name": os.path.basename(file_path),
+            "size": f"{round(st.st_size / (1024**3), 2)} GB",
+            "size_bytes": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "model_type": model_type.name,
+        }
+
+    def request_refresh(self) -> int:
+        """returns the generation to wait for: the scan which starts after this call"""
+        with self.lock:
+            self.requested_generation += 1
+            return self.requested_generation
+
+    def wait(self, generation: int = 0, timeout: Optional[float] = None) -> bool:
+        """wait until a scan covering `generation` is finished, 0 is the first scan"""
+        with self.lock:
+            return self.scanned.wait_for(lambda: self.scanned_generation >= generation, timeout)
+
+    def refresh(self):
+        with self.lock:
+            generation = self.requested_generation
+        try:
+            self._scan()
+        finally:
+            # also on errors, not to keep the waiters until the timeout
+            with self.lock:
+                self.scanned_generation = max(self.scanned_generation, generation)
+                self.scanned.notify_all()
+
+    def _scan(self):
+        now = time.time()
+        full_scan = now - self.last_full_scan >= self.full_rescan_interval
+        recent_ns = (now - self.full_rescan_interval) * 1e9
+
+        entries: Dict[str, Dict] = {}
+        dir_mtimes: Dict[str, int] = {}
+        dir_contents: Dict[str, Tuple[List[str], List[str]]] = {}
+        visited = set()
+
+        stack = [self.path]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                real_path = os.path.realpath(dir_path)
+                if real_path in visited:
+                    continue  # symlink loop
+                visited.add(real_path)
+                dir_mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+
+            if not full_scan and self.dir_mtimes.get(dir_path) == dir_mtime:
+                # not changed since listed: only recently modified files may be changed
+                files, sub_dirs = self.dir_contents[dir_path]
+                dir_mtimes[dir_path] = dir_mtime
+                dir_contents[dir_path] = (files, sub_dirs)
+                stack.extend(sub_dirs)
+                for file_path in files:
+                    old = self.entries.get(file_path)
+                    if old is None:
+                        continue
+                    if old["mtime"] >= recent_ns:
+                        try:
+                            old = self._make_entry(file_path, os.stat(file_path), old)
+                        except OSError:
+                            continue
+                    entries[file_path] = old
+                continue
+
+            files, sub_dirs = [], []
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                sub_dirs.append(entry.path)
+                            elif entry.is_file():
+                                if self.pattern is not None and not self.pattern.search(entry.name):
+                                    continue
+                                files.append(entry.path)
+                                entries[entry.path] = self._make_entry(entry.path, entry.stat(), self.entries.get(entry.path))
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            stack.extend(sub_dirs)
+            dir_mtimes[dir_path] = dir_mtime
+            dir_contents[dir_path] = (files, sub_dirs)
+
+        with self.lock:
+            self.entries = entries
+            self.dir_mtimes = dir_mtimes
+            self.dir_contents = dir_contents
+        if full_scan:
+            self.last_full_scan = now
+
+    def list(self) -> List[Dict]:
+        with self.lock:
+            entries = list(self.entries.values())
+        entries.sort(key=lambda e: e["path"])
+        return entries
+
+
+class FileIndexer:
+    """refresh registered file indexes in a background thread"""
+
+    def __init__(self, poll_interval: float = 10):
+        self.poll_interval = poll_interval
+        self.indexes: Dict[str, FileIndex] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def get_index(self, path: str, regex_filter: Optional[str] = None) -> FileIndex:
+        key = f"{path}\n{regex_filter}"
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = FileIndex(path, regex_filter)
+                self.indexes[key] = index
+                self.wakeup.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="file-indexer", daemon=True)
+                self.thread.start()
+        return index
+
+    def request_refresh(self, index: FileIndex) -> int:
+        """rescan the index soon, returns the generation to pass to index.wait"""
+        generation = index.request_refresh()
+        self.wakeup.set()
+        return generation
+
+    def _loop(self):
+        while True:
+            # cleared before the scans, so a request during the scans wakes up the next loop at once
+            self.wakeup.clear()
+            with self.lock:
+                indexes = list(self.indexes.values())
+            for index in indexes:
+                try:
+                    index.refresh()
+                except Exception as e:
+                    log.error(f"Error when indexing files in {index.path}: {e}")
+            self.wakeup.wait(timeout=self.poll_interval)
+
+
+def _poll_interval():
+    try:
+        return float(os.environ.get("MIKAZUKI_FILE_INDEX_INTERVAL", 10))
+    except ValueError:
+        return 10
+
+
+file_indexer = FileIndexer(poll_interval=_poll_interval())
@@ -1,3 +1,4 @@
+from bisect import bisect_left
 from enum import Enum
 import glob
 import os
@@ -5,7 +6,8 @@ import re
 import shutil
 import sys
 import json
-from typing import Dict
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from mikazuki.log import log
 
@@ -27,7 +29,7 @@ MODEL_SIGNATURE = [
         "type": ModelType.FLUX,
         "signature": [
             "double_blocks.0.img_mlp.0.weight",
-            "guidance_in.in_layer.weight"
+            "guidance_in.in_layer.weight",
             "model.diffusion_model.double_blocks",
             "double_blocks.0.img_attn.norm.query_norm.scale",
         ]
@@ -56,7 +58,7 @@ MODEL_SIGNATURE = [
         "type": ModelType.LoRA,
         "signature": [
             "lora_te_text_model_encoder",
-            "lora_unet_up_blocks"
+            "lora_unet_up_blocks",
             "lora_unet_input_blocks_4_1_transformer_blocks_0_attn1_to_k.alpha",
             "lora_unet_input_blocks_4_1_transformer_blocks_0_attn1_to_k.lora_up.weight",
 
@@ -102,19 +104,56 @@ def read_safetensors_metadata(path) -> Dict:
 
     with open(path, "rb") as f:
         meta_length = int.from_bytes(f.read(8), "little")
+        if meta_length > 100 * 1024 * 1024:
+            raise ValueError(f"Invalid safetensors header length: {meta_length}")
         meta = f.read(meta_length)
         return json.loads(meta)
 
 
-def guess_model_type(path):
+class KeyPrefixIndex:
+    """
+    Sorted index of tensor keys and of their suffixes after each ".", so that a signature is looked up with a binary search
+    instead of a substring search over all keys. A signature matches if a key, or a part of a key after a ".",
+    starts with it: "lora_te" matches "lora_te1_text_model...", "lora_A.weight" matches "...q_proj.lora_A.weight".
+    """
+
+    def __init__(self, keys: Iterable[str]):
+        entries = set()
+        for key in keys:
+            entries.add(key)
+            pos = key.find(".")
+            while pos != -1:
+                entries.add(key[pos + 1:])
+                pos = key.find(".", pos + 1)
+        self.entries = sorted(entries)
+
+    def has_prefix(self, prefix: str) -> bool:
+        i = bisect_left(self.entries, prefix)
+        return i < len(self.entries) and self.entries[i].startswith(prefix)
+
+
+def match_model_type(keys: Iterable[str]) -> ModelType:
+    index = KeyPrefixIndex(k for k in keys if k != "__metadata__")
+    for m in MODEL_SIGNATURE:
+        if any(index.has_prefix(k) for k in m["signature"]):
+            return m["type"]
+    return ModelType.UNKNOWN
+
+
+def get_model_fingerprint(path) -> Tuple[str, int, int]:
+    """(absolute path, size, mtime_ns), the key of the model type cache"""
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+_model_type_cache: Dict[str, Tuple[int, int, ModelType]] = {}
+_model_type_cache_lock = threading.Lock()
+
+
+def _guess_model_type_uncached(path):
     if path.endswith("safetensors"):
         metadata = read_safetensors_metadata(path)
-        model_keys = "\n".join(metadata.keys())
-        for m in MODEL_SIGNATURE:
-            if any([k in model_keys for k in m["signature"]]):
-                return m["type"]
-
-        return ModelType.UNKNOWN
+        return match_model_type(metadata.keys())
 
     if path.endswith("pt") or path.endswith("ckpt"):
         with open(path, "rb") as f:
@@ -122,6 +161,41 @@ def guess_model_type(path):
             return match_model_type_legacy(content)
 
 
+def guess_model_type(path):
+    """
+    guess the model type from the tensor keys. the result is cached by path, size and mtime,
+    so the file listing, run validation and preset suggestions read the header of a model only once.
+    """
+    try:
+        abs_path, size, mtime = get_model_fingerprint(path)
+    except OSError:
+        return _guess_model_type_uncached(path)
+
+    with _model_type_cache_lock:
+        cached = _model_type_cache.get(abs_path)
+    if cached is not None and cached[0] == size and cached[1] == mtime:
+        return cached[2]
+
+    model_type = _guess_model_type_uncached(path)
+    if model_type is not None:
+        with _model_type_cache_lock:
+            _model_type_cache[abs_path] = (size, mtime, model_type)
+    return model_type
+
+
+def suggest_train_types(model_type: ModelType) -> Optional[List[str]]:
+    """train types (preset metadata.train_type / model_train_type) which can use the model, None if unknown"""
+    if model_type == ModelType.FLUX:
+        return ["flux-lora", "flux-finetune"]
+    if model_type == ModelType.SD3:
+        return ["sd3-lora"]
+    if model_type == ModelType.SDXL:
+        return ["lora-basic", "lora-master", "dreambooth", "sdxl-lora", "sdxl-finetune"]
+    if model_type in [ModelType.SD15, ModelType.SD2]:
+        return ["lora-basic", "lora-master", "dreambooth", "sd-lora", "sd-dreambooth"]
+    return None
+
+
 def validate_model(model_name: str, training_type: str = "sd-lora"):
     if os.path.exists(model_name):
         if os.path.isdir(model_name):
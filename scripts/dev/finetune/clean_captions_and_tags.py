@@ -2,12 +2,12 @@
 # (c) 2022 Kohya S. @kohya_ss
 
 import argparse
-import glob
+import functools
 import os
-import json
 import re
 
 from tqdm import tqdm
+from library import metadata_util
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -30,6 +30,12 @@ PATTERNS_REMOVE_IN_MULTI = [
 ]
 
 
+@functools.lru_cache(maxsize=None)
+def get_pattern_modified_word(word):
+  # compiled once per word, re's own cache is too small for the vocabulary of tags
+  return re.compile(rf", ((\w+) )+{word}, ")
+
+
 def clean_tags(image_key, tags):
   # replace '_' to ' '
   tags = tags.replace('^_^', '^@@@^')
@@ -74,7 +80,7 @@ def clean_tags(image_key, tags):
   # white shirtとshirtみたいな重複タグの削除
   found = PATTERN_WORD.findall(tags)
   for word in found:
-    if re.search(f", ((\w+) )+{word}, ", tags):
+    if get_pattern_modified_word(word).search(tags):
       tags = tags.replace(f", {word}, ", "")
 
   tags = tags.replace(", , ", ", ")
@@ -126,44 +132,55 @@ def clean_caption(caption):
   return caption
 
 
-def main(args):
-  if os.path.exists(args.in_json):
-    logger.info(f"loading existing metadata: {args.in_json}")
-    with open(args.in_json, "rt", encoding='utf-8') as f:
-      metadata = json.load(f)
-  else:
-    logger.error("no metadata / メタデータファイルがありません")
-    return
-
-  logger.info("cleaning captions and tags.")
-  image_keys = list(metadata.keys())
-  for image_key in tqdm(image_keys):
-    tags = metadata[image_key].get('tags')
+def clean_entries(entries, debug=False):
+  # runs in the worker processes: [(image_key, metadata)] -> [(image_key, metadata, changed)]
+  results = []
+  for image_key, metadata in entries:
+    changed = False
+    tags = metadata.get('tags')
     if tags is None:
       logger.error(f"image does not have tags / メタデータにタグがありません: {image_key}")
     else:
       org = tags
       tags = clean_tags(image_key, tags)
-      metadata[image_key]['tags'] = tags
-      if args.debug and org != tags:
+      metadata['tags'] = tags
+      changed = changed or org != tags
+      if debug and org != tags:
         logger.info("FROM: " + org)
         logger.info("TO:   " + tags)
 
-    caption = metadata[image_key].get('caption')
+    caption = metadata.get('caption')
     if caption is None:
       logger.error(f"image does not have caption / メタデータにキャプションがありません: {image_key}")
     else:
       org = caption
       caption = clean_caption(caption)
-      metadata[image_key]['caption'] = caption
-      if args.debug and org != caption:
+      metadata['caption'] = caption
+      changed = changed or org != caption
+      if debug and org != caption:
         logger.info("FROM: " + org)
         logger.info("TO:   " + caption)
 
+    results.append((image_key, metadata, changed))
+  return results
+
+
+def main(args):
+  if os.path.exists(args.in_json):
+    logger.info(f"loading existing metadata: {args.in_json}")
+  else:
+    logger.error("no metadata / メタデータファイルがありません")
+    return
+
+  # the entries are streamed to the worker processes in chunks, and written in the original order
+  logger.info("cleaning captions and tags.")
+  entries = metadata_util.iter_metadata(args.in_json)
+  results = metadata_util.map_in_processes(functools.partial(clean_entries, debug=args.debug), entries, args.max_workers)
+
   # metadataを書き出して終わり
   logger.info(f"writing metadata: {args.out_json}")
-  with open(args.out_json, "wt", encoding='utf-8') as f:
-    json.dump(metadata, f, indent=2)
+  num_changed, num_entries = metadata_util.save_metadata_updates(args.in_json, args.out_json, tqdm(results))
+  logger.info(f"{num_changed} of {num_entries} entries are updated")
   logger.info("done!")
 
 
@@ -171,7 +188,9 @@ def setup_parser() -> argparse.ArgumentParser:
   parser = argparse.ArgumentParser()
   # parser.add_argument("train_data_dir", type=str, help="directory for train images / 学習画像データのディレクトリ")
   parser.add_argument("in_json", type=str, help="metadata file to input / 読み込むメタデータファイル")
-  parser.add_argument("out_json", type=str, help="metadata file to output / メタデータファイル書き出し先")
+  parser.add_argument("out_json", type=str, help="metadata file to output (.json or .jsonl) / メタデータファイル書き出し先（.jsonまたは.jsonl）")
+  parser.add_argument("--max_workers", type=int, default=None,
+                      help="number of worker processes (default: number of CPUs) / ワーカープロセス数（デフォルト：CPU数）")
   parser.add_argument("--debug", action="store_true", help="debug mode")
 
   return parser
@@ -1,10 +1,8 @@
 import argparse
-import json
 from pathlib import Path
 from typing import List
-from tqdm import tqdm
 import library.train_util as train_util
-import os
+from library import metadata_util
 from library.utils import setup_logging
 
 setup_logging()
@@ -27,38 +25,29 @@ def main(args):
 
     if args.in_json is not None:
         logger.info(f"loading existing metadata: {args.in_json}")
-        metadata = json.loads(Path(args.in_json).read_text(encoding="utf-8"))
         logger.warning("captions for existing images will be overwritten / 既存の画像のキャプションは上書きされます")
     else:
         logger.info("new metadata will be created / 新しいメタデータファイルが作成されます")
-        metadata = {}
-
-    logger.info("merge caption texts to metadata json.")
-    for image_path in tqdm(image_paths):
-        caption_path = image_path.with_suffix(args.caption_extension)
-        caption = caption_path.read_text(encoding="utf-8").strip()
-
-        if not os.path.exists(caption_path):
-            caption_path = os.path.join(image_path, args.caption_extension)
 
+    image_keys_to_files = {}
+    for image_path in image_paths:
         image_key = str(image_path) if args.full_path else image_path.stem
-        if image_key not in metadata:
-            metadata[image_key] = {}
+        image_keys_to_files[image_key] = str(image_path.with_suffix(args.caption_extension))
 
-        metadata[image_key]["caption"] = caption
-        if args.debug:
-            logger.info(f"{image_key} {caption}")
-
-    # metadataを書き出して終わり
+    # existing entries are streamed, and only the changed entries are appended if out_json is the same .jsonl as in_json
+    logger.info("merge caption texts to metadata json.")
     logger.info(f"writing metadata: {args.out_json}")
-    Path(args.out_json).write_text(json.dumps(metadata, indent=2), encoding="utf-8")
+    num_changed, num_entries = metadata_util.merge_text_files_to_metadata(
+        args.in_json, args.out_json, image_keys_to_files, "caption", args.debug
+    )
+    logger.info(f"{num_changed} of {num_entries} entries are updated")
     logger.info("done!")
 
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("train_data_dir", type=str, help="directory for train images / 学習画像データのディレクトリ")
-    parser.add_argument("out_json", type=str, help="metadata file to output / メタデータファイル書き出し先")
+    parser.add_argument("out_json", type=str, help="metadata file to output (.json or .jsonl) / メタデータファイル書き出し先（.jsonまたは.jsonl）")
     parser.add_argument(
         "--in_json",
         type=str,
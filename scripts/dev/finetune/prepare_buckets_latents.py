@@ -1,6 +1,5 @@
 import argparse
 import os
-import json
 
 from pathlib import Path
 from typing import List
@@ -18,6 +17,8 @@ from torchvision import transforms
 
 import library.model_util as model_util
 import library.train_util as train_util
+from library import metadata_util
+from library.image_size_cache import ImageSizeCache
 from library.utils import setup_logging
 
 setup_logging()
@@ -74,8 +75,7 @@ def main(args):
 
     if os.path.exists(args.in_json):
         logger.info(f"loading existing metadata: {args.in_json}")
-        with open(args.in_json, "rt", encoding="utf-8") as f:
-            metadata = json.load(f)
+        metadata = metadata_util.load_metadata(args.in_json)
     else:
         logger.error(f"no metadata / メタデータファイルがありません: {args.in_json}")
         return
@@ -106,6 +106,14 @@ def main(args):
             "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
         )
 
+    # 画像サイズから全画像のbucketをまとめて計算しておく。読み込んだ画像のサイズが異なる場合はその画像だけ計算し直す
+    # assign buckets to all images at once by the image sizes, images whose loaded size differs are assigned again
+    image_sizes = np.array(ImageSizeCache().get_sizes(image_paths), dtype=np.int64).reshape(-1, 2)
+    has_size = np.all(image_sizes > 0, axis=1)
+    image_sizes = image_sizes[has_size]
+    bucket_resos, resized_sizes, ar_errors = bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
+    path_to_bucket_index = {path: i for i, path in enumerate(np.array(image_paths, dtype=object)[has_size])}
+
     # 画像をひとつずつ適切なbucketに割り当てながらlatentを計算する
     img_ar_errors = []
 
@@ -152,7 +160,13 @@ def main(args):
 
         # 本当はこのあとの部分もDataSetに持っていけば高速化できるがいろいろ大変
 
-        reso, resized_size, ar_error = bucket_manager.select_bucket(image.width, image.height)
+        bucket_index = path_to_bucket_index.get(image_path)
+        if bucket_index is not None and tuple(image_sizes[bucket_index]) == (image.width, image.height):
+            reso = (int(bucket_resos[bucket_index][0]), int(bucket_resos[bucket_index][1]))
+            resized_size = (int(resized_sizes[bucket_index][0]), int(resized_sizes[bucket_index][1]))
+            ar_error = float(ar_errors[bucket_index])
+        else:
+            reso, resized_size, ar_error = bucket_manager.select_bucket(image.width, image.height)
         img_ar_errors.append(abs(ar_error))
         bucket_counts[reso] = bucket_counts.get(reso, 0) + 1
 
@@ -202,8 +216,7 @@ def main(args):
 
     # metadataを書き出して終わり
     logger.info(f"writing metadata: {args.out_json}")
-    with open(args.out_json, "wt", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+    metadata_util.write_metadata(args.out_json, metadata.items())
     logger.info("done!")
 
 
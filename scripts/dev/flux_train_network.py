@@ -17,6 +17,7 @@ from library import (
     flux_train_utils,
     flux_utils,
     sd3_train_utils,
+    step_profiler,
     strategy_base,
     strategy_flux,
     train_util,
@@ -161,7 +162,9 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
         return [tokenize_strategy.clip_l, tokenize_strategy.t5xxl]
 
     def get_latents_caching_strategy(self, args):
-        latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(args.cache_latents_to_disk, args.vae_batch_size, False)
+        latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(
+            args.cache_latents_to_disk, args.vae_batch_size, False, args.latents_cache_backend
+        )
         return latents_caching_strategy
 
     def get_text_encoding_strategy(self, args):
@@ -290,7 +293,15 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
         text_encoders = self.get_models_for_text_encoding(args, accelerator, text_encoders)
 
         flux_train_utils.sample_images(
-            accelerator, args, epoch, global_step, flux, ae, text_encoders, self.sample_prompts_te_outputs
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            flux,
+            ae,
+            text_encoders,
+            self.sample_prompts_te_outputs,
+            cache_prompt_embeddings=not self.is_train_text_encoder(args),
         )
         # return
 
@@ -396,16 +407,17 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
                 )
             return model_pred
 
-        model_pred = call_dit(
-            img=packed_noisy_model_input,
-            img_ids=img_ids,
-            t5_out=t5_out,
-            txt_ids=txt_ids,
-            l_pooled=l_pooled,
-            timesteps=timesteps,
-            guidance_vec=guidance_vec,
-            t5_attn_mask=t5_attn_mask,
-        )
+        with step_profiler.span("dit_forward"):
+            model_pred = call_dit(
+                img=packed_noisy_model_input,
+                img_ids=img_ids,
+                t5_out=t5_out,
+                txt_ids=txt_ids,
+                l_pooled=l_pooled,
+                timesteps=timesteps,
+                guidance_vec=guidance_vec,
+                t5_attn_mask=t5_attn_mask,
+            )
 
         # unpack latents
         model_pred = flux_utils.unpack_latents(model_pred, packed_latent_height, packed_latent_width)
@@ -426,7 +438,7 @@ class FluxNetworkTrainer(train_network.NetworkTrainer):
             if len(diff_output_pr_indices) > 0:
                 network.set_multiplier(0.0)
                 unet.prepare_block_swap_before_forward()
-                with torch.no_grad():
+                with torch.no_grad(), step_profiler.span("dit_forward_prior"):
                     model_pred_prior = call_dit(
                         img=packed_noisy_model_input[diff_output_pr_indices],
                         img_ids=img_ids[diff_output_pr_indices],
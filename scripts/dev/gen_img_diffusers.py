@@ -2486,6 +2486,11 @@ def main(args):
                 if network_pre_calc:
                     logger.info("backup original weights")
                     network.backup_weights()
+                elif args.network_fused_delta:
+                    if hasattr(network, "set_fused_delta"):
+                        network.set_fused_delta(True)
+                    else:
+                        logger.warning("network does not support fused delta / ネットワークがfused deltaに対応していません")
 
                 networks.append(network)
                 network_default_muls.append(network_mul)
@@ -3659,6 +3664,12 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="pre-calculate network for generation / ネットワークのあらかじめ計算して生成する",
     )
+    parser.add_argument(
+        "--network_fused_delta",
+        action="store_true",
+        help="cache the weights with the sum of all networks per module and compute them in one matmul, regional prompts fall back automatically"
+        " / モジュールごとに全ネットワークを合算した重みをキャッシュして1回の行列積で計算する（領域別プロンプトでは自動的に通常の計算）",
+    )
     parser.add_argument(
         "--network_regional_mask_max_color_codes",
         type=int,
@@ -0,0 +1,234 @@
+# sidecar manifest of disk caches (.npz) to validate caches without opening every npz file
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Set, Union
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_MANIFEST_FILE = "cache_manifest.json"
+CACHE_MANIFEST_VERSION = 1
+
+_rebuild_cache_manifest = False
+
+
+def set_rebuild_cache_manifest(rebuild: bool):
+    r"""if True, existing manifests are ignored and rebuilt from the npz files"""
+    global _rebuild_cache_manifest
+    _rebuild_cache_manifest = rebuild
+
+
+def _stat(path: Optional[str]):
+    if path is None:
+        return -1, -1
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return -1, -1
+
+
+class CacheManifest:
+    r"""
+    Records key sets, shapes, dtypes and scalar parameters of each npz in a directory, with mtime and size of the npz and
+    mtime of the source image. If the npz and the image are not changed, the record is used instead of loading the npz. If
+    the image is changed after the npz is written, the cache is outdated: is_source_changed tells the caller to re-create it.
+
+    The manifest is only a shortcut: a missing or stale record falls back to loading the npz, so it is safe that
+    multiple processes update the same manifest (the last writer wins, entries of others are merged on save).
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, CACHE_MANIFEST_FILE)
+        self.records: Dict[str, dict] = {} if _rebuild_cache_manifest else self._load_records()
+        self.checked: Dict[str, bool] = {}  # file name -> record is valid, set by validate
+        self.image_mtimes: Dict[str, int] = {}  # file name -> mtime of the source image, set by validate
+        self.source_changed: Set[str] = set()  # file names whose source image is changed since the npz is written
+        self.dirty = False
+
+    def _load_records(self) -> Dict[str, dict]:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_MANIFEST_VERSION:
+                return data["files"]
+        except Exception as e:
+            logger.warning(f"failed to load cache manifest, ignore it / キャッシュマニフェストを読み込めませんでした: {self.path}, error: {e}")
+        return {}
+
+    def validate(self, npz_paths: Sequence[str], image_paths: Optional[Sequence[Optional[str]]] = None) -> np.ndarray:
+        r"""
+        check that the npz files (and the source images) are not changed since recorded, at once.
+        returns bool array. the result is used by get_record and is_source_changed without stat.
+        """
+        names = [os.path.basename(p) for p in npz_paths]
+        if image_paths is None:
+            image_paths = [None] * len(npz_paths)
+
+        with ThreadPoolExecutor(max(1, min(32, os.cpu_count() or 1))) as executor:
+            npz_stats = list(executor.map(_stat, npz_paths))
+            image_mtimes = [s[0] for s in executor.map(_stat, image_paths)]
+
+        current = np.array([(m, s, i) for (m, s), i in zip(npz_stats, image_mtimes)], dtype=np.int64).reshape(-1, 3)
+        recorded = np.full_like(current, -2)
+        for i, name in enumerate(names):
+            record = self.records.get(name)
+            if record is not None:
+                image_mtime = record["image_mtime_ns"]
+                recorded[i] = (record["mtime_ns"], record["size"], -1 if image_mtime is None else image_mtime)
+
+        # image mtime is not checked if it is unknown in either side
+        image_unknown = (current[:, 2] < 0) | (recorded[:, 2] == -1)
+        npz_unchanged = (current[:, 0] >= 0) & (current[:, :2] == recorded[:, :2]).all(axis=1)
+        image_changed = ~image_unknown & (current[:, 2] != recorded[:, 2])
+        valid = npz_unchanged & ~image_changed
+        source_changed = npz_unchanged & image_changed
+
+        for name, is_valid, is_source_changed, image_mtime in zip(names, valid.tolist(), source_changed.tolist(), image_mtimes):
+            self.checked[name] = is_valid
+            if is_source_changed:
+                self.source_changed.add(name)
+            else:
+                self.source_changed.discard(name)
+            if image_mtime >= 0:
+                self.image_mtimes[name] = image_mtime
+                if is_valid and self.records[name]["image_mtime_ns"] is None:
+                    self.records[name]["image_mtime_ns"] = image_mtime
+                    self.dirty = True
+        return valid
+
+    def get_record(self, npz_path: str) -> Optional[dict]:
+        name = os.path.basename(npz_path)
+        record = self.records.get(name)
+        if record is None:
+            return None
+
+        is_valid = self.checked.get(name)
+        if is_valid is None:  # not validated yet
+            mtime, size = _stat(npz_path)
+            is_valid = mtime == record["mtime_ns"] and size == record["size"]
+            self.checked[name] = is_valid
+        return record if is_valid else None
+
+    def is_source_changed(self, npz_path: str) -> bool:
+        return os.path.basename(npz_path) in self.source_changed
+
+    def update(self, npz_path: str, arrays: Union[Dict[str, np.ndarray], np.lib.npyio.NpzFile]) -> dict:
+        r"""record the npz which is just written or loaded. arrays are the contents of the npz"""
+        name = os.path.basename(npz_path)
+        mtime, size = _stat(npz_path)
+
+        keys = {}
+        params = {}
+        for key in arrays.keys() if isinstance(arrays, dict) else arrays.files:
+            value = np.asarray(arrays[key])
+            keys[key] = [list(value.shape), value.dtype.str]
+            if value.size == 1 and value.dtype.kind in "biuf":
+                params[key] = value.item()  # e.g. apply_t5_attn_mask
+
+        record = {
+            "mtime_ns": mtime,
+            "size": size,
+            "image_mtime_ns": self.image_mtimes.get(name),
+            "keys": keys,
+            "params": params,
+        }
+        self.records[name] = record
+        self.checked[name] = True
+        self.source_changed.discard(name)
+        self.dirty = True
+        return record
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        # merge records written by other processes in the meantime
+        records = {} if _rebuild_cache_manifest else self._load_records()
+        records.update(self.records)
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": CACHE_MANIFEST_VERSION, "files": records}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.warning(f"failed to save cache manifest / キャッシュマニフェストを保存できませんでした: {self.path}, error: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_manifests: Dict[str, CacheManifest] = {}
+
+
+def get_cache_manifest(npz_path: str) -> CacheManifest:
+    cache_dir = os.path.dirname(os.path.abspath(npz_path))
+    manifest = _manifests.get(cache_dir)
+    if manifest is None:
+        manifest = CacheManifest(cache_dir)
+        _manifests[cache_dir] = manifest
+    return manifest
+
+
+def validate_cache_files(npz_paths: Sequence[str], image_paths: Optional[Sequence[str]] = None) -> np.ndarray:
+    r"""validate npz files per directory. see CacheManifest.validate"""
+    if image_paths is None:
+        image_paths = [None] * len(npz_paths)
+
+    by_dir: Dict[str, List[int]] = {}
+    for i, npz_path in enumerate(npz_paths):
+        by_dir.setdefault(os.path.dirname(os.path.abspath(npz_path)), []).append(i)
+
+    valid = np.zeros(len(npz_paths), dtype=bool)
+    for indices in by_dir.values():
+        manifest = get_cache_manifest(npz_paths[indices[0]])
+        valid[indices] = manifest.validate([npz_paths[i] for i in indices], [image_paths[i] for i in indices])
+    return valid
+
+
+def get_npz_record(npz_path: str) -> dict:
+    r"""
+    returns the record of npz: {"keys": {key: [shape, dtype]}, "params": {key: scalar value}, ...}.
+    the npz is loaded only if the manifest has no valid record for it. this does not check the source image, call
+    is_source_changed first if the cache depends on it.
+    """
+    manifest = get_cache_manifest(npz_path)
+    record = manifest.get_record(npz_path)
+    if record is None:
+        with np.load(npz_path) as npz:
+            record = manifest.update(npz_path, npz)
+    return record
+
+
+def is_source_changed(npz_path: str) -> bool:
+    r"""True if validate_cache_files found that the source image is changed since the npz is written, the npz is outdated"""
+    return get_cache_manifest(npz_path).is_source_changed(npz_path)
+
+
+def update_npz_record(npz_path: str, arrays: Dict[str, np.ndarray]):
+    r"""call after writing the npz with arrays"""
+    get_cache_manifest(npz_path).update(npz_path, arrays)
+
+
+def save_cache_manifests():
+    for manifest in _manifests.values():
+        manifest.save()
+
+
+atexit.register(save_cache_manifests)
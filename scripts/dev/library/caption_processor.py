@@ -0,0 +1,123 @@
+# parsed captions for BaseDataset.process_caption: wildcards and tag splitting are parsed once per caption and reused,
+# only the random parts (choice, shuffle, dropout) are done per sample, with the same calls to `random` as before
+
+import random
+import re
+from typing import Dict, List, Optional, Tuple, Union
+
+
+WILDCARD_PATTERN = re.compile(r"\{([^}]+)\}")
+
+# escape of "{{" and "}}" in wildcard captions
+WILDCARD_ESCAPE_OPEN = "⦅"
+WILDCARD_ESCAPE_CLOSE = "⦆"
+
+# segments of a wildcard caption: literal text, or alternatives to choose one from
+WildcardTemplate = List[Union[str, List[str]]]
+
+# fixed tokens, flex tokens (shuffled / dropped), fixed suffix tokens
+SplitTokens = Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]
+
+
+def process_wildcard_slow(caption: str) -> str:
+    r"""original implementation of the wildcard replacement, for captions which contain the escape characters"""
+    replacer1 = WILDCARD_ESCAPE_OPEN
+    replacer2 = WILDCARD_ESCAPE_CLOSE
+    while replacer1 in caption or replacer2 in caption:
+        replacer1 += WILDCARD_ESCAPE_OPEN
+        replacer2 += WILDCARD_ESCAPE_CLOSE
+
+    caption = caption.replace("{{", replacer1).replace("}}", replacer2)
+
+    def replace_wildcard(match):
+        return random.choice(match.group(1).split("|"))
+
+    caption = re.sub(WILDCARD_PATTERN, replace_wildcard, caption)
+    return caption.replace(replacer1, "{").replace(replacer2, "}")
+
+
+def parse_wildcard(caption: str) -> Optional[WildcardTemplate]:
+    r"""
+    parse wildcards like '{aaa|bbb|ccc}' (escaped by '{{' and '}}') into segments. returns None if the caption contains
+    the escape characters, then process_wildcard_slow must be used.
+    """
+    if WILDCARD_ESCAPE_OPEN in caption or WILDCARD_ESCAPE_CLOSE in caption:
+        return None
+
+    def unescape(text: str) -> str:
+        return text.replace(WILDCARD_ESCAPE_OPEN, "{").replace(WILDCARD_ESCAPE_CLOSE, "}")
+
+    escaped = caption.replace("{{", WILDCARD_ESCAPE_OPEN).replace("}}", WILDCARD_ESCAPE_CLOSE)
+    template: WildcardTemplate = []
+    last = 0
+    for match in WILDCARD_PATTERN.finditer(escaped):
+        if match.start() > last:
+            template.append(unescape(escaped[last : match.start()]))
+        template.append([unescape(alt) for alt in match.group(1).split("|")])
+        last = match.end()
+    if last < len(escaped):
+        template.append(unescape(escaped[last:]))
+    return template
+
+
+def split_caption_tokens(caption: str, caption_separator: str, keep_tokens: int, keep_tokens_separator: Optional[str]) -> SplitTokens:
+    r"""split a caption into fixed, flex and fixed suffix tokens by keep_tokens_separator or keep_tokens"""
+    fixed_tokens = []
+    flex_tokens = []
+    fixed_suffix_tokens = []
+    if keep_tokens_separator and keep_tokens_separator in caption:
+        fixed_part, flex_part = caption.split(keep_tokens_separator, 1)
+        if keep_tokens_separator in flex_part:
+            flex_part, fixed_suffix_part = flex_part.split(keep_tokens_separator, 1)
+            fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(caption_separator) if t.strip()]
+
+        fixed_tokens = [t.strip() for t in fixed_part.split(caption_separator) if t.strip()]
+        flex_tokens = [t.strip() for t in flex_part.split(caption_separator) if t.strip()]
+    else:
+        tokens = [t.strip() for t in caption.strip().split(caption_separator)]
+        flex_tokens = tokens[:]
+        if keep_tokens > 0:
+            fixed_tokens = flex_tokens[:keep_tokens]
+            flex_tokens = tokens[keep_tokens:]
+    return tuple(fixed_tokens), tuple(flex_tokens), tuple(fixed_suffix_tokens)
+
+
+class CaptionProcessor:
+    r"""
+    Caches of parsed captions. Captions of the images are parsed on first use and the results are reused for every sample,
+    in each process (dataloader workers have their own caches). Captions generated by wildcards are also cached up to
+    `max_entries`.
+    """
+
+    def __init__(self, max_entries: int = 2**18):
+        self.max_entries = max_entries
+        self.wildcard_templates: Dict[str, Optional[WildcardTemplate]] = {}
+        self.split_tokens: Dict[Tuple[str, str, int, Optional[str]], SplitTokens] = {}
+
+    def process_wildcard(self, caption: str) -> str:
+        template = self.wildcard_templates.get(caption)
+        if template is None and caption not in self.wildcard_templates:
+            template = parse_wildcard(caption)
+            if len(self.wildcard_templates) < self.max_entries:
+                self.wildcard_templates[caption] = template
+        if template is None:
+            return process_wildcard_slow(caption)
+
+        # random.choice is called for each wildcard from left to right, same as re.sub
+        return "".join([segment if type(segment) is str else random.choice(segment) for segment in template])
+
+    def split(self, caption: str, caption_separator: str, keep_tokens: int, keep_tokens_separator: Optional[str]) -> SplitTokens:
+        key = (caption, caption_separator, keep_tokens, keep_tokens_separator)
+        tokens = self.split_tokens.get(key)
+        if tokens is None:
+            tokens = split_caption_tokens(caption, caption_separator, keep_tokens, keep_tokens_separator)
+            if len(self.split_tokens) < self.max_entries:
+                self.split_tokens[key] = tokens
+        return tokens
+
+
+def dropout_tags(tokens: List[str], caption_tag_dropout_rate: float) -> List[str]:
+    if caption_tag_dropout_rate <= 0:
+        return tokens
+    # one random.random() for each token in order
+    return [token for token in tokens if random.random() >= caption_tag_dropout_rate]
@@ -0,0 +1,105 @@
+# background writer of checkpoints: the weights are copied to CPU on the training thread, then hashing, serialization,
+# removing old checkpoints and uploading are done on a worker thread
+
+import atexit
+import queue
+import threading
+from typing import Any, Callable, Dict, List
+
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state_dict(state_dict: Dict[str, Any]) -> Dict[str, Any]:
+    r"""copy tensors of the state dict to (pinned if possible) CPU memory, the copy is not changed by training"""
+    snapshot = {}
+    pinned = False
+    for key, value in state_dict.items():
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            pin_memory = value.device.type == "cuda"
+            buffer = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=pin_memory)
+            buffer.copy_(value, non_blocking=pin_memory)
+            pinned = pinned or pin_memory
+            snapshot[key] = buffer
+        else:
+            snapshot[key] = value
+    if pinned:
+        torch.cuda.synchronize()
+    return snapshot
+
+
+class NetworkSnapshot:
+    r"""
+    Weights of a network at a point of training. `save_weights` of the network class is called with the snapshot as self,
+    so the saved file is the same as `network.save_weights`. Other attributes are read from the network.
+    """
+
+    def __init__(self, network: torch.nn.Module):
+        self._network = network
+        self._state_dict = snapshot_state_dict(network.state_dict())
+
+    def state_dict(self, *args, **kwargs) -> Dict[str, Any]:
+        return self._state_dict
+
+    def save_weights(self, file: str, dtype, metadata):
+        type(self._network).save_weights(self, file, dtype, metadata)
+
+    def __getattr__(self, name: str):
+        return getattr(self._network, name)
+
+
+class AsyncCheckpointWriter:
+    r"""
+    Run jobs (saving, removing and uploading checkpoints) on a worker thread in the order of submission. The queue is
+    bounded, so `submit` blocks while `max_queue_size` jobs are waiting. Errors are logged and raised on `close`, which
+    waits for all jobs and is also called at exit.
+    """
+
+    def __init__(self, max_queue_size: int = 2):
+        self.queue = queue.Queue(maxsize=max(1, max_queue_size))
+        self.errors: List[Exception] = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception(f"failed to write checkpoint / チェックポイントの書き込みに失敗しました: {e}")
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        assert not self.closed, "checkpoint writer is closed / チェックポイントの書き込みは終了しています"
+        self.queue.put((fn, args, kwargs))
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue.unfinished_tasks > 0:
+            logger.info("waiting for checkpoints to be written / チェックポイントの書き込みを待機しています")
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            raise RuntimeError(
+                f"failed to write {len(self.errors)} checkpoint(s) / {len(self.errors)}個のチェックポイントの書き込みに失敗しました"
+            ) from self.errors[0]
@@ -106,6 +106,7 @@ class BaseDatasetParams:
     debug_dataset: bool = False
     validation_seed: Optional[int] = None
     validation_split: float = 0.0
+    image_size_cache: bool = False
 
 
 @dataclass
@@ -241,6 +242,7 @@ class ConfigSanitizer:
         "validation_split": float,
         "resolution": functools.partial(__validate_and_convert_scalar_or_twodim.__func__, int),
         "network_multiplier": float,
+        "image_size_cache": bool,
     }
 
     # options handled by argparse but not handled by user config
@@ -526,6 +528,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
                   batch_size: {dataset.batch_size}
                   resolution: {(dataset.width, dataset.height)}
                   enable_bucket: {dataset.enable_bucket}
+                  image_size_cache: {dataset.image_size_cache.persistent}
             """)
 
             if dataset.enable_bucket:
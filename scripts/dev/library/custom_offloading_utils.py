@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 
 from library.device_utils import clean_memory_on_device
+from library import step_profiler
 
 
 def synchronize_device(device: torch.device):
@@ -140,7 +141,8 @@ class Offloader:
             start_time = time.perf_counter()
 
         future = self.futures.pop(block_idx)
-        _, bidx_to_cuda = future.result()
+        with step_profiler.span("block_swap_wait"):
+            _, bidx_to_cuda = future.result()
 
         assert block_idx == bidx_to_cuda, f"Block index mismatch: {block_idx} != {bidx_to_cuda}"
 
@@ -14,7 +14,7 @@ from tqdm import tqdm
 from PIL import Image
 from safetensors.torch import save_file
 
-from library import flux_models, flux_utils, strategy_base, train_util
+from library import flux_models, flux_utils, sample_engine, strategy_base, train_util
 from library.device_utils import init_ipex, clean_memory_on_device
 
 init_ipex()
@@ -40,7 +40,8 @@ def sample_images(
     text_encoders,
     sample_prompts_te_outputs,
     prompt_replacement=None,
-    controlnet=None
+    controlnet=None,
+    cache_prompt_embeddings: bool = False,
 ):
     if steps == 0:
         if not args.sample_at_first:
@@ -77,6 +78,10 @@ def sample_images(
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
+    # the text encoder outputs are reused in this sampling event, and in the next events if the text encoders are not trained
+    prompt_encoding_cache = sample_engine.get_prompt_encoding_cache()
+    prompt_encoding_cache.begin(text_encoders or [], persistent=cache_prompt_embeddings)
+
     # save random state to restore later
     rng_state = torch.get_rng_state()
     cuda_rng_state = None
@@ -85,48 +90,40 @@ def sample_images(
     except Exception:
         pass
 
-    if distributed_state.num_processes <= 1:
-        # If only one device is available, just use the original prompt list. We don't need to care about the distribution of prompts.
-        with torch.no_grad(), accelerator.autocast():
-            for prompt_dict in prompts:
-                sample_image_inference(
-                    accelerator,
-                    args,
-                    flux,
-                    text_encoders,
-                    ae,
-                    save_dir,
-                    prompt_dict,
-                    epoch,
-                    steps,
-                    sample_prompts_te_outputs,
-                    prompt_replacement,
-                    controlnet
-                )
-    else:
-        # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
-        # prompt_dicts are assigned to lists based on order of processes, to attempt to time the image creation time to match enum order. Probably only works when steps and sampler are identical.
-        per_process_prompts = []  # list of lists
-        for i in range(distributed_state.num_processes):
-            per_process_prompts.append(prompts[i :: distributed_state.num_processes])
-
-        with torch.no_grad():
-            with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
-                for prompt_dict in prompt_dict_lists[0]:
-                    sample_image_inference(
-                        accelerator,
-                        args,
-                        flux,
-                        text_encoders,
-                        ae,
-                        save_dir,
-                        prompt_dict,
-                        epoch,
-                        steps,
-                        sample_prompts_te_outputs,
-                        prompt_replacement,
-                        controlnet
-                    )
+    def get_batch_key(prompt_dict):
+        if prompt_dict.get("controlnet_image") is not None:
+            return ("controlnet", prompt_dict["enum"])  # the image is per prompt, not batched
+        width = prompt_dict.get("width", 512)
+        height = prompt_dict.get("height", 512)
+        return (
+            max(64, width - width % 16),
+            max(64, height - height % 16),
+            prompt_dict.get("sample_steps", 20),
+            prompt_dict.get("scale", 3.5),
+        )
+
+    # prompts with the same settings are generated in a batch. batches are assigned to the processes in order, to attempt to
+    # time the image creation time to match enum order
+    batches = sample_engine.make_sample_batches(prompts, args.sample_batch_size, get_batch_key)
+    with torch.no_grad(), accelerator.autocast(), sample_engine.split_sample_batches(
+        distributed_state, batches
+    ) as process_batches:
+        for prompt_dicts in process_batches:
+            sample_image_inference_batch(
+                accelerator,
+                args,
+                flux,
+                text_encoders,
+                ae,
+                save_dir,
+                prompt_dicts,
+                epoch,
+                steps,
+                sample_prompts_te_outputs,
+                prompt_replacement,
+                controlnet,
+            )
+    prompt_encoding_cache.log_stats()
 
     torch.set_rng_state(rng_state)
     if cuda_rng_state is not None:
@@ -150,50 +147,30 @@ def sample_image_inference(
     controlnet
 ):
     assert isinstance(prompt_dict, dict)
-    # negative_prompt = prompt_dict.get("negative_prompt")
-    sample_steps = prompt_dict.get("sample_steps", 20)
-    width = prompt_dict.get("width", 512)
-    height = prompt_dict.get("height", 512)
-    scale = prompt_dict.get("scale", 3.5)
-    seed = prompt_dict.get("seed")
-    controlnet_image = prompt_dict.get("controlnet_image")
-    prompt: str = prompt_dict.get("prompt", "")
-    # sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
-
-    if prompt_replacement is not None:
-        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-        # if negative_prompt is not None:
-        #     negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
-
-    if seed is not None:
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
-    else:
-        # True random sample image generation
-        torch.seed()
-        torch.cuda.seed()
+    sample_image_inference_batch(
+        accelerator,
+        args,
+        flux,
+        text_encoders,
+        ae,
+        save_dir,
+        [prompt_dict],
+        epoch,
+        steps,
+        sample_prompts_te_outputs,
+        prompt_replacement,
+        controlnet,
+    )
 
-    # if negative_prompt is None:
-    #     negative_prompt = ""
-    height = max(64, height - height % 16)  # round to divisible by 16
-    width = max(64, width - width % 16)  # round to divisible by 16
-    logger.info(f"prompt: {prompt}")
-    # logger.info(f"negative_prompt: {negative_prompt}")
-    logger.info(f"height: {height}")
-    logger.info(f"width: {width}")
-    logger.info(f"sample_steps: {sample_steps}")
-    logger.info(f"scale: {scale}")
-    # logger.info(f"sample_sampler: {sampler_name}")
-    if seed is not None:
-        logger.info(f"seed: {seed}")
 
-    # encode prompts
+def encode_sample_prompt(text_encoders: Optional[List[CLIPTextModel]], prompt: str, sample_prompts_te_outputs) -> List:
+    r"""text encoder outputs of the sample prompt: the cached outputs are updated with the outputs of the given text encoders"""
     tokenize_strategy = strategy_base.TokenizeStrategy.get_strategy()
     encoding_strategy = strategy_base.TextEncodingStrategy.get_strategy()
 
     text_encoder_conds = []
     if sample_prompts_te_outputs and prompt in sample_prompts_te_outputs:
-        text_encoder_conds = sample_prompts_te_outputs[prompt]
+        text_encoder_conds = list(sample_prompts_te_outputs[prompt])
         print(f"Using cached text encoder outputs for prompt: {prompt}")
     if text_encoders is not None:
         print(f"Encoding prompt: {prompt}")
@@ -209,23 +186,101 @@ def sample_image_inference(
             for i in range(len(encoded_text_encoder_conds)):
                 if encoded_text_encoder_conds[i] is not None:
                     text_encoder_conds[i] = encoded_text_encoder_conds[i]
+    return text_encoder_conds
+
+
+def sample_image_inference_batch(
+    accelerator: Accelerator,
+    args: argparse.Namespace,
+    flux: flux_models.Flux,
+    text_encoders: Optional[List[CLIPTextModel]],
+    ae: flux_models.AutoEncoder,
+    save_dir,
+    prompt_dicts: List[Dict],
+    epoch,
+    steps,
+    sample_prompts_te_outputs,
+    prompt_replacement,
+    controlnet,
+):
+    r"""
+    generate the images of the prompts in a batch. the prompts must have the same size, steps and scale (the first prompt's
+    are used), and at most one prompt can have controlnet_image. the noise of each image is generated from its seed, so a
+    batch of one prompt is same as before.
+    """
+    prompt_dict = prompt_dicts[0]
+    # negative_prompt = prompt_dict.get("negative_prompt")
+    sample_steps = prompt_dict.get("sample_steps", 20)
+    width = prompt_dict.get("width", 512)
+    height = prompt_dict.get("height", 512)
+    scale = prompt_dict.get("scale", 3.5)
+    controlnet_image = prompt_dict.get("controlnet_image")
+    # sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
 
-    l_pooled, t5_out, txt_ids, t5_attn_mask = text_encoder_conds
+    # if negative_prompt is None:
+    #     negative_prompt = ""
+    height = max(64, height - height % 16)  # round to divisible by 16
+    width = max(64, width - width % 16)  # round to divisible by 16
 
     # sample image
     weight_dtype = ae.dtype  # TOFO give dtype as argument
     packed_latent_height = height // 16
     packed_latent_width = width // 16
-    noise = torch.randn(
-        1,
-        packed_latent_height * packed_latent_width,
-        16 * 2 * 2,
-        device=accelerator.device,
-        dtype=weight_dtype,
-        generator=torch.Generator(device=accelerator.device).manual_seed(seed) if seed is not None else None,
-    )
+
+    prompts: List[str] = []
+    seeds: List[Optional[int]] = []
+    conds_list = []
+    noises = []
+    prompt_encoding_cache = sample_engine.get_prompt_encoding_cache()
+    for prompt_dict in prompt_dicts:
+        seed = prompt_dict.get("seed")
+        prompt: str = prompt_dict.get("prompt", "")
+        if prompt_replacement is not None:
+            prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+            # if negative_prompt is not None:
+            #     negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+
+        sample_engine.set_sample_seed(seed)
+
+        logger.info(f"prompt: {prompt}")
+        # logger.info(f"negative_prompt: {negative_prompt}")
+        if seed is not None:
+            logger.info(f"seed: {seed}")
+
+        # encode prompts
+        conds_list.append(
+            prompt_encoding_cache.get(prompt, lambda: encode_sample_prompt(text_encoders, prompt, sample_prompts_te_outputs))
+        )
+
+        noise = torch.randn(
+            1,
+            packed_latent_height * packed_latent_width,
+            16 * 2 * 2,
+            device=accelerator.device,
+            dtype=weight_dtype,
+            generator=torch.Generator(device=accelerator.device).manual_seed(seed) if seed is not None else None,
+        )
+        prompts.append(prompt)
+        seeds.append(seed)
+        noises.append(noise)
+
+    logger.info(f"height: {height}")
+    logger.info(f"width: {width}")
+    logger.info(f"sample_steps: {sample_steps}")
+    logger.info(f"scale: {scale}")
+    # logger.info(f"sample_sampler: {sampler_name}")
+    if len(prompts) > 1:
+        logger.info(f"batch size: {len(prompts)}")
+
+    # concatenate the outputs of the prompts along the batch dimension
+    l_pooled, t5_out, txt_ids, t5_attn_mask = [
+        None if conds[0] is None else torch.cat([c.to(accelerator.device) for c in conds], dim=0) for conds in zip(*conds_list)
+    ]
+
+    noise = torch.cat(noises, dim=0)
+    batch_size = noise.shape[0]
     timesteps = get_schedule(sample_steps, noise.shape[1], shift=True)  # FLUX.1 dev -> shift=True
-    img_ids = flux_utils.prepare_img_ids(1, packed_latent_height, packed_latent_width).to(accelerator.device, weight_dtype)
+    img_ids = flux_utils.prepare_img_ids(batch_size, packed_latent_height, packed_latent_width).to(accelerator.device, weight_dtype)
     t5_attn_mask = t5_attn_mask.to(accelerator.device) if args.apply_t5_attn_mask else None
 
     if controlnet_image is not None:
@@ -250,26 +305,28 @@ def sample_image_inference(
 
     x = x.clamp(-1, 1)
     x = x.permute(0, 2, 3, 1)
-    image = Image.fromarray((127.5 * (x + 1.0)).float().cpu().numpy().astype(np.uint8)[0])
+    images = (127.5 * (x + 1.0)).float().cpu().numpy().astype(np.uint8)
 
     # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
     # but adding 'enum' to the filename should be enough
 
-    ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-    num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-    seed_suffix = "" if seed is None else f"_{seed}"
-    i: int = prompt_dict["enum"]
-    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
+    for prompt_dict, prompt, seed, image in zip(prompt_dicts, prompts, seeds, images):
+        image = Image.fromarray(image)
+        ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+        seed_suffix = "" if seed is None else f"_{seed}"
+        i: int = prompt_dict["enum"]
+        img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
+        image.save(os.path.join(save_dir, img_filename))
 
-    # send images to wandb if enabled
-    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
-        wandb_tracker = accelerator.get_tracker("wandb")
+        # send images to wandb if enabled
+        if "wandb" in [tracker.name for tracker in accelerator.trackers]:
+            wandb_tracker = accelerator.get_tracker("wandb")
 
-        import wandb
+            import wandb
 
-        # not to commit images to avoid inconsistency between training and logging steps
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+            # not to commit images to avoid inconsistency between training and logging steps
+            wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
 
 
 def time_shift(mu: float, sigma: float, t: torch.Tensor):
@@ -0,0 +1,352 @@
+# columnar storage of the images of a dataset: numbers are kept in numpy arrays, strings (paths, captions) are interned in
+# one table, and optional objects (latents, images, text encoder outputs) are kept in sparse dicts. ImageInfo is a view of a
+# row, so a dataset with millions of images has few Python objects and is pickled to the dataloader workers quickly.
+
+from collections.abc import ItemsView, Mapping, ValuesView
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+class StringTable:
+    r"""
+    Interned strings. Each distinct string is stored once as UTF-8 in a byte buffer and referred by its index. The reverse
+    lookup (string -> index) is only for adding strings, and is rebuilt on demand after `compact` or unpickling.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = np.zeros(1025, dtype=np.int64)  # string i is data[offsets[i] : offsets[i + 1]]
+        self.count = 0
+        self.indices: Optional[Dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> str:
+        return self.data[self.offsets[index] : self.offsets[index + 1]].decode("utf-8", "surrogatepass")
+
+    def __getstate__(self):
+        return {"data": bytes(self.data), "offsets": self.offsets[: self.count + 1].copy(), "count": self.count}
+
+    def __setstate__(self, state):
+        self.data = bytearray(state["data"])
+        self.offsets = state["offsets"]
+        self.count = state["count"]
+        self.indices = None
+
+    def add(self, string: str) -> int:
+        if self.indices is None:
+            self.indices = {self[i]: i for i in range(self.count)}
+        index = self.indices.get(string)
+        if index is not None:
+            return index
+
+        index = self.count
+        if index + 1 >= len(self.offsets):
+            self.offsets = np.concatenate([self.offsets, np.zeros(len(self.offsets), dtype=np.int64)])
+        self.data += string.encode("utf-8", "surrogatepass")
+        self.offsets[index + 1] = len(self.data)
+        self.count += 1
+        self.indices[string] = index
+        return index
+
+    def compact(self):
+        self.indices = None
+
+
+# fields of ImageInfo by the kind of the storage
+STRING_FIELDS = (
+    "image_key",
+    "absolute_path",
+    "caption",
+    "latents_npz",  # set in cache_latents
+    "latents_npz_flipped",  # fine tuning with npz files
+    "cond_img_path",
+    "text_encoder_outputs_npz",  # set in cache_text_encoder_outputs
+)
+SIZE_FIELDS = ("image_size", "resized_size", "bucket_reso")  # (width, height)
+NUMBER_FIELDS = ("num_repeats", "is_reg")
+OBJECT_FIELDS = (
+    "latents",
+    "latents_flipped",
+    "latents_original_size",  # original image size, not latents size
+    "latents_crop_ltrb",  # crop left top right bottom in original pixel size, not latents size
+    "image",  # optional, original PIL Image
+    "text_encoder_outputs",  # new
+    "text_encoder_outputs1",  # old
+    "text_encoder_outputs2",
+    "text_encoder_pool2",
+    "alpha_mask",  # alpha mask can be flipped in runtime
+)
+FIELDS = STRING_FIELDS + SIZE_FIELDS + NUMBER_FIELDS + OBJECT_FIELDS
+
+_STRING, _SIZE, _NUMBER, _OBJECT = range(4)
+_FIELD_KINDS = {
+    **{name: _STRING for name in STRING_FIELDS},
+    **{name: _SIZE for name in SIZE_FIELDS},
+    **{name: _NUMBER for name in NUMBER_FIELDS},
+    **{name: _OBJECT for name in OBJECT_FIELDS},
+}
+
+
+class ImageInfo:
+    r"""
+    Information of an image. A new ImageInfo keeps the values by itself (e.g. in the preprocessing scripts). After it is added
+    to an ImageRegistry, it becomes a view of the row: the attributes are read from and written to the columns.
+    """
+
+    __slots__ = ("_registry", "_index", "_values")
+
+    def __init__(self, image_key: str, num_repeats: int, caption: str, is_reg: bool, absolute_path: str) -> None:
+        self._registry: Optional[ImageRegistry] = None
+        self._index: int = -1
+        self._values: Optional[Dict[str, Any]] = dict.fromkeys(FIELDS)
+        self._values.update(
+            image_key=image_key, num_repeats=num_repeats, caption=caption, is_reg=is_reg, absolute_path=absolute_path
+        )
+
+    @classmethod
+    def view(cls, registry: "ImageRegistry", index: int) -> "ImageInfo":
+        info = cls.__new__(cls)
+        info._registry = registry
+        info._index = index
+        info._values = None
+        return info
+
+    def __repr__(self) -> str:
+        return f"ImageInfo({self.image_key!r})"
+
+
+def _field_property(name: str) -> property:
+    def fget(self: ImageInfo):
+        if self._registry is None:
+            return self._values[name]
+        return self._registry.get(name, self._index)
+
+    def fset(self: ImageInfo, value):
+        if self._registry is None:
+            self._values[name] = value
+        else:
+            self._registry.set(name, self._index, value)
+
+    return property(fget, fset)
+
+
+for _name in FIELDS:
+    setattr(ImageInfo, _name, _field_property(_name))
+
+
+class ImageRegistry:
+    r"""
+    Images of a dataset in columns, in the order of registration:
+
+    - strings: int32 indices to the StringTable, -1 for None
+    - sizes: int32 (N, 2) arrays of (width, height), -1 for None
+    - num_repeats: int32, is_reg: bool, subset ids: int32 (index of `subsets`)
+    - objects: dicts of row index -> object, only for the rows which have the value
+
+    `image_data` and `image_to_subset` are read-only mappings keyed by image_key for the code which uses the keys.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.capacity = capacity
+        self.strings = StringTable()
+        self.string_columns = {name: np.full(capacity, -1, dtype=np.int32) for name in STRING_FIELDS}
+        self.size_columns = {name: np.full((capacity, 2), -1, dtype=np.int32) for name in SIZE_FIELDS}
+        self.num_repeats = np.zeros(capacity, dtype=np.int32)
+        self.is_reg = np.zeros(capacity, dtype=bool)
+        self.subset_ids = np.zeros(capacity, dtype=np.int32)
+        self.objects: Dict[str, Dict[int, Any]] = {name: {} for name in OBJECT_FIELDS}
+
+        self.subsets: List[Any] = []
+        self.key_to_index: Optional[Dict[str, int]] = {}
+
+        self.image_data = ImageDataMapping(self)
+        self.image_to_subset = ImageToSubsetMapping(self)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getstate__(self):
+        # trim the columns and drop the lookup tables, they are rebuilt on demand
+        state = self.__dict__.copy()
+        state["capacity"] = self.size
+        state["string_columns"] = {name: column[: self.size].copy() for name, column in self.string_columns.items()}
+        state["size_columns"] = {name: column[: self.size].copy() for name, column in self.size_columns.items()}
+        state["num_repeats"] = self.num_repeats[: self.size].copy()
+        state["is_reg"] = self.is_reg[: self.size].copy()
+        state["subset_ids"] = self.subset_ids[: self.size].copy()
+        state["key_to_index"] = None
+        return state
+
+    def _grow(self):
+        def resize(column: np.ndarray, fill_value) -> np.ndarray:
+            new_column = np.full((capacity,) + column.shape[1:], fill_value, dtype=column.dtype)
+            new_column[: self.size] = column[: self.size]
+            return new_column
+
+        capacity = max(1024, self.capacity * 2)
+        self.string_columns = {name: resize(column, -1) for name, column in self.string_columns.items()}
+        self.size_columns = {name: resize(column, -1) for name, column in self.size_columns.items()}
+        self.num_repeats = resize(self.num_repeats, 0)
+        self.is_reg = resize(self.is_reg, False)
+        self.subset_ids = resize(self.subset_ids, 0)
+        self.capacity = capacity
+
+    def _get_key_to_index(self) -> Dict[str, int]:
+        if self.key_to_index is None:
+            keys = self.string_columns["image_key"]
+            self.key_to_index = {self.strings[keys[i]]: i for i in range(self.size)}
+        return self.key_to_index
+
+    def add(self, info: ImageInfo, subset: Any) -> int:
+        r"""
+        copy the values of the info to a row, and make the info a view of the row. an image with the same key replaces the
+        existing row, same as assigning to a dict.
+        """
+        key_to_index = self._get_key_to_index()
+        index = key_to_index.get(info.image_key)
+        if index is None:
+            if self.size >= self.capacity:
+                self._grow()
+            index = self.size
+            self.size += 1
+            key_to_index[info.image_key] = index
+
+        values = {name: getattr(info, name) for name in FIELDS}
+        for name, value in values.items():
+            self.set(name, index, value)
+
+        for subset_id, s in enumerate(self.subsets):
+            if s is subset:
+                break
+        else:
+            subset_id = len(self.subsets)
+            self.subsets.append(subset)
+        self.subset_ids[index] = subset_id
+
+        info._registry = self
+        info._index = index
+        info._values = None
+        return index
+
+    def get(self, name: str, index: int) -> Any:
+        kind = _FIELD_KINDS[name]
+        if kind == _STRING:
+            string_index = self.string_columns[name][index]
+            return None if string_index < 0 else self.strings[string_index]
+        if kind == _SIZE:
+            width, height = self.size_columns[name][index]
+            return None if width < 0 else (int(width), int(height))
+        if kind == _NUMBER:
+            return int(self.num_repeats[index]) if name == "num_repeats" else bool(self.is_reg[index])
+        return self.objects[name].get(index)
+
+    def set(self, name: str, index: int, value: Any):
+        kind = _FIELD_KINDS[name]
+        if kind == _STRING:
+            self.string_columns[name][index] = -1 if value is None else self.strings.add(value)
+        elif kind == _SIZE:
+            self.size_columns[name][index] = (-1, -1) if value is None else (int(value[0]), int(value[1]))
+        elif kind == _NUMBER:
+            if name == "num_repeats":
+                self.num_repeats[index] = value
+            else:
+                self.is_reg[index] = value
+        elif value is None:
+            self.objects[name].pop(index, None)
+        else:
+            self.objects[name][index] = value
+
+    def view(self, index: int) -> ImageInfo:
+        return ImageInfo.view(self, int(index))
+
+    def get_image_key(self, index: int) -> str:
+        return self.strings[self.string_columns["image_key"][index]]
+
+    def get_subset(self, index: int) -> Any:
+        return self.subsets[self.subset_ids[index]]
+
+    def index_of(self, image_key: str) -> int:
+        return self._get_key_to_index()[image_key]
+
+    def get_column(self, name: str) -> np.ndarray:
+        r"""array of the numbers or sizes of all rows, (N,) or (N, 2), do not modify"""
+        if name == "num_repeats":
+            return self.num_repeats[: self.size]
+        if name == "is_reg":
+            return self.is_reg[: self.size]
+        return self.size_columns[name][: self.size]
+
+    def set_column(self, name: str, values: np.ndarray):
+        r"""set the numbers or sizes of all rows at once"""
+        self.get_column(name)[:] = values
+
+    def compact(self):
+        r"""release the lookup tables for adding images, called after the dataset is built"""
+        self.strings.compact()
+        self.key_to_index = None
+
+
+class ImageDataMapping(Mapping):
+    r"""image_key -> ImageInfo (view)"""
+
+    def __init__(self, registry: ImageRegistry):
+        self.registry = registry
+
+    def __getitem__(self, image_key: str) -> ImageInfo:
+        return self.registry.view(self.registry.index_of(image_key))
+
+    def __contains__(self, image_key) -> bool:
+        return image_key in self.registry._get_key_to_index()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self.registry)):
+            yield self.registry.get_image_key(i)
+
+    def __len__(self) -> int:
+        return len(self.registry)
+
+    def values(self) -> ValuesView:
+        return _ImageDataValuesView(self)
+
+    def items(self) -> ItemsView:
+        return _ImageDataItemsView(self)
+
+
+class _ImageDataValuesView(ValuesView):
+    r"""same as the view of Mapping, iterates the rows in order without looking up the keys"""
+
+    def __iter__(self) -> Iterator[ImageInfo]:
+        registry = self._mapping.registry
+        for i in range(len(registry)):
+            yield registry.view(i)
+
+
+class _ImageDataItemsView(ItemsView):
+    def __iter__(self) -> Iterator[Tuple[str, ImageInfo]]:
+        registry = self._mapping.registry
+        for i in range(len(registry)):
+            yield registry.get_image_key(i), registry.view(i)
+
+
+class ImageToSubsetMapping(Mapping):
+    r"""image_key -> subset"""
+
+    def __init__(self, registry: ImageRegistry):
+        self.registry = registry
+
+    def __getitem__(self, image_key: str) -> Any:
+        return self.registry.get_subset(self.registry.index_of(image_key))
+
+    def __contains__(self, image_key) -> bool:
+        return image_key in self.registry._get_key_to_index()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self.registry)):
+            yield self.registry.get_image_key(i)
+
+    def __len__(self) -> int:
+        return len(self.registry)
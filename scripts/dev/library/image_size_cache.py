@@ -0,0 +1,156 @@
+# parallel image size scanner with a persistent per-directory size index
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import imagesize
+from PIL import Image
+from tqdm import tqdm
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+IMAGE_SIZE_CACHE_FILE = "image_size_cache.json"
+IMAGE_SIZE_CACHE_VERSION = 1
+
+
+def get_image_size(image_path: str) -> Tuple[int, int]:
+    image_size = imagesize.get(image_path)
+    if image_size[0] <= 0:
+        # imagesize doesn't work for some images, so use PIL as a fallback
+        try:
+            with Image.open(image_path) as img:
+                image_size = img.size
+        except Exception as e:
+            logger.warning(f"failed to get image size: {image_path}, error: {e}")
+            image_size = (0, 0)
+    return image_size
+
+
+def default_max_workers() -> int:
+    # reading image headers is I/O bound, but too many threads hurt on network storage
+    return max(1, min(32, os.cpu_count() or 1))
+
+
+class ImageSizeCache:
+    r"""
+    Get image sizes in parallel. If persistent is True, sizes are stored to `image_size_cache.json` in each image directory,
+    keyed by file name, mtime and file size. Only `os.stat` is needed for images which are not changed since the last scan.
+
+    The cache file is written atomically, so it is safe for multiple processes (e.g. multi-GPU ranks) to share it.
+    """
+
+    def __init__(self, persistent: bool = False, max_workers: Optional[int] = None):
+        self.persistent = persistent
+        self.max_workers = max_workers or default_max_workers()
+
+        # dir -> {file name: [mtime_ns, file size, width, height]}
+        self._entries: Dict[str, Dict[str, List[int]]] = {}
+        self._dirty_dirs = set()
+
+    @staticmethod
+    def get_cache_path(image_dir: str) -> str:
+        return os.path.join(image_dir, IMAGE_SIZE_CACHE_FILE)
+
+    def _load_dir(self, image_dir: str) -> Dict[str, List[int]]:
+        entries = self._entries.get(image_dir)
+        if entries is not None:
+            return entries
+
+        entries = {}
+        cache_path = self.get_cache_path(image_dir)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == IMAGE_SIZE_CACHE_VERSION:
+                    entries = data["images"]
+                else:
+                    logger.info(f"image size cache version mismatch, rebuild it / 画像サイズのキャッシュを再作成します: {cache_path}")
+            except Exception as e:
+                logger.warning(f"failed to load image size cache / 画像サイズのキャッシュを読み込めませんでした: {cache_path}, error: {e}")
+
+        self._entries[image_dir] = entries
+        return entries
+
+    def _save_dir(self, image_dir: str):
+        cache_path = self.get_cache_path(image_dir)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": IMAGE_SIZE_CACHE_VERSION, "images": self._entries[image_dir]}, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)  # atomic
+        except OSError as e:
+            # read-only dataset directory etc. the sizes are still used in this run
+            logger.warning(f"failed to save image size cache / 画像サイズのキャッシュを保存できませんでした: {cache_path}, error: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _get_size(self, image_path: str) -> Tuple[int, int]:
+        if not self.persistent:
+            return get_image_size(image_path)
+
+        image_dir, file_name = os.path.split(os.path.abspath(image_path))
+        entries = self._entries[image_dir]  # loaded before submitting
+
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return get_image_size(image_path)  # log the error in get_image_size
+
+        entry = entries.get(file_name)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2], entry[3]
+
+        width, height = get_image_size(image_path)
+        if width > 0 and height > 0:
+            # dict assignment is atomic under GIL
+            entries[file_name] = [st.st_mtime_ns, st.st_size, width, height]
+            self._dirty_dirs.add(image_dir)
+        return width, height
+
+    def get_sizes(self, image_paths: Sequence[str], desc: str = "get image size") -> List[Tuple[int, int]]:
+        if len(image_paths) == 0:
+            return []
+
+        if self.persistent:
+            for image_dir in set(os.path.dirname(os.path.abspath(p)) for p in image_paths):
+                self._load_dir(image_dir)
+
+        sizes: List[Tuple[int, int]] = []
+        max_workers = min(self.max_workers, len(image_paths))
+        chunk_size = max_workers * 16  # bound the number of in-flight futures
+        with tqdm(total=len(image_paths), desc=desc) as pbar, ThreadPoolExecutor(max_workers) as executor:
+            for i in range(0, len(image_paths), chunk_size):
+                chunk = image_paths[i : i + chunk_size]
+                sizes.extend(executor.map(self._get_size, chunk))
+                pbar.update(len(chunk))
+
+        if self.persistent:
+            self.save()
+
+        return sizes
+
+    def set_size(self, image_path: str, width: int, height: int):
+        r"""record the size of an image which is known without reading it, e.g. an image just written by a preprocessing tool"""
+        assert self.persistent, "set_size is only for the persistent cache"
+        image_dir, file_name = os.path.split(os.path.abspath(image_path))
+        entries = self._load_dir(image_dir)
+        st = os.stat(image_path)
+        entries[file_name] = [st.st_mtime_ns, st.st_size, width, height]
+        self._dirty_dirs.add(image_dir)
+
+    def save(self):
+        r"""write the cache files of the directories which have new or updated sizes"""
+        for image_dir in self._dirty_dirs:
+            self._save_dir(image_dir)
+        self._dirty_dirs.clear()
@@ -0,0 +1,245 @@
+# sharded, memory-mapped latents cache store. an alternative backend to one .npz file per image
+
+import glob
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+LATENTS_CACHE_BACKENDS = ["npz", "store"]
+
+STORE_DTYPE = np.float32
+SHARD_EXT = ".bin"
+INDEX_PREFIX = "index_"
+INDEX_EXT = ".jsonl"
+
+# the validity check calls is_cached for every image: on a miss, the index files are read again at most once in this interval
+MISS_REFRESH_INTERVAL = 1.0
+
+
+class LatentsStore:
+    r"""
+    Latents cache for all images in a directory.
+
+    Records with the same layout (latents shape, flipped latents, alpha mask shape) are appended to the same shard file,
+    so every record in a shard has a fixed size and is located by its record number. The shard is read with `np.memmap`,
+    so loading latents is a single slice of the mapped file without parsing a zip archive.
+
+    Each writer process has its own shard files and index file (`index_<pid>.jsonl`, append only, one line per record),
+    so multiple processes can cache to the same store without locking. The later line wins if a key is cached twice.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.writer_id = str(os.getpid())
+
+        # key -> {"HxW": entry}
+        self.entries: Dict[str, Dict[str, dict]] = {}
+        self.index_offsets: Dict[str, int] = {}  # index file path -> bytes already read
+
+        self.memmaps: Dict[str, np.memmap] = {}
+        self.shard_files = {}  # shard name -> file object for writing
+        self.shard_counts: Dict[str, int] = {}  # shard name -> number of records
+
+        self.index_file = None
+
+        self.last_refresh = 0.0
+        self.refresh()
+
+    @staticmethod
+    def _reso_key(latents_size: Tuple[int, int]) -> str:
+        return f"{latents_size[0]}x{latents_size[1]}"  # HxW
+
+    def refresh(self):
+        r"""read index lines which are not read yet. other processes may have appended to the index files"""
+        self.last_refresh = time.monotonic()
+        if not os.path.isdir(self.store_dir):
+            return
+
+        for index_path in glob.glob(os.path.join(self.store_dir, INDEX_PREFIX + "*" + INDEX_EXT)):
+            offset = self.index_offsets.get(index_path, 0)
+            if os.path.getsize(index_path) <= offset:
+                continue
+
+            with open(index_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+
+            # ignore the last line if it is not completed (another process may be writing it)
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.entries.setdefault(entry["key"], {})[entry["reso"]] = entry
+            self.index_offsets[index_path] = offset + end
+
+    def _get_entry(self, key: str, latents_size: Optional[Tuple[int, int]], rate_limit_refresh: bool) -> Optional[dict]:
+        r"""
+        look up the entry, the index files are read again on a miss. with rate_limit_refresh, not more than once in
+        MISS_REFRESH_INTERVAL, so checking many uncached images does not list and stat the index files for each image
+        """
+        for i in range(2):
+            resos = self.entries.get(key)
+            if resos is not None:
+                if latents_size is None:
+                    # single resolution (SD/SDXL): use the last cached one
+                    return next(reversed(resos.values()))
+                entry = resos.get(self._reso_key(latents_size))
+                if entry is not None:
+                    return entry
+            if i == 0:
+                if rate_limit_refresh and time.monotonic() - self.last_refresh < MISS_REFRESH_INTERVAL:
+                    break
+                self.refresh()
+        return None
+
+    def is_cached(self, key: str, latents_size: Optional[Tuple[int, int]], flip_aug: bool, alpha_mask: bool) -> bool:
+        # images missed within the interval after a refresh are reported as not cached; each process checks the images it caches
+        entry = self._get_entry(key, latents_size, rate_limit_refresh=True)
+        if entry is None:
+            return False
+        if flip_aug and not entry["flipped"]:
+            return False
+        if alpha_mask and entry["alpha_shape"] is None:
+            return False
+        return True
+
+    def _get_memmap(self, shard: str, num_elements: int) -> np.memmap:
+        memmap = self.memmaps.get(shard)
+        if memmap is None or memmap.shape[0] < num_elements:
+            # the shard may be grown after mapping, so map it again
+            shard_path = os.path.join(self.store_dir, shard)
+            memmap = np.memmap(shard_path, dtype=STORE_DTYPE, mode="r")
+            self.memmaps[shard] = memmap
+        return memmap
+
+    def load(
+        self, key: str, latents_size: Optional[Tuple[int, int]]
+    ) -> Tuple[np.ndarray, List[int], List[int], Optional[np.ndarray], Optional[np.ndarray]]:
+        entry = self._get_entry(key, latents_size, rate_limit_refresh=False)  # a miss is an error, always refresh
+        if entry is None:
+            raise ValueError(f"latents not found in store / latentsがストアにありません: {key} in {self.store_dir}")
+
+        shape = tuple(entry["shape"])
+        alpha_shape = None if entry["alpha_shape"] is None else tuple(entry["alpha_shape"])
+        latents_numel = int(np.prod(shape))
+        record_numel = latents_numel * (2 if entry["flipped"] else 1) + (0 if alpha_shape is None else int(np.prod(alpha_shape)))
+
+        start = entry["index"] * record_numel
+        record = self._get_memmap(entry["shard"], start + record_numel)[start : start + record_numel]
+
+        latents = record[:latents_numel].reshape(shape)
+        pos = latents_numel
+        flipped_latents = None
+        if entry["flipped"]:
+            flipped_latents = record[pos : pos + latents_numel].reshape(shape)
+            pos += latents_numel
+        alpha_mask = None if alpha_shape is None else record[pos:].reshape(alpha_shape)
+
+        return latents, entry["original_size"], entry["crop_ltrb"], flipped_latents, alpha_mask
+
+    def _open_shard(self, shard: str, record_numel: int):
+        f = self.shard_files.get(shard)
+        if f is not None:
+            return f
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        shard_path = os.path.join(self.store_dir, shard)
+        record_bytes = record_numel * np.dtype(STORE_DTYPE).itemsize
+        f = open(shard_path, "ab")
+        size = f.tell()
+        if size % record_bytes != 0:
+            # the last record was not completed (e.g. interrupted). it is not in the index, so discard it
+            size -= size % record_bytes
+            f.truncate(size)
+            f.seek(size)
+        self.shard_files[shard] = f
+        self.shard_counts[shard] = size // record_bytes
+        return f
+
+    def save(
+        self,
+        key: str,
+        latents: np.ndarray,
+        original_size: List[int],
+        crop_ltrb: List[int],
+        flipped_latents: Optional[np.ndarray] = None,
+        alpha_mask: Optional[np.ndarray] = None,
+    ):
+        latents = np.ascontiguousarray(latents, dtype=STORE_DTYPE)
+        arrays = [latents]
+        if flipped_latents is not None:
+            arrays.append(np.ascontiguousarray(flipped_latents, dtype=STORE_DTYPE))
+        if alpha_mask is not None:
+            arrays.append(np.ascontiguousarray(alpha_mask, dtype=STORE_DTYPE))
+        record_numel = sum(a.size for a in arrays)
+
+        # fixed layout in a shard: e.g. "16x64x48_flip_alpha512x384_1234.bin"
+        layout = "x".join(str(s) for s in latents.shape)
+        if flipped_latents is not None:
+            layout += "_flip"
+        if alpha_mask is not None:
+            layout += "_alpha" + "x".join(str(s) for s in alpha_mask.shape)
+        shard = f"{layout}_{self.writer_id}{SHARD_EXT}"
+
+        f = self._open_shard(shard, record_numel)
+        for a in arrays:
+            f.write(a.tobytes())
+        f.flush()  # data must be written before the index line
+        index = self.shard_counts[shard]
+        self.shard_counts[shard] += 1
+
+        entry = {
+            "key": key,
+            "reso": self._reso_key(latents.shape[1:3]),
+            "shard": shard,
+            "index": index,
+            "shape": list(latents.shape),
+            "flipped": flipped_latents is not None,
+            "alpha_shape": None if alpha_mask is None else list(alpha_mask.shape),
+            "original_size": [int(s) for s in original_size],
+            "crop_ltrb": [int(c) for c in crop_ltrb],
+        }
+        if self.index_file is None:
+            index_path = os.path.join(self.store_dir, INDEX_PREFIX + self.writer_id + INDEX_EXT)
+            self.index_file = open(index_path, "a", encoding="utf-8")
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+
+        self.entries.setdefault(key, {})[entry["reso"]] = entry
+
+    def close(self):
+        for f in self.shard_files.values():
+            f.close()
+        self.shard_files.clear()
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+        self.memmaps.clear()
+
+
+_stores: Dict[Tuple[int, str], LatentsStore] = {}
+
+
+def get_latents_store(store_dir: str) -> LatentsStore:
+    r"""
+    returns the store for the directory. stores are kept per process: memmaps and file handles must not be shared
+    with DataLoader workers, so the store is not held by the (pickled) strategy or dataset.
+    """
+    store_key = (os.getpid(), store_dir)
+    store = _stores.get(store_key)
+    if store is None:
+        store = LatentsStore(store_dir)
+        _stores[store_key] = store
+    return store
@@ -0,0 +1,258 @@
+# streaming merge of LoRA models: one module at a time across all inputs, so the peak memory is bounded by the largest module
+
+import math
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+from tqdm import tqdm
+
+from library import train_util
+from library.utils import setup_logging, MemoryEfficientSafeOpen, MemoryEfficientSafeWriter
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LazyStateDict:
+    r"""
+    read-only view of a model file which loads tensors on demand. safetensors files are read with MemoryEfficientSafeOpen,
+    other files are loaded with torch.load(mmap=True) if possible.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        if os.path.splitext(file_name)[1] == ".safetensors":
+            self.safe_open = MemoryEfficientSafeOpen(file_name)
+            self.state_dict = None
+            self.metadata = train_util.load_metadata_from_safetensors(file_name)
+        else:
+            self.safe_open = None
+            try:
+                self.state_dict = torch.load(file_name, map_location="cpu", mmap=True)
+            except (RuntimeError, TypeError):
+                # legacy (non zip) format or old PyTorch
+                self.state_dict = torch.load(file_name, map_location="cpu")
+            self.metadata = {}
+
+    def keys(self) -> List[str]:
+        if self.safe_open is not None:
+            return self.safe_open.keys()
+        return [k for k, v in self.state_dict.items() if isinstance(v, torch.Tensor)]
+
+    def __contains__(self, key: str) -> bool:
+        if self.safe_open is not None:
+            return key in self.safe_open.header and key != "__metadata__"
+        return key in self.state_dict
+
+    def shape(self, key: str) -> List[int]:
+        if self.safe_open is not None:
+            return list(self.safe_open.header[key]["shape"])
+        return list(self.state_dict[key].shape)
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        if self.safe_open is not None:
+            return self.safe_open.get_tensor(key)
+        return self.state_dict[key]
+
+    def close(self):
+        if self.safe_open is not None:
+            self.safe_open.file.close()
+        self.state_dict = None
+
+
+class StreamingLoRAMerger:
+    r"""
+    Merge (or concat) LoRA models into one LoRA, same as the in-memory merge of merge_lora.py:
+    each weight is scaled by sqrt(alpha / base_alpha) * ratio (abs for lora_up), and alpha and dim of the first model
+    which has the module are used for the merged model.
+
+    Inputs are opened lazily. Only the header and alphas are read on init, then `iter_merged` yields the merged tensors
+    module by module, accumulating into one preallocated buffer per key.
+    """
+
+    def __init__(self, models: List[str], ratios: List[float], merge_dtype: torch.dtype, concat: bool = False, shuffle: bool = False):
+        self.models = models
+        self.ratios = ratios
+        self.merge_dtype = merge_dtype
+        self.concat = concat
+        self.shuffle = shuffle
+
+        self.base_alphas: Dict[str, float] = {}  # alpha for merged model
+        self.base_dims: Dict[str, int] = {}
+        self.v2 = None
+        self.base_model = None
+
+        self.readers: List[LazyStateDict] = []
+        self.alphas: List[Dict[str, float]] = []  # alpha for each model
+        for model in models:
+            logger.info(f"loading: {model}")
+            reader = LazyStateDict(model)
+            self.readers.append(reader)
+
+            if reader.metadata is not None:
+                if self.v2 is None:
+                    self.v2 = reader.metadata.get(train_util.SS_METADATA_KEY_V2, None)  # return string
+                if self.base_model is None:
+                    self.base_model = reader.metadata.get(train_util.SS_METADATA_KEY_BASE_MODEL_VERSION, None)
+
+            # get alpha and dim. alphas are converted to merge_dtype as the weights
+            alphas = {}
+            dims = {}
+            for key in reader.keys():
+                if "alpha" in key:
+                    lora_module_name = key[: key.rfind(".alpha")]
+                    alpha = float(reader.get_tensor(key).to(merge_dtype).float().numpy())
+                    alphas[lora_module_name] = alpha
+                    if lora_module_name not in self.base_alphas:
+                        self.base_alphas[lora_module_name] = alpha
+                elif "lora_down" in key:
+                    lora_module_name = key[: key.rfind(".lora_down")]
+                    dim = reader.shape(key)[0]
+                    dims[lora_module_name] = dim
+                    if lora_module_name not in self.base_dims:
+                        self.base_dims[lora_module_name] = dim
+
+            for lora_module_name in dims.keys():
+                if lora_module_name not in alphas:
+                    alpha = dims[lora_module_name]
+                    alphas[lora_module_name] = alpha
+                    if lora_module_name not in self.base_alphas:
+                        self.base_alphas[lora_module_name] = alpha
+            self.alphas.append(alphas)
+
+            logger.info(f"dim: {list(set(dims.values()))}, alpha: {list(set(alphas.values()))}")
+
+        # output keys grouped by module, in the order of names
+        self.module_keys: Dict[str, List[str]] = {}
+        self.shapes: Dict[str, List[int]] = {}
+        for reader in self.readers:
+            for key in reader.keys():
+                if "alpha" in key:
+                    continue
+                lora_module_name = key[: key.rfind(".lora_")]
+                shape = reader.shape(key)
+                concat_dim = self._get_concat_dim(key)
+                if key not in self.shapes:
+                    self.module_keys.setdefault(lora_module_name, []).append(key)
+                    self.shapes[key] = shape
+                elif concat_dim is not None:
+                    self.shapes[key][concat_dim] += shape[concat_dim]
+                else:
+                    assert (
+                        self.shapes[key] == shape
+                    ), "weights shape mismatch, different dims? / 重みのサイズが合いません。dimが異なる可能性があります。"
+        for lora_module_name in self.base_alphas.keys():
+            self.module_keys.setdefault(lora_module_name, [])
+
+    def _get_concat_dim(self, key: str) -> Optional[int]:
+        if "lora_up" in key and self.concat:
+            return 1
+        elif "lora_down" in key and self.concat:
+            return 0
+        return None
+
+    def output_specs(self, save_dtype: Optional[torch.dtype]) -> Dict[str, Tuple[torch.dtype, List[int]]]:
+        dtype = save_dtype or self.merge_dtype
+        specs = {}
+        for lora_module_name, keys in self.module_keys.items():
+            for key in keys:
+                specs[key] = (dtype, self.shapes[key])
+            if lora_module_name in self.base_alphas:
+                specs[lora_module_name + ".alpha"] = (dtype, [])
+        return specs
+
+    def _merge_key(self, key: str) -> torch.Tensor:
+        lora_module_name = key[: key.rfind(".lora_")]
+        concat_dim = self._get_concat_dim(key)
+        base_alpha = self.base_alphas[lora_module_name]
+
+        merged = torch.empty(self.shapes[key], dtype=self.merge_dtype)
+        offset = 0
+        first = True
+        for reader, ratio, alphas in zip(self.readers, self.ratios, self.alphas):
+            if key not in reader:
+                continue
+
+            alpha = alphas[lora_module_name]
+            scale = math.sqrt(alpha / base_alpha) * ratio
+            scale = abs(scale) if "lora_up" in key else scale  # マイナスの重みに対応する。
+
+            weight = reader.get_tensor(key).to(self.merge_dtype) * scale
+            if concat_dim is not None:
+                size = weight.shape[concat_dim]
+                merged.narrow(concat_dim, offset, size).copy_(weight)
+                offset += size
+            elif first:
+                merged.copy_(weight)
+            else:
+                merged.add_(weight)
+            first = False
+            del weight
+        return merged
+
+    def iter_merged(self) -> Iterator[Tuple[str, torch.Tensor]]:
+        r"""yields (key, merged tensor in merge_dtype), module by module"""
+        for lora_module_name in tqdm(sorted(self.module_keys.keys())):
+            merged = {key: self._merge_key(key) for key in self.module_keys[lora_module_name]}
+
+            if lora_module_name in self.base_alphas:
+                merged[lora_module_name + ".alpha"] = torch.tensor(self.base_alphas[lora_module_name])
+                if self.shuffle:
+                    key_down = lora_module_name + ".lora_down.weight"
+                    key_up = lora_module_name + ".lora_up.weight"
+                    dim = merged[key_down].shape[0]
+                    perm = torch.randperm(dim)
+                    merged[key_down] = merged[key_down][perm]
+                    merged[key_up] = merged[key_up][:, perm]
+
+            for key in sorted(merged.keys()):
+                yield key, merged[key]
+
+    def get_dims_and_alphas_str(self) -> Tuple[str, str]:
+        r"""dims and alphas for the minimum network metadata, "Dynamic" if they are not same"""
+        logger.info("merged model")
+        logger.info(f"dim: {list(set(self.base_dims.values()))}, alpha: {list(set(self.base_alphas.values()))}")
+
+        dims_list = list(set(self.base_dims.values()))
+        alphas_list = list(set(self.base_alphas.values()))
+        dims = f"{dims_list[0]}" if len(dims_list) == 1 else "Dynamic"
+        alphas = f"{alphas_list[0]}" if len(alphas_list) == 1 else "Dynamic"
+        return dims, alphas
+
+    def merge_to_state_dict(self) -> Dict[str, torch.Tensor]:
+        r"""merge all modules into memory, for non-safetensors output"""
+        return dict(self.iter_merged())
+
+    def save(self, file_name: str, save_dtype: Optional[torch.dtype], metadata: Dict[str, str], add_hashes: bool = True):
+        r"""
+        merge and write to a safetensors file tensor by tensor. if add_hashes, sshs_model_hash and sshs_legacy_hash
+        are calculated from the written data and added to the metadata.
+        """
+        metadata = dict(metadata)
+        if add_hashes:
+            # placeholders of the same length to reserve the header
+            metadata["sshs_model_hash"] = "0" * 64
+            metadata["sshs_legacy_hash"] = "0" * 8
+
+        logger.info(f"saving model to: {file_name}")
+        with MemoryEfficientSafeWriter(file_name, self.output_specs(save_dtype), metadata) as writer:
+            for key, tensor in self.iter_merged():
+                if save_dtype is not None and tensor.is_floating_point():
+                    tensor = tensor.to(save_dtype)
+                writer.write(key, tensor)
+
+            if add_hashes:
+                logger.info("calculating hashes and creating metadata...")
+                writer.file.flush()
+                model_hash, legacy_hash = train_util.precalculate_safetensors_hashes_from_file(file_name, metadata)
+                metadata["sshs_model_hash"] = model_hash
+                metadata["sshs_legacy_hash"] = legacy_hash
+                writer.update_metadata(metadata)
+        return metadata
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
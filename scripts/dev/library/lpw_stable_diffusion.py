@@ -17,6 +17,8 @@ from diffusers.models import AutoencoderKL, UNet2DConditionModel
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput, StableDiffusionSafetyChecker
 from diffusers.utils import logging
 
+from library.sample_engine import make_seeded_noise
+
 try:
     from diffusers.utils import PIL_INTERPOLATION
 except ImportError:
@@ -744,6 +746,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         is_cancelled_callback: Optional[Callable[[], bool]] = None,
         callback_steps: int = 1,
+        seeds: Optional[List[Optional[int]]] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -815,6 +818,9 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            seeds (`List[Optional[int]]`, *optional*):
+                A seed for each prompt. The initial noise of each prompt is generated after seeding with its seed, same
+                as generating the prompts one by one. `None` in the list is for a random seed.
 
         Returns:
             `None` if cancelled by `is_cancelled_callback`,
@@ -877,6 +883,9 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
 
         # 6. Prepare latent variables
+        if seeds is not None and image is None and latents is None:
+            latent_shape = (self.unet.in_channels, height // self.vae_scale_factor, width // self.vae_scale_factor)
+            latents = make_seeded_noise(seeds, latent_shape, device, dtype)
         latents, init_latents_orig, noise = self.prepare_latents(
             image,
             latent_timestep,
@@ -0,0 +1,234 @@
+# metadata files of fine tuning: the JSON file (image_key -> entry) and JSON Lines, which is streamed and updated incrementally
+
+import concurrent.futures
+import json
+import os
+import re
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+IMAGE_KEY = "image_key"  # key of the image in each line of JSON Lines
+
+
+def is_jsonl_metadata(path: str) -> bool:
+    return path.endswith(".jsonl")
+
+
+def _iter_jsonl_lines(path: str) -> Iterator[Tuple[int, bytes]]:
+    r"""(offset, line) of each non-empty line, including the lines which are updated by later lines"""
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            if line.strip():
+                yield line_offset, line
+
+
+_IMAGE_KEY_PREFIX = re.compile(r'\s*\{\s*"' + IMAGE_KEY + r'"\s*:\s*')
+_json_decoder = json.JSONDecoder()
+
+
+def _parse_image_key(line: bytes) -> str:
+    r"""
+    image_key of a line without decoding the other fields, which may be large. image_key is the first field of the lines
+    written by this module; otherwise, or if the key is longer than the decoded head of the line, the line is parsed.
+    """
+    head = line[:4096].decode("utf-8", errors="ignore")
+    match = _IMAGE_KEY_PREFIX.match(head)
+    if match is not None:
+        try:
+            image_key, _ = _json_decoder.raw_decode(head, match.end())
+            if isinstance(image_key, str):
+                return image_key
+        except json.JSONDecodeError:
+            pass
+    return json.loads(line)[IMAGE_KEY]
+
+
+def index_jsonl_metadata(path: str) -> Dict[str, int]:
+    r"""image_key -> offset of the latest line of the image"""
+    return {_parse_image_key(line): offset for offset, line in _iter_jsonl_lines(path)}
+
+
+def iter_metadata(path: str, index: Optional[Dict[str, int]] = None) -> Iterator[Tuple[str, Dict]]:
+    r"""
+    (image_key, entry) of the metadata file. JSON Lines is streamed: the file is read twice, first for the index of the latest
+    lines (only image_key is decoded), and then only the latest lines are parsed, so the updated entries come in the order of
+    their updates. JSON is loaded at once.
+    """
+    if not is_jsonl_metadata(path):
+        with open(path, "rt", encoding="utf-8") as f:
+            metadata = json.load(f)
+        yield from metadata.items()
+        return
+
+    if index is None:
+        index = index_jsonl_metadata(path)
+    latest_offsets = set(index.values())
+    for offset, line in _iter_jsonl_lines(path):
+        if offset not in latest_offsets:
+            continue  # updated by a later line
+        entry = json.loads(line)
+        image_key = entry.pop(IMAGE_KEY)
+        yield image_key, entry
+
+
+def count_metadata(path: str) -> int:
+    if not is_jsonl_metadata(path):
+        with open(path, "rt", encoding="utf-8") as f:
+            return len(json.load(f))
+    return len(index_jsonl_metadata(path))
+
+
+def load_metadata(path: str) -> Dict[str, Dict]:
+    r"""all entries of the metadata file in a dict, for the scripts which look up entries by image_key"""
+    return dict(iter_metadata(path))
+
+
+def _dump_jsonl_line(image_key: str, entry: Dict) -> str:
+    return json.dumps({IMAGE_KEY: image_key, **entry}, ensure_ascii=False) + "\n"
+
+
+def write_metadata(path: str, entries: Iterable[Tuple[str, Dict]]) -> int:
+    r"""
+    write all entries. JSON Lines is written line by line, JSON (indent=2, same as before) needs all entries in memory.
+    the file is replaced atomically, so it is safe to write the entries read from the same file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    if is_jsonl_metadata(path):
+        with open(tmp_path, "wt", encoding="utf-8") as f:
+            for image_key, entry in entries:
+                f.write(_dump_jsonl_line(image_key, entry))
+                count += 1
+    else:
+        metadata = dict(entries)
+        count = len(metadata)
+        with open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
+    os.replace(tmp_path, path)
+    return count
+
+
+def append_metadata(path: str, entries: Iterable[Tuple[str, Dict]]) -> int:
+    r"""append the updated or new entries to JSON Lines, the appended lines override the previous lines of the same images"""
+    assert is_jsonl_metadata(path), f"only JSON Lines metadata can be appended / 追記できるのはJSON Linesのメタデータのみです: {path}"
+    lines = [_dump_jsonl_line(image_key, entry) for image_key, entry in entries]
+    if lines:
+        with open(path, "at", encoding="utf-8") as f:
+            f.writelines(lines)
+    return len(lines)
+
+
+def save_metadata_updates(in_path: Optional[str], out_path: str, results: Iterable[Tuple[str, Dict, bool]]) -> Tuple[int, int]:
+    r"""
+    save the results (image_key, entry, changed) of processing all entries of in_path (and new entries). if out_path is the
+    same JSON Lines file as in_path, only the changed entries are appended. otherwise all entries are written to out_path.
+    returns the number of changed entries and the number of all entries.
+    """
+    num_changed = 0
+    num_entries = 0
+
+    def count(results):
+        nonlocal num_changed, num_entries
+        for image_key, entry, changed in results:
+            num_entries += 1
+            if changed:
+                num_changed += 1
+            yield image_key, entry, changed
+
+    results = count(results)
+    incremental = (
+        in_path is not None
+        and is_jsonl_metadata(out_path)
+        and os.path.exists(in_path)
+        and os.path.exists(out_path)
+        and os.path.samefile(in_path, out_path)
+    )
+    if incremental:
+        # keep the changed entries until in_path is read to the end, then append them
+        changed_entries = [(image_key, entry) for image_key, entry, changed in results if changed]
+        append_metadata(out_path, changed_entries)
+    else:
+        write_metadata(out_path, ((image_key, entry) for image_key, entry, _ in results))
+    return num_changed, num_entries
+
+
+def map_in_processes(
+    fn: Callable[[List], List], items: Iterable, max_workers: Optional[int] = None, chunk_size: int = 1000
+) -> Iterator:
+    r"""
+    results of fn(chunk) for the chunks of items in a process pool, flattened in the order of items. the number of chunks in
+    flight is bounded, so the items are streamed. fn must be a picklable module level function.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if max_workers <= 1:
+        for chunk in chunks():
+            yield from fn(chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = []
+        for chunk in chunks():
+            futures.append(executor.submit(fn, chunk))
+            if len(futures) >= max_workers * 2:
+                yield from futures.pop(0).result()
+        for future in futures:
+            yield from future.result()
+
+
+def merge_text_files_to_metadata(
+    in_path: Optional[str],
+    out_path: str,
+    image_keys_to_files: Dict[str, str],
+    field: str,
+    debug: bool = False,
+) -> Tuple[int, int]:
+    r"""
+    set the text of the files (captions, tags) to the field of the entries. the existing entries are streamed, and the images
+    which are not in in_path are added at the end. returns the number of changed entries and the number of all entries.
+    """
+    remaining = dict(image_keys_to_files)
+
+    def read_text(image_key: str, text_path: str) -> str:
+        with open(text_path, "rt", encoding="utf-8") as f:
+            text = f.read().strip()
+        if debug:
+            logger.info(f"{image_key} {text}")
+        return text
+
+    def results():
+        if in_path is not None:
+            for image_key, entry in iter_metadata(in_path):
+                text_path = remaining.pop(image_key, None)
+                if text_path is None:
+                    yield image_key, entry, False
+                    continue
+                text = read_text(image_key, text_path)
+                changed = entry.get(field) != text
+                entry[field] = text
+                yield image_key, entry, changed
+
+        for image_key, text_path in remaining.items():
+            yield image_key, {field: read_text(image_key, text_path)}, True
+
+    return save_metadata_updates(in_path, out_path, results())
@@ -0,0 +1,141 @@
+# helpers for sample image generation during training: batching prompts with the same generation settings, splitting the
+# batches between processes, per-prompt seeds and reusing the text encoder outputs of the sample prompts
+
+import contextlib
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_sample_batches(prompts: List[Dict], batch_size: int, get_key: Callable[[Dict], Hashable]) -> List[List[Dict]]:
+    r"""
+    group the prompt dicts with the same key (resolution, steps, sampler etc.) into batches of up to batch_size. the batches
+    are in the order of their first prompt, and the prompts in a batch are in the original order.
+    """
+    batch_size = max(1, batch_size)
+    batches: List[List[Dict]] = []
+    open_batches: Dict[Hashable, List[Dict]] = {}
+    for prompt_dict in prompts:
+        key = get_key(prompt_dict)
+        batch = open_batches.get(key)
+        if batch is None or len(batch) >= batch_size:
+            batch = []
+            batches.append(batch)
+            open_batches[key] = batch
+        batch.append(prompt_dict)
+    return batches
+
+
+@contextlib.contextmanager
+def split_sample_batches(distributed_state, batches: List[List[Dict]]) -> Iterator[List[List[Dict]]]:
+    r"""
+    batches for this process. split_between_processes gives contiguous slices, so the batches are reordered to assign them
+    round-robin (batch i to process i % num_processes) and the images are generated roughly in the order of the prompts.
+    """
+    num_processes = distributed_state.num_processes
+    if num_processes <= 1:
+        yield batches
+        return
+
+    ordered = [batch for process_index in range(num_processes) for batch in batches[process_index::num_processes]]
+    with distributed_state.split_between_processes(ordered) as process_batches:
+        yield process_batches
+
+
+def set_sample_seed(seed: Optional[int]):
+    r"""seed the global RNGs for a prompt, or reseed them randomly if the prompt has no seed"""
+    if seed is not None:
+        torch.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed(seed)
+    else:
+        # True random sample image generation
+        torch.seed()
+        if torch.cuda.is_available():
+            torch.cuda.seed()
+
+
+def make_seeded_noise(seeds: List[Optional[int]], shape: tuple, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    r"""
+    initial noise of (len(seeds), *shape). the noise of each sample is generated with the global RNGs after
+    set_sample_seed(seed), so it is the same as generating the prompts one by one.
+    """
+    noises = []
+    for seed in seeds:
+        set_sample_seed(seed)
+        if device.type == "mps":
+            # randn does not work reproducibly on mps
+            noises.append(torch.randn((1,) + tuple(shape), device="cpu", dtype=dtype).to(device))
+        else:
+            noises.append(torch.randn((1,) + tuple(shape), device=device, dtype=dtype))
+    return torch.cat(noises, dim=0)
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, torch.device):
+        return str(value)
+    return value
+
+
+class PromptEncodingCache:
+    r"""
+    Text encoder outputs of the sample prompts. The outputs are reused in a sampling event (e.g. the same negative prompt),
+    and across the events if `persistent` is given to `begin`, which is only valid while the text encoders are not trained.
+    """
+
+    def __init__(self):
+        self.owner: Optional[Hashable] = None
+        self.outputs: Dict[Hashable, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, models: List[Optional[torch.nn.Module]], persistent: bool):
+        r"""called at the beginning of each sampling event with the text encoders"""
+        owner = tuple(id(model) for model in models)
+        if not persistent or owner != self.owner:
+            self.outputs.clear()
+        self.owner = owner
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, encode: Callable[[], Any]) -> Any:
+        key = _freeze(key)
+        if key in self.outputs:
+            self.hits += 1
+            return self.outputs[key]
+        self.misses += 1
+        output = encode()
+        self.outputs[key] = output
+        return output
+
+    def wrap(self, encode_fn: Callable) -> Callable:
+        r"""cached version of encode_fn, the arguments are the key"""
+
+        def cached_encode_fn(*args, **kwargs):
+            return self.get((args, kwargs), lambda: encode_fn(*args, **kwargs))
+
+        return cached_encode_fn
+
+    def log_stats(self):
+        if self.hits + self.misses > 0:
+            logger.info(f"sample prompt encodings: {self.hits} reused, {self.misses} encoded")
+
+
+# shared by the sampling events of a training
+_prompt_encoding_cache = PromptEncodingCache()
+
+
+def get_prompt_encoding_cache() -> PromptEncodingCache:
+    return _prompt_encoding_cache
+
@@ -28,7 +28,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from library import sd3_models, sd3_utils, strategy_base, train_util
+from library import sample_engine, sd3_models, sd3_utils, strategy_base, train_util
 
 
 def save_models(
@@ -300,7 +300,7 @@ def max_denoise(model_sampling, sigmas):
 def do_sample(
     height: int,
     width: int,
-    seed: int,
+    seed: Union[Optional[int], List[Optional[int]]],
     cond: Tuple[torch.Tensor, torch.Tensor],
     neg_cond: Tuple[torch.Tensor, torch.Tensor],
     mmdit: sd3_models.MMDiT,
@@ -309,19 +309,27 @@ def do_sample(
     dtype: torch.dtype,
     device: str,
 ):
-    latent = torch.zeros(1, 16, height // 8, width // 8, device=device)
+    r"""
+    seed can be a list of the seeds of a batch, cond and neg_cond have the same batch size. the noise of each sample is
+    generated from its seed.
+    """
+    seeds = seed if isinstance(seed, list) else [seed]
+    batch_size = len(seeds)
+    latent = torch.zeros(batch_size, 16, height // 8, width // 8, device=device)
     latent = latent.to(dtype).to(device)
 
     # noise = get_noise(seed, latent).to(device)
-    if seed is not None:
-        generator = torch.manual_seed(seed)
-    else:
-        generator = None
-    noise = (
-        torch.randn(latent.size(), dtype=torch.float32, layout=latent.layout, generator=generator, device="cpu")
-        .to(latent.dtype)
-        .to(device)
-    )
+    noises = []
+    for seed in seeds:
+        if seed is not None:
+            generator = torch.manual_seed(seed)
+        else:
+            torch.seed()  # the global RNG may be seeded by the previous sample in the batch
+            generator = None
+        noises.append(
+            torch.randn((1,) + latent.shape[1:], dtype=torch.float32, layout=latent.layout, generator=generator, device="cpu")
+        )
+    noise = torch.cat(noises, dim=0).to(latent.dtype).to(device)
 
     model_sampling = sd3_utils.ModelSamplingDiscreteFlow(shift=3.0)  # 3.0 is for SD3
 
@@ -340,7 +348,7 @@ def do_sample(
         sigma_hat = sigmas[i]
 
         timestep = model_sampling.timestep(sigma_hat).float()
-        timestep = torch.FloatTensor([timestep, timestep]).to(device)
+        timestep = torch.FloatTensor([timestep] * (batch_size * 2)).to(device)
 
         x_c_nc = torch.cat([x, x], dim=0)
         # print(x_c_nc.shape, timestep.shape, c_crossattn.shape, y.shape)
@@ -381,6 +389,7 @@ def sample_images(
     text_encoders,
     sample_prompts_te_outputs,
     prompt_replacement=None,
+    cache_prompt_embeddings: bool = False,
 ):
     if steps == 0:
         if not args.sample_at_first:
@@ -414,6 +423,10 @@ def sample_images(
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
+    # the text encoder outputs are reused in this sampling event, and in the next events if the text encoders are not trained
+    prompt_encoding_cache = sample_engine.get_prompt_encoding_cache()
+    prompt_encoding_cache.begin(text_encoders or [], persistent=cache_prompt_embeddings)
+
     # save random state to restore later
     rng_state = torch.get_rng_state()
     cuda_rng_state = None
@@ -422,46 +435,37 @@ def sample_images(
     except Exception:
         pass
 
-    if distributed_state.num_processes <= 1:
-        # If only one device is available, just use the original prompt list. We don't need to care about the distribution of prompts.
-        with torch.no_grad(), accelerator.autocast():
-            for prompt_dict in prompts:
-                sample_image_inference(
-                    accelerator,
-                    args,
-                    mmdit,
-                    text_encoders,
-                    vae,
-                    save_dir,
-                    prompt_dict,
-                    epoch,
-                    steps,
-                    sample_prompts_te_outputs,
-                    prompt_replacement,
-                )
-    else:
-        # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
-        # prompt_dicts are assigned to lists based on order of processes, to attempt to time the image creation time to match enum order. Probably only works when steps and sampler are identical.
-        per_process_prompts = []  # list of lists
-        for i in range(distributed_state.num_processes):
-            per_process_prompts.append(prompts[i :: distributed_state.num_processes])
-
-        with torch.no_grad():
-            with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
-                for prompt_dict in prompt_dict_lists[0]:
-                    sample_image_inference(
-                        accelerator,
-                        args,
-                        mmdit,
-                        text_encoders,
-                        vae,
-                        save_dir,
-                        prompt_dict,
-                        epoch,
-                        steps,
-                        sample_prompts_te_outputs,
-                        prompt_replacement,
-                    )
+    def get_batch_key(prompt_dict):
+        width = prompt_dict.get("width", 512)
+        height = prompt_dict.get("height", 512)
+        return (
+            max(64, width - width % 8),
+            max(64, height - height % 8),
+            prompt_dict.get("sample_steps", 30),
+            prompt_dict.get("scale", 7.5),
+        )
+
+    # prompts with the same settings are generated in a batch. batches are assigned to the processes in order, to attempt to
+    # time the image creation time to match enum order
+    batches = sample_engine.make_sample_batches(prompts, args.sample_batch_size, get_batch_key)
+    with torch.no_grad(), accelerator.autocast(), sample_engine.split_sample_batches(
+        distributed_state, batches
+    ) as process_batches:
+        for prompt_dicts in process_batches:
+            sample_image_inference_batch(
+                accelerator,
+                args,
+                mmdit,
+                text_encoders,
+                vae,
+                save_dir,
+                prompt_dicts,
+                epoch,
+                steps,
+                sample_prompts_te_outputs,
+                prompt_replacement,
+            )
+    prompt_encoding_cache.log_stats()
 
     torch.set_rng_state(rng_state)
     if cuda_rng_state is not None:
@@ -484,52 +488,58 @@ def sample_image_inference(
     prompt_replacement,
 ):
     assert isinstance(prompt_dict, dict)
-    negative_prompt = prompt_dict.get("negative_prompt")
+    sample_image_inference_batch(
+        accelerator,
+        args,
+        mmdit,
+        text_encoders,
+        vae,
+        save_dir,
+        [prompt_dict],
+        epoch,
+        steps,
+        sample_prompts_te_outputs,
+        prompt_replacement,
+    )
+
+
+def sample_image_inference_batch(
+    accelerator: Accelerator,
+    args: argparse.Namespace,
+    mmdit: sd3_models.MMDiT,
+    text_encoders: List[Union[CLIPTextModelWithProjection, T5EncoderModel]],
+    vae: sd3_models.SDVAE,
+    save_dir,
+    prompt_dicts: List[Dict],
+    epoch,
+    steps,
+    sample_prompts_te_outputs,
+    prompt_replacement,
+):
+    r"""
+    generate the images of the prompts in a batch. the prompts must have the same size, steps and scale (the first prompt's
+    are used). the noise of each image is generated from its seed, so a batch of one prompt is same as before.
+    """
+    prompt_dict = prompt_dicts[0]
     sample_steps = prompt_dict.get("sample_steps", 30)
     width = prompt_dict.get("width", 512)
     height = prompt_dict.get("height", 512)
     scale = prompt_dict.get("scale", 7.5)
-    seed = prompt_dict.get("seed")
     # controlnet_image = prompt_dict.get("controlnet_image")
-    prompt: str = prompt_dict.get("prompt", "")
     # sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
 
-    if prompt_replacement is not None:
-        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-        if negative_prompt is not None:
-            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
-
-    if seed is not None:
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
-    else:
-        # True random sample image generation
-        torch.seed()
-        torch.cuda.seed()
-
-    if negative_prompt is None:
-        negative_prompt = ""
-
     height = max(64, height - height % 8)  # round to divisible by 8
     width = max(64, width - width % 8)  # round to divisible by 8
-    logger.info(f"prompt: {prompt}")
-    logger.info(f"negative_prompt: {negative_prompt}")
-    logger.info(f"height: {height}")
-    logger.info(f"width: {width}")
-    logger.info(f"sample_steps: {sample_steps}")
-    logger.info(f"scale: {scale}")
-    # logger.info(f"sample_sampler: {sampler_name}")
-    if seed is not None:
-        logger.info(f"seed: {seed}")
 
     # encode prompts
     tokenize_strategy = strategy_base.TokenizeStrategy.get_strategy()
     encoding_strategy = strategy_base.TextEncodingStrategy.get_strategy()
+    prompt_encoding_cache = sample_engine.get_prompt_encoding_cache()
 
     def encode_prompt(prpt):
         text_encoder_conds = []
         if sample_prompts_te_outputs and prpt in sample_prompts_te_outputs:
-            text_encoder_conds = sample_prompts_te_outputs[prpt]
+            text_encoder_conds = list(sample_prompts_te_outputs[prpt])
             print(f"Using cached text encoder outputs for prompt: {prpt}")
         if text_encoders is not None:
             print(f"Encoding prompt: {prpt}")
@@ -545,54 +555,91 @@ def sample_image_inference(
                 for i in range(len(encoded_text_encoder_conds)):
                     if encoded_text_encoder_conds[i] is not None:
                         text_encoder_conds[i] = encoded_text_encoder_conds[i]
-        return text_encoder_conds
 
-    lg_out, t5_out, pooled, l_attn_mask, g_attn_mask, t5_attn_mask = encode_prompt(prompt)
-    cond = encoding_strategy.concat_encodings(lg_out, t5_out, pooled)
+        lg_out, t5_out, pooled, l_attn_mask, g_attn_mask, t5_attn_mask = text_encoder_conds
+        return encoding_strategy.concat_encodings(lg_out, t5_out, pooled)
+
+    prompts: List[str] = []
+    seeds: List[Optional[int]] = []
+    conds = []
+    neg_conds = []
+    for prompt_dict in prompt_dicts:
+        negative_prompt = prompt_dict.get("negative_prompt")
+        seed = prompt_dict.get("seed")
+        prompt: str = prompt_dict.get("prompt", "")
+
+        if prompt_replacement is not None:
+            prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+            if negative_prompt is not None:
+                negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+
+        sample_engine.set_sample_seed(seed)
+
+        if negative_prompt is None:
+            negative_prompt = ""
+
+        logger.info(f"prompt: {prompt}")
+        logger.info(f"negative_prompt: {negative_prompt}")
+        if seed is not None:
+            logger.info(f"seed: {seed}")
+
+        conds.append(prompt_encoding_cache.get(prompt, lambda: encode_prompt(prompt)))
+        neg_conds.append(prompt_encoding_cache.get(negative_prompt, lambda: encode_prompt(negative_prompt)))
+        prompts.append(prompt)
+        seeds.append(seed)
+
+    logger.info(f"height: {height}")
+    logger.info(f"width: {width}")
+    logger.info(f"sample_steps: {sample_steps}")
+    logger.info(f"scale: {scale}")
+    # logger.info(f"sample_sampler: {sampler_name}")
+    if len(prompts) > 1:
+        logger.info(f"batch size: {len(prompts)}")
 
-    # encode negative prompts
-    lg_out, t5_out, pooled, l_attn_mask, g_attn_mask, t5_attn_mask = encode_prompt(negative_prompt)
-    neg_cond = encoding_strategy.concat_encodings(lg_out, t5_out, pooled)
+    # concatenate the conds of the prompts along the batch dimension
+    cond = tuple(torch.cat([t.to(accelerator.device) for t in c], dim=0) for c in zip(*conds))
+    neg_cond = tuple(torch.cat([t.to(accelerator.device) for t in c], dim=0) for c in zip(*neg_conds))
 
     # sample image
     clean_memory_on_device(accelerator.device)
     with accelerator.autocast(), torch.no_grad():
         # mmdit may be fp8, so we need weight_dtype here. vae is always in that dtype.
-        latents = do_sample(height, width, seed, cond, neg_cond, mmdit, sample_steps, scale, vae.dtype, accelerator.device)
+        latents = do_sample(height, width, seeds, cond, neg_cond, mmdit, sample_steps, scale, vae.dtype, accelerator.device)
 
     # latent to image
     clean_memory_on_device(accelerator.device)
     org_vae_device = vae.device  # will be on cpu
     vae.to(accelerator.device)
     latents = vae.process_out(latents.to(vae.device, dtype=vae.dtype))
-    image = vae.decode(latents)
+    images = vae.decode(latents)
     vae.to(org_vae_device)
     clean_memory_on_device(accelerator.device)
 
-    image = image.float()
-    image = torch.clamp((image + 1.0) / 2.0, min=0.0, max=1.0)[0]
-    decoded_np = 255.0 * np.moveaxis(image.cpu().numpy(), 0, 2)
+    images = images.float()
+    images = torch.clamp((images + 1.0) / 2.0, min=0.0, max=1.0)
+    decoded_np = 255.0 * np.moveaxis(images.cpu().numpy(), 1, 3)
     decoded_np = decoded_np.astype(np.uint8)
 
-    image = Image.fromarray(decoded_np)
     # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
     # but adding 'enum' to the filename should be enough
 
-    ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-    num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-    seed_suffix = "" if seed is None else f"_{seed}"
-    i: int = prompt_dict["enum"]
-    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
+    for prompt_dict, prompt, seed, image in zip(prompt_dicts, prompts, seeds, decoded_np):
+        image = Image.fromarray(image)
+        ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+        seed_suffix = "" if seed is None else f"_{seed}"
+        i: int = prompt_dict["enum"]
+        img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
+        image.save(os.path.join(save_dir, img_filename))
 
-    # send images to wandb if enabled
-    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
-        wandb_tracker = accelerator.get_tracker("wandb")
+        # send images to wandb if enabled
+        if "wandb" in [tracker.name for tracker in accelerator.trackers]:
+            wandb_tracker = accelerator.get_tracker("wandb")
 
-        import wandb
+            import wandb
 
-        # not to commit images to avoid inconsistency between training and logging steps
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+            # not to commit images to avoid inconsistency between training and logging steps
+            wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
 
 
 # region Diffusers
@@ -27,6 +27,7 @@ from library import (
     sdxl_original_unet,
     sdxl_original_control_net,
 )
+from library.sample_engine import make_seeded_noise
 
 
 try:
@@ -602,6 +603,28 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
                 return torch.device(module._hf_hook.execution_device)
         return self.device
 
+    def _encode_prompt(self, prompt, negative_prompt, do_classifier_free_guidance):
+        r"""text embeddings and pooled outputs of the prompt and the negative prompt (None without guidance)"""
+        tokenize_strategy: strategy_sdxl.SdxlTokenizeStrategy = strategy_base.TokenizeStrategy.get_strategy()
+        encoding_strategy: strategy_sdxl.SdxlTextEncodingStrategy = strategy_base.TextEncodingStrategy.get_strategy()
+
+        text_input_ids, text_weights = tokenize_strategy.tokenize_with_weights(prompt)
+        hidden_states_1, hidden_states_2, text_pool = encoding_strategy.encode_tokens_with_weights(
+            tokenize_strategy, self.text_encoders, text_input_ids, text_weights
+        )
+        text_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
+
+        if do_classifier_free_guidance:
+            input_ids, weights = tokenize_strategy.tokenize_with_weights(negative_prompt or "")
+            hidden_states_1, hidden_states_2, uncond_pool = encoding_strategy.encode_tokens_with_weights(
+                tokenize_strategy, self.text_encoders, input_ids, weights
+            )
+            uncond_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
+        else:
+            uncond_embeddings = None
+            uncond_pool = None
+        return text_embeddings, text_pool, uncond_embeddings, uncond_pool
+
     def check_inputs(self, prompt, height, width, strength, callback_steps):
         if not isinstance(prompt, str) and not isinstance(prompt, list):
             raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
@@ -737,6 +760,7 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         is_cancelled_callback: Optional[Callable[[], bool]] = None,
         callback_steps: int = 1,
+        seeds: Optional[List[Optional[int]]] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -808,6 +832,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            seeds (`List[Optional[int]]`, *optional*):
+                A seed for each prompt. The initial noise of each prompt is generated after seeding with its seed, same
+                as generating the prompts one by one. `None` in the list is for a random seed.
 
         Returns:
             `None` if cancelled by `is_cancelled_callback`,
@@ -836,24 +863,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         do_classifier_free_guidance = guidance_scale > 1.0
 
         # 3. Encode input prompt
-        tokenize_strategy: strategy_sdxl.SdxlTokenizeStrategy = strategy_base.TokenizeStrategy.get_strategy()
-        encoding_strategy: strategy_sdxl.SdxlTextEncodingStrategy = strategy_base.TextEncodingStrategy.get_strategy()
-
-        text_input_ids, text_weights = tokenize_strategy.tokenize_with_weights(prompt)
-        hidden_states_1, hidden_states_2, text_pool = encoding_strategy.encode_tokens_with_weights(
-            tokenize_strategy, self.text_encoders, text_input_ids, text_weights
+        text_embeddings, text_pool, uncond_embeddings, uncond_pool = self._encode_prompt(
+            prompt, negative_prompt, do_classifier_free_guidance
         )
-        text_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
-
-        if do_classifier_free_guidance:
-            input_ids, weights = tokenize_strategy.tokenize_with_weights(negative_prompt or "")
-            hidden_states_1, hidden_states_2, uncond_pool = encoding_strategy.encode_tokens_with_weights(
-                tokenize_strategy, self.text_encoders, input_ids, weights
-            )
-            uncond_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
-        else:
-            uncond_embeddings = None
-            uncond_pool = None
 
         unet_dtype = self.unet.dtype
         dtype = unet_dtype
@@ -886,6 +898,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
 
         # 6. Prepare latent variables
+        if seeds is not None and image is None and latents is None:
+            latent_shape = (self.unet.in_channels, height // self.vae_scale_factor, width // self.vae_scale_factor)
+            latents = make_seeded_noise(seeds, latent_shape, device, dtype)
         latents, init_latents_orig, noise = self.prepare_latents(
             image,
             latent_timestep,
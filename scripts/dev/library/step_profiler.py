@@ -0,0 +1,319 @@
+# lightweight step profiler for training loops: named spans, throughput and data stall, JSON trace and torch.profiler window
+
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def add_step_profiler_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile_steps",
+        action="store_true",
+        help="measure the time of each part of training steps (data loading, text encoding, forward, backward, optimizer etc.) and"
+        " log samples/sec, data stall ratio and percentiles of them / 学習ステップの各部分（データ読み込み、テキストエンコード、forward、"
+        "backward、optimizer等）の時間を計測し、samples/sec、データ待ちの割合、各部分のパーセンタイルを記録する",
+    )
+    parser.add_argument(
+        "--profile_log_every_n_steps",
+        type=int,
+        default=50,
+        help="interval of steps to log the profile with --profile_steps (default 50) / --profile_steps時に記録するステップ間隔（デフォルト50）",
+    )
+    parser.add_argument(
+        "--profile_trace_file",
+        type=str,
+        default=None,
+        help="write the spans to a JSON trace file (Chrome trace format, can be opened in Perfetto) with --profile_steps"
+        " / --profile_steps時に計測区間をJSONトレースファイル（Chrome trace形式、Perfettoで開ける）に書き出す",
+    )
+    parser.add_argument(
+        "--profile_sync_device",
+        action="store_true",
+        help="synchronize the device at the end of each span with --profile_steps, for accurate GPU time (slower)"
+        " / --profile_steps時に各区間の終わりでデバイスを同期し、GPUの時間を正確に計測する（低速になる）",
+    )
+    parser.add_argument(
+        "--torch_profiler_steps",
+        type=str,
+        default=None,
+        help="run torch.profiler for the range of steps, e.g. '10-15'. the trace is saved to logging_dir (or output_dir)/torch_profiler"
+        " / 指定範囲のステップでtorch.profilerを実行する（例：'10-15'）。結果はlogging_dir（またはoutput_dir）/torch_profilerに保存される",
+    )
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start", "record_function")
+
+    def __init__(self, profiler: "StepProfiler", name: str):
+        self.profiler = profiler
+        self.name = name
+        self.record_function = None
+
+    def __enter__(self):
+        if self.profiler.torch_profiler is not None:
+            # show the span in the trace of torch.profiler too
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profiler.sync_device is not None:
+            _synchronize(self.profiler.sync_device)
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        if self.record_function is not None:
+            self.record_function.__exit__(exc_type, exc_val, exc_tb)
+        return False
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "xpu":
+        torch.xpu.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+class StepProfiler:
+    r"""
+    Collects the durations of named spans and steps. `span(name)` is a context manager which can be nested and used from
+    any thread (e.g. backward hooks of the block swap). `step_end` closes the step and returns the logs of the interval
+    every `log_every_n_steps` steps:
+
+    - perf/samples_per_sec, perf/steps_per_sec
+    - perf/data_stall_ratio: time waiting for the dataloader / wall time
+    - perf/{span}_ms_p50, _p90, _p99 and perf/{span}_ratio (total time of the span / wall time)
+    """
+
+    def __init__(
+        self,
+        log_every_n_steps: int = 50,
+        trace_file: Optional[str] = None,
+        sync_device: Optional[torch.device] = None,
+        torch_profiler_steps: Optional[Tuple[int, int]] = None,
+        torch_profiler_dir: Optional[str] = None,
+    ):
+        self.log_every_n_steps = max(1, log_every_n_steps)
+        self.sync_device = sync_device
+        self.lock = threading.Lock()
+
+        self.origin = time.perf_counter()
+        self.spans: Dict[str, List[float]] = {}  # name -> durations in the interval
+        self.span_totals: Dict[str, float] = {}  # name -> total duration in the interval
+        self.interval_start = None
+        self.interval_steps = 0
+        self.interval_samples = 0
+        self.step_start = None
+
+        self.trace = None
+        if trace_file:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+            self.trace = open(trace_file, "w", encoding="utf-8")
+            self.trace.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+            self.trace_first = True
+        self.pid = os.getpid()
+
+        self.torch_profiler_steps = torch_profiler_steps
+        self.torch_profiler_dir = torch_profiler_dir
+        self.torch_profiler = None
+
+    def span(self, name: str) -> _Span:
+        return _Span(self, name)
+
+    def record(self, name: str, start: float, end: float):
+        duration = end - start
+        with self.lock:
+            self.spans.setdefault(name, []).append(duration)
+            self.span_totals[name] = self.span_totals.get(name, 0.0) + duration
+            if self.trace is not None:
+                event = {
+                    "name": name,
+                    "ph": "X",
+                    "ts": round((start - self.origin) * 1e6, 1),
+                    "dur": round(duration * 1e6, 1),
+                    "pid": self.pid,
+                    "tid": threading.get_ident(),
+                }
+                self.trace.write(("" if self.trace_first else ",\n") + json.dumps(event))
+                self.trace_first = False
+
+    def iterate(self, iterable: Iterable, name: str = "data") -> Iterator:
+        r"""yield items of the iterable (e.g. dataloader), the time waiting for each item is recorded as the span"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, start, time.perf_counter())
+            if self.step_start is None:
+                self.step_start = start
+            yield item
+
+    def step_begin(self, global_step: int):
+        r"""called at the beginning of each optimization step, to start and stop torch.profiler"""
+        if self.torch_profiler_steps is None:
+            return
+        first, last = self.torch_profiler_steps
+        if self.torch_profiler is None and first <= global_step <= last:
+            logger.info(f"start torch.profiler at step {global_step} / ステップ{global_step}でtorch.profilerを開始します")
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                with_stack=False,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.torch_profiler_dir),
+            )
+            self.torch_profiler.start()
+        elif self.torch_profiler is not None and global_step > last:
+            self._stop_torch_profiler()
+
+    def _stop_torch_profiler(self):
+        if self.torch_profiler is None:
+            return
+        self.torch_profiler.stop()
+        self.torch_profiler = None
+        self.torch_profiler_steps = None  # only once
+        logger.info(f"torch.profiler trace is saved to / torch.profilerの結果を保存しました: {self.torch_profiler_dir}")
+
+    def add_samples(self, num_samples: int):
+        self.interval_samples += num_samples
+
+    def step_end(self) -> Optional[Dict[str, float]]:
+        r"""called at the end of each optimization step, returns the logs every log_every_n_steps steps"""
+        now = time.perf_counter()
+        if self.step_start is not None:
+            self.record("step", self.step_start, now)
+        if self.interval_start is None:
+            self.interval_start = self.step_start if self.step_start is not None else now
+        self.step_start = None
+        self.interval_steps += 1
+
+        if self.interval_steps < self.log_every_n_steps:
+            return None
+        return self._flush(now)
+
+    def _flush(self, now: float) -> Dict[str, float]:
+        with self.lock:
+            spans, totals = self.spans, self.span_totals
+            self.spans, self.span_totals = {}, {}
+            if self.trace is not None:
+                self.trace.flush()
+
+        elapsed = max(now - self.interval_start, 1e-9)
+        logs = {
+            "perf/samples_per_sec": self.interval_samples / elapsed,
+            "perf/steps_per_sec": self.interval_steps / elapsed,
+            "perf/data_stall_ratio": totals.get("data", 0.0) / elapsed,
+        }
+        for name, durations in spans.items():
+            p50, p90, p99 = np.percentile(np.array(durations) * 1000, [50, 90, 99])
+            logs[f"perf/{name}_ms_p50"] = float(p50)
+            logs[f"perf/{name}_ms_p90"] = float(p90)
+            logs[f"perf/{name}_ms_p99"] = float(p99)
+            if name != "step":
+                logs[f"perf/{name}_ratio"] = totals[name] / elapsed
+
+        self.interval_start = now
+        self.interval_steps = 0
+        self.interval_samples = 0
+        return logs
+
+    def get_span_totals(self) -> Dict[str, Tuple[int, float]]:
+        r"""{name: (count, total seconds)} of the spans since the last logs"""
+        with self.lock:
+            return {name: (len(durations), self.span_totals[name]) for name, durations in self.spans.items()}
+
+    def close(self):
+        self._stop_torch_profiler()
+        with self.lock:
+            if self.trace is not None:
+                self.trace.write("\n]}\n")
+                self.trace.close()
+                self.trace = None
+
+
+# profiler of the current training, spans are no-op if not set
+_profiler: Optional[StepProfiler] = None
+
+
+def set_profiler(profiler: Optional[StepProfiler]):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler() -> Optional[StepProfiler]:
+    return _profiler
+
+
+def span(name: str):
+    r"""context manager to measure the span with the current profiler, does nothing if profiling is disabled"""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.span(name)
+
+
+def record(name: str, start: float, end: float):
+    r"""record the span measured by time.perf_counter() with the current profiler, does nothing if profiling is disabled"""
+    if _profiler is not None:
+        _profiler.record(name, start, end)
+
+
+def parse_step_range(value: str) -> Tuple[int, int]:
+    r"""'10-15' -> (10, 15), '10' -> (10, 10)"""
+    if "-" in value:
+        first, last = value.split("-", 1)
+        return int(first), int(last)
+    return int(value), int(value)
+
+
+def create_profiler(
+    args: argparse.Namespace, device: Optional[torch.device] = None, is_main_process: bool = True
+) -> Optional[StepProfiler]:
+    r"""
+    create StepProfiler from the arguments of add_step_profiler_arguments and set it as current, None if disabled.
+    the trace file and torch.profiler are only for the main process.
+    """
+    torch_profiler_steps = args.torch_profiler_steps
+    if not args.profile_steps and torch_profiler_steps is None:
+        return None
+
+    torch_profiler_dir = os.path.join(args.logging_dir or args.output_dir or ".", "torch_profiler")
+    profiler = StepProfiler(
+        log_every_n_steps=args.profile_log_every_n_steps,
+        trace_file=args.profile_trace_file if args.profile_steps and is_main_process else None,
+        sync_device=device if args.profile_sync_device else None,
+        torch_profiler_steps=parse_step_range(torch_profiler_steps) if torch_profiler_steps and is_main_process else None,
+        torch_profiler_dir=torch_profiler_dir,
+    )
+    set_profiler(profiler)
+    return profiler
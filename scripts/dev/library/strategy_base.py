@@ -12,7 +12,9 @@ from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextModelWithProjecti
 # TODO remove circular import by moving ImageInfo to a separate file
 # from library.train_util import ImageInfo
 
-from library.utils import setup_logging
+from library import cache_manifest
+from library.latents_store import LATENTS_CACHE_BACKENDS, LatentsStore, get_latents_store
+from library.utils import BoundedThreadPoolExecutor, setup_logging
 
 setup_logging()
 import logging
@@ -73,6 +75,19 @@ class TokenizeStrategy:
     def tokenize(self, text: Union[str, List[str]]) -> List[torch.Tensor]:
         raise NotImplementedError
 
+    def get_cache_key(self) -> str:
+        """
+        returns a string which identifies the tokenizers and max lengths of this strategy, for caching the token ids.
+        """
+        key = [self.__class__.__name__]
+        for name, value in sorted(vars(self).items()):
+            if hasattr(value, "name_or_path"):
+                # tokenizer: added tokens (e.g. textual inversion) change the ids
+                key.append(f"{name}={value.name_or_path}:{len(value)}:{value.model_max_length}")
+            elif isinstance(value, (bool, int, float, str)) or value is None:
+                key.append(f"{name}={value}")
+        return ",".join(key)
+
     def tokenize_with_weights(self, text: Union[str, List[str]]) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
         """
         returns: [tokens1, tokens2, ...], [weights1, weights2, ...]
@@ -371,6 +386,20 @@ class TextEncoderOutputsCachingStrategy:
     def is_disk_cached_outputs_expected(self, npz_path: str) -> bool:
         raise NotImplementedError
 
+    def get_outputs_npz_record(self, npz_path: str) -> dict:
+        """
+        returns {"keys": {key: [shape, dtype]}, "params": {key: scalar}} of npz from the cache manifest, loads npz only if needed
+        """
+        try:
+            return cache_manifest.get_npz_record(npz_path)
+        except Exception as e:
+            logger.error(f"Error loading file: {npz_path}")
+            raise e
+
+    def save_outputs_npz(self, npz_path: str, **arrays):
+        np.savez(npz_path, **arrays)
+        cache_manifest.update_npz_record(npz_path, arrays)
+
     def cache_batch_outputs(
         self, tokenize_strategy: TokenizeStrategy, models: List[Any], text_encoding_strategy: TextEncodingStrategy, batch: List
     ):
@@ -382,10 +411,19 @@ class LatentsCachingStrategy:
 
     _strategy = None  # strategy instance: actual strategy class
 
-    def __init__(self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool) -> None:
+    def __init__(
+        self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool, cache_backend: str = "npz"
+    ) -> None:
+        assert cache_backend in LATENTS_CACHE_BACKENDS, f"unknown latents cache backend: {cache_backend}"
         self._cache_to_disk = cache_to_disk
         self._batch_size = batch_size
         self.skip_disk_cache_validity_check = skip_disk_cache_validity_check
+        self._cache_backend = cache_backend
+
+        # workers for the caching pipeline: image decode/resize -> VAE encode -> disk write
+        self.num_decode_workers: Optional[int] = None  # None: decided by the dataset
+        self.num_write_workers: int = 1  # 0: write synchronously
+        self._writer: Optional[BoundedThreadPoolExecutor] = None
 
     @classmethod
     def set_strategy(cls, strategy):
@@ -405,10 +443,46 @@ class LatentsCachingStrategy:
     def batch_size(self):
         return self._batch_size
 
+    @property
+    def cache_backend(self):
+        return self._cache_backend
+
+    def set_caching_workers(self, num_decode_workers: Optional[int], num_write_workers: int):
+        self.num_decode_workers = num_decode_workers
+        self.num_write_workers = num_write_workers
+
+    def _save_latents_async(self, *args):
+        if not self.cache_to_disk or self.num_write_workers <= 0:
+            self.save_latents_to_disk(*args)
+            return
+
+        if self._writer is None:
+            # the latents store appends to shared files, so it is written by a single thread
+            num_workers = 1 if self._cache_backend == "store" else self.num_write_workers
+            self._writer = BoundedThreadPoolExecutor(num_workers, max(num_workers, self.batch_size) * 2)
+        self._writer.submit(self.save_latents_to_disk, *args)
+
+    def wait_for_pending_writes(self):
+        r"""wait until all latents are written. must be called after caching, the writer cannot be pickled to DataLoader workers"""
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.shutdown(wait=True)
+
     @property
     def cache_suffix(self):
         raise NotImplementedError
 
+    def _get_latents_store(self, npz_path: str) -> Tuple[Optional[LatentsStore], str]:
+        r"""
+        returns the store and the key for npz_path if the store backend is used, otherwise (None, npz_path).
+        existing npz files (e.g. cached before switching the backend, or fine tuning npz) are still read as npz.
+        """
+        if self._cache_backend != "store" or os.path.exists(npz_path):
+            return None, npz_path
+        # e.g. "image_dir/latents_store_flux", key is the file name of npz_path which includes the image size
+        store_dir = os.path.join(os.path.dirname(npz_path), "latents_store" + os.path.splitext(self.cache_suffix)[0])
+        return get_latents_store(store_dir), os.path.basename(npz_path)
+
     def get_image_size_from_disk_cache_path(self, absolute_path: str, npz_path: str) -> Tuple[Optional[int], Optional[int]]:
         w, h = os.path.splitext(npz_path)[0].split("_")[-2].split("x")
         return int(w), int(h)
@@ -435,23 +509,31 @@ class LatentsCachingStrategy:
     ):
         if not self.cache_to_disk:
             return False
+
+        expected_latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
+
+        store, key = self._get_latents_store(npz_path)
+        if store is not None:
+            # in-memory index lookup, no need to skip the validity check
+            return store.is_cached(key, expected_latents_size if multi_resolution else None, flip_aug, alpha_mask)
+
         if not os.path.exists(npz_path):
             return False
         if self.skip_disk_cache_validity_check:
             return True
-
-        expected_latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
+        if cache_manifest.is_source_changed(npz_path):
+            return False  # the image is changed after caching, re-create the latents
 
         # e.g. "_32x64", HxW
         key_reso_suffix = f"_{expected_latents_size[0]}x{expected_latents_size[1]}" if multi_resolution else ""
 
         try:
-            npz = np.load(npz_path)
-            if "latents" + key_reso_suffix not in npz:
+            keys = cache_manifest.get_npz_record(npz_path)["keys"]  # npz is loaded only if the manifest is stale
+            if "latents" + key_reso_suffix not in keys:
                 return False
-            if flip_aug and "latents_flipped" + key_reso_suffix not in npz:
+            if flip_aug and "latents_flipped" + key_reso_suffix not in keys:
                 return False
-            if alpha_mask and "alpha_mask" + key_reso_suffix not in npz:
+            if alpha_mask and "alpha_mask" + key_reso_suffix not in keys:
                 return False
         except Exception as e:
             logger.error(f"Error loading file: {npz_path}")
@@ -503,7 +585,7 @@ class LatentsCachingStrategy:
             key_reso_suffix = f"_{latents_size[0]}x{latents_size[1]}" if multi_resolution else ""  # e.g. "_32x64", HxW
 
             if self.cache_to_disk:
-                self.save_latents_to_disk(
+                self._save_latents_async(
                     info.latents_npz, latents, original_size, crop_ltrb, flipped_latent, alpha_mask, key_reso_suffix
                 )
             else:
@@ -531,6 +613,10 @@ class LatentsCachingStrategy:
             latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
             key_reso_suffix = f"_{latents_size[0]}x{latents_size[1]}"  # e.g. "_32x64", HxW
 
+        store, key = self._get_latents_store(npz_path)
+        if store is not None:
+            return store.load(key, None if latents_stride is None else latents_size)
+
         npz = np.load(npz_path)
         if "latents" + key_reso_suffix not in npz:
             raise ValueError(f"latents{key_reso_suffix} not found in {npz_path}")
@@ -552,9 +638,23 @@ class LatentsCachingStrategy:
         alpha_mask=None,
         key_reso_suffix="",
     ):
+        store, key = self._get_latents_store(npz_path)
+        if store is not None:
+            # key_reso_suffix is not needed, the store always records the resolution of the latents
+            store.save(
+                key,
+                latents_tensor.float().cpu().numpy(),
+                original_size,
+                crop_ltrb,
+                None if flipped_latents_tensor is None else flipped_latents_tensor.float().cpu().numpy(),
+                None if alpha_mask is None else alpha_mask.float().cpu().numpy(),
+            )
+            return
+
         kwargs = {}
 
-        if os.path.exists(npz_path):
+        # if the image is changed, the latents of the other resolutions in the npz are outdated too: do not keep them
+        if os.path.exists(npz_path) and not cache_manifest.is_source_changed(npz_path):
             # load existing npz and update it
             npz = np.load(npz_path)
             for key in npz.files:
@@ -567,4 +667,15 @@ class LatentsCachingStrategy:
             kwargs["latents_flipped" + key_reso_suffix] = flipped_latents_tensor.float().cpu().numpy()
         if alpha_mask is not None:
             kwargs["alpha_mask" + key_reso_suffix] = alpha_mask.float().cpu().numpy()
-        np.savez(npz_path, **kwargs)
+
+        # write to a temporary file and rename, so an interrupted caching does not leave a broken npz
+        tmp_path = f"{npz_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **kwargs)
+            os.replace(tmp_path, npz_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        cache_manifest.update_npz_record(npz_path, kwargs)
@@ -112,24 +112,21 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         if self.skip_disk_cache_validity_check:
             return True
 
-        try:
-            npz = np.load(npz_path)
-            if "l_pooled" not in npz:
-                return False
-            if "t5_out" not in npz:
-                return False
-            if "txt_ids" not in npz:
-                return False
-            if "t5_attn_mask" not in npz:
-                return False
-            if "apply_t5_attn_mask" not in npz:
-                return False
-            npz_apply_t5_attn_mask = npz["apply_t5_attn_mask"]
-            if npz_apply_t5_attn_mask != self.apply_t5_attn_mask:
-                return False
-        except Exception as e:
-            logger.error(f"Error loading file: {npz_path}")
-            raise e
+        record = self.get_outputs_npz_record(npz_path)
+        keys = record["keys"]
+        if "l_pooled" not in keys:
+            return False
+        if "t5_out" not in keys:
+            return False
+        if "txt_ids" not in keys:
+            return False
+        if "t5_attn_mask" not in keys:
+            return False
+        if "apply_t5_attn_mask" not in keys:
+            return False
+        npz_apply_t5_attn_mask = record["params"].get("apply_t5_attn_mask")
+        if npz_apply_t5_attn_mask != self.apply_t5_attn_mask:
+            return False
 
         return True
 
@@ -181,7 +178,7 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
             apply_t5_attn_mask_i = self.apply_t5_attn_mask
 
             if self.cache_to_disk:
-                np.savez(
+                self.save_outputs_npz(
                     info.text_encoder_outputs_npz,
                     l_pooled=l_pooled_i,
                     t5_out=t5_out_i,
@@ -197,8 +194,10 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
 class FluxLatentsCachingStrategy(LatentsCachingStrategy):
     FLUX_LATENTS_NPZ_SUFFIX = "_flux.npz"
 
-    def __init__(self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool) -> None:
-        super().__init__(cache_to_disk, batch_size, skip_disk_cache_validity_check)
+    def __init__(
+        self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool, cache_backend: str = "npz"
+    ) -> None:
+        super().__init__(cache_to_disk, batch_size, skip_disk_cache_validity_check, cache_backend)
 
     @property
     def cache_suffix(self) -> str:
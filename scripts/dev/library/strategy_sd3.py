@@ -280,31 +280,28 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         if self.skip_disk_cache_validity_check:
             return True
 
-        try:
-            npz = np.load(npz_path)
-            if "lg_out" not in npz:
-                return False
-            if "lg_pooled" not in npz:
-                return False
-            if "clip_l_attn_mask" not in npz or "clip_g_attn_mask" not in npz:  # necessary even if not used
-                return False
-            if "apply_lg_attn_mask" not in npz:
-                return False
-            if "t5_out" not in npz:
-                return False
-            if "t5_attn_mask" not in npz:
-                return False
-            npz_apply_lg_attn_mask = npz["apply_lg_attn_mask"]
-            if npz_apply_lg_attn_mask != self.apply_lg_attn_mask:
-                return False
-            if "apply_t5_attn_mask" not in npz:
-                return False
-            npz_apply_t5_attn_mask = npz["apply_t5_attn_mask"]
-            if npz_apply_t5_attn_mask != self.apply_t5_attn_mask:
-                return False
-        except Exception as e:
-            logger.error(f"Error loading file: {npz_path}")
-            raise e
+        record = self.get_outputs_npz_record(npz_path)
+        keys = record["keys"]
+        if "lg_out" not in keys:
+            return False
+        if "lg_pooled" not in keys:
+            return False
+        if "clip_l_attn_mask" not in keys or "clip_g_attn_mask" not in keys:  # necessary even if not used
+            return False
+        if "apply_lg_attn_mask" not in keys:
+            return False
+        if "t5_out" not in keys:
+            return False
+        if "t5_attn_mask" not in keys:
+            return False
+        npz_apply_lg_attn_mask = record["params"].get("apply_lg_attn_mask")
+        if npz_apply_lg_attn_mask != self.apply_lg_attn_mask:
+            return False
+        if "apply_t5_attn_mask" not in keys:
+            return False
+        npz_apply_t5_attn_mask = record["params"].get("apply_t5_attn_mask")
+        if npz_apply_t5_attn_mask != self.apply_t5_attn_mask:
+            return False
 
         return True
 
@@ -365,7 +362,7 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
             apply_t5_attn_mask = self.apply_t5_attn_mask
 
             if self.cache_to_disk:
-                np.savez(
+                self.save_outputs_npz(
                     info.text_encoder_outputs_npz,
                     lg_out=lg_out_i,
                     lg_pooled=lg_pooled_i,
@@ -384,8 +381,10 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
 class Sd3LatentsCachingStrategy(LatentsCachingStrategy):
     SD3_LATENTS_NPZ_SUFFIX = "_sd3.npz"
 
-    def __init__(self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool) -> None:
-        super().__init__(cache_to_disk, batch_size, skip_disk_cache_validity_check)
+    def __init__(
+        self, cache_to_disk: bool, batch_size: int, skip_disk_cache_validity_check: bool, cache_backend: str = "npz"
+    ) -> None:
+        super().__init__(cache_to_disk, batch_size, skip_disk_cache_validity_check, cache_backend)
 
     @property
     def cache_suffix(self) -> str:
@@ -243,13 +243,9 @@ class SdxlTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         if self.skip_disk_cache_validity_check:
             return True
 
-        try:
-            npz = np.load(npz_path)
-            if "hidden_state1" not in npz or "hidden_state2" not in npz or "pool2" not in npz:
-                return False
-        except Exception as e:
-            logger.error(f"Error loading file: {npz_path}")
-            raise e
+        keys = self.get_outputs_npz_record(npz_path)["keys"]
+        if "hidden_state1" not in keys or "hidden_state2" not in keys or "pool2" not in keys:
+            return False
 
         return True
 
@@ -296,7 +292,7 @@ class SdxlTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
             pool2_i = pool2[i]
 
             if self.cache_to_disk:
-                np.savez(
+                self.save_outputs_npz(
                     info.text_encoder_outputs_npz,
                     hidden_state1=hidden_state1_i,
                     hidden_state2=hidden_state2_i,
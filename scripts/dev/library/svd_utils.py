@@ -0,0 +1,266 @@
+# low rank factorization for the LoRA extract / resize / svd merge tools
+# exact (full SVD) or fast (randomized SVD), modules of the same shape are batched and processed in a thread pool
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+SVD_MODES = ["exact", "fast"]
+
+# matrix, or (up, down) factors of the matrix (up @ down)
+Matrix = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
+
+
+def add_svd_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--svd_mode",
+        type=str,
+        default="exact",
+        choices=SVD_MODES,
+        help="exact: full SVD, fast: randomized SVD of the target rank (much faster for low ranks, approximated)"
+        " / exact: 通常のSVD、fast: 指定rankのランダム化SVD（低rankでは大幅に高速、近似）",
+    )
+    parser.add_argument(
+        "--svd_oversample",
+        type=int,
+        default=8,
+        help="oversampling for fast SVD (default 8) / fast SVDのオーバーサンプリング数（デフォルト8）",
+    )
+    parser.add_argument(
+        "--svd_niter",
+        type=int,
+        default=2,
+        help="power iterations for fast SVD, more is more accurate (default 2) / fast SVDのべき乗反復回数、多いほど正確（デフォルト2）",
+    )
+    parser.add_argument(
+        "--svd_workers",
+        type=int,
+        default=None,
+        help="number of threads for SVD, default is 1 for GPU, up to 4 for CPU / SVDのスレッド数、省略時はGPUで1、CPUで最大4",
+    )
+    parser.add_argument(
+        "--svd_verify",
+        action="store_true",
+        help="calculate exact singular values also and report the error of fast SVD against exact one (slow)"
+        " / 厳密な特異値も計算し、fast SVDの誤差を厳密な値と比較して表示する（低速）",
+    )
+
+
+def randomized_svd(
+    A: torch.Tensor, rank: int, oversample: int = 8, niter: int = 2, generator: Optional[torch.Generator] = None
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    r"""
+    truncated SVD of batched matrices A (b, m, n) by randomized range finder with power iterations (Halko et al.).
+    returns U (b, m, rank), S (b, rank), Vh (b, rank, n)
+    """
+    m, n = A.shape[-2:]
+    transpose = m < n
+    if transpose:
+        A = A.transpose(-2, -1)
+        m, n = n, m
+
+    k = min(rank + oversample, n)
+    if k >= n:
+        # no gain from sampling
+        U, S, Vh = torch.linalg.svd(A, full_matrices=False)
+    else:
+        omega = torch.randn((A.shape[0], n, k), dtype=A.dtype, device=A.device, generator=generator)
+        Q = torch.linalg.qr(A @ omega).Q
+        for _ in range(niter):
+            # re-orthonormalize every step to keep small singular values
+            Q = torch.linalg.qr(A.transpose(-2, -1) @ Q).Q
+            Q = torch.linalg.qr(A @ Q).Q
+        Ub, S, Vh = torch.linalg.svd(Q.transpose(-2, -1) @ A, full_matrices=False)
+        U = Q @ Ub
+
+    U, S, Vh = U[..., :rank], S[..., :rank], Vh[..., :rank, :]
+    if transpose:
+        U, Vh = Vh.transpose(-2, -1), U.transpose(-2, -1)
+    return U, S, Vh
+
+
+def svd_from_factors(up: torch.Tensor, down: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    r"""
+    exact thin SVD of batched up @ down (b, m, r) @ (b, r, n) without making the m x n matrix: QR of both factors and
+    SVD of the small r x r core. singular values beyond r are zero and omitted.
+    """
+    Qu, Ru = torch.linalg.qr(up)
+    Qd, Rd = torch.linalg.qr(down.transpose(-2, -1))
+    Uc, S, Vhc = torch.linalg.svd(Ru @ Rd.transpose(-2, -1), full_matrices=False)
+    return Qu @ Uc, S, Vhc @ Qd.transpose(-2, -1)
+
+
+def _relative_error(norm_sq: torch.Tensor, S: torch.Tensor) -> torch.Tensor:
+    # ||A - U S Vh||_F / ||A||_F = sqrt(||A||^2 - sum(S^2)) / ||A|| for orthonormal U, Vh
+    residual = (norm_sq - S.pow(2).sum(dim=-1)).clamp(min=0)
+    return torch.where(norm_sq > 0, (residual / norm_sq.clamp(min=1e-30)).sqrt(), torch.zeros_like(norm_sq))
+
+
+class LowRankDecomposer:
+    r"""
+    Decompose many matrices into truncated U, S, Vh.
+
+    Matrices with the same shape and rank are stacked into one batched call (up to `max_batch_size` matrices and
+    `max_batch_elements` elements), and batches are processed in a thread pool. Results are yielded in the order
+    of the batches, with relative Frobenius error of the reconstruction. With `verify`, singular values are also
+    computed exactly to report how far the fast SVD is from the optimal error of the same rank.
+    """
+
+    def __init__(
+        self,
+        mode: str = "exact",
+        device: Optional[Union[str, torch.device]] = None,
+        oversample: int = 8,
+        niter: int = 2,
+        num_workers: Optional[int] = None,
+        verify: bool = False,
+        max_batch_size: int = 8,
+        max_batch_elements: int = 2**26,
+        seed: int = 0,
+    ):
+        assert mode in SVD_MODES, f"unknown svd mode / 不明なSVDモード: {mode}"
+        self.mode = mode
+        self.device = torch.device(device) if device else torch.device("cpu")
+        self.oversample = oversample
+        self.niter = niter
+        if num_workers is None:
+            num_workers = 1 if self.device.type != "cpu" else max(1, min(4, os.cpu_count() or 1))
+        self.num_workers = num_workers
+        self.verify = verify
+        self.max_batch_size = max_batch_size
+        self.max_batch_elements = max_batch_elements
+        self.seed = seed
+
+        self.errors: List[float] = []
+        self.exact_errors: List[float] = []
+        self.excess_errors: List[float] = []  # error - exact error, for verify
+
+    def _decompose_batch(self, batch: List[Tuple[str, Matrix, Optional[int]]], batch_index: int):
+        names = [name for name, _, _ in batch]
+        rank = batch[0][2]
+
+        with torch.no_grad():
+            if isinstance(batch[0][1], tuple):
+                up = torch.stack([m[0] for _, m, _ in batch]).to(self.device, dtype=torch.float)
+                down = torch.stack([m[1] for _, m, _ in batch]).to(self.device, dtype=torch.float)
+                U, S, Vh = svd_from_factors(up, down)
+                norm_sq = S.pow(2).sum(dim=-1)  # exact
+                A = None
+                del up, down
+            else:
+                A = torch.stack([m for _, m, _ in batch]).to(self.device, dtype=torch.float)
+                norm_sq = A.pow(2).sum(dim=(-2, -1))
+                if self.mode == "fast" and rank is not None:
+                    generator = torch.Generator(device=self.device).manual_seed(self.seed + batch_index)
+                    U, S, Vh = randomized_svd(A, rank, self.oversample, self.niter, generator)
+                else:
+                    U, S, Vh = torch.linalg.svd(A, full_matrices=False)
+
+            if rank is not None:
+                U, S, Vh = U[..., :rank], S[..., :rank], Vh[..., :rank, :]
+                errors = _relative_error(norm_sq, S).tolist()
+                exact_errors = [None] * len(batch)
+                if self.verify and A is not None:
+                    exact_S = torch.linalg.svdvals(A)[..., :rank]
+                    exact_errors = _relative_error(norm_sq, exact_S).tolist()
+            else:
+                errors = exact_errors = [None] * len(batch)
+            del A
+
+            U, S, Vh = U.cpu(), S.cpu(), Vh.cpu()
+
+        return [
+            (name, U[i], S[i], Vh[i], {"rel_error": errors[i], "exact_rel_error": exact_errors[i]}) for i, name in enumerate(names)
+        ]
+
+    def decompose(
+        self, items: Iterable[Tuple[str, Matrix, Optional[int]]]
+    ) -> Iterator[Tuple[str, torch.Tensor, torch.Tensor, torch.Tensor, Dict[str, Optional[float]]]]:
+        r"""
+        items: (name, 2D matrix or (up, down) factors, rank or None for all singular values).
+        yields (name, U, S, Vh, info) on CPU. items are consumed lazily, so they can be a generator.
+        """
+        pending: Dict[Tuple, List] = {}  # (shapes, rank) -> items to batch
+        pending_elements: Dict[Tuple, int] = {}
+        futures = deque()
+        batch_index = 0
+
+        def result_of(future):
+            results = future.result()
+            for name, U, S, Vh, info in results:
+                if info["rel_error"] is not None:
+                    self.errors.append(info["rel_error"])
+                if info["exact_rel_error"] is not None:
+                    self.exact_errors.append(info["exact_rel_error"])
+                    self.excess_errors.append(info["rel_error"] - info["exact_rel_error"])
+            return results
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+
+            def submit(key):
+                nonlocal batch_index
+                futures.append(executor.submit(self._decompose_batch, pending.pop(key), batch_index))
+                pending_elements.pop(key)
+                batch_index += 1
+
+            for name, mat, rank in items:
+                if isinstance(mat, tuple):
+                    key = (tuple(mat[0].shape), tuple(mat[1].shape), rank)
+                    elements = mat[0].numel() + mat[1].numel()
+                else:
+                    assert mat.dim() == 2, f"matrix must be 2D / 行列は2次元である必要があります: {name} {list(mat.shape)}"
+                    key = (tuple(mat.shape), rank)
+                    elements = mat.numel()
+
+                pending.setdefault(key, []).append((name, mat, rank))
+                pending_elements[key] = pending_elements.get(key, 0) + elements
+                if len(pending[key]) >= self.max_batch_size or pending_elements[key] >= self.max_batch_elements:
+                    submit(key)
+
+                # bound the number of batches in flight, to bound the memory
+                while len(futures) > self.num_workers * 2:
+                    yield from result_of(futures.popleft())
+
+            for key in list(pending.keys()):
+                submit(key)
+            while futures:
+                yield from result_of(futures.popleft())
+
+    def log_summary(self):
+        if not self.errors:
+            return
+        errors = torch.tensor(self.errors)
+        logger.info(
+            f"SVD ({self.mode}) relative error / SVDの相対誤差: mean {errors.mean().item():.4f}, max {errors.max().item():.4f}"
+        )
+        if self.exact_errors:
+            exact_errors = torch.tensor(self.exact_errors)
+            excess = torch.tensor(self.excess_errors)
+            logger.info(
+                f"error against exact SVD / 厳密なSVDとの誤差の差: mean {excess.mean().item():.6f}, max {excess.max().item():.6f}"
+                f" (exact error mean {exact_errors.mean().item():.4f})"
+            )
+
+
+def create_decomposer(args: argparse.Namespace, device: Optional[Union[str, torch.device]] = None) -> LowRankDecomposer:
+    r"""create LowRankDecomposer from the arguments of add_svd_arguments"""
+    return LowRankDecomposer(
+        mode=args.svd_mode,
+        device=device,
+        oversample=args.svd_oversample,
+        niter=args.svd_niter,
+        num_workers=args.svd_workers,
+        verify=args.svd_verify,
+    )
@@ -0,0 +1,124 @@
+# cache of token ids for deterministic captions, shared by the dataloader workers with a memory-mapped file
+
+import atexit
+import hashlib
+import os
+import tempfile
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class TokenIdCache:
+    r"""
+    Token ids of processed captions, keyed by (caption, tokenizers and max lengths of the strategy).
+
+    The captions which can be cached are registered in the main process, and each caption has a slot in a memory-mapped
+    file. The slots are filled lazily by whichever process tokenizes the caption first, so the dataloader workers share the
+    results without tokenizing the same caption every epoch. Other captions (e.g. shuffled) are tokenized as usual.
+
+    Hits, misses and bypasses are counted in the file too, so they are the totals of all workers (approximately, the
+    counters are not atomic).
+    """
+
+    STAT_HITS = 0
+    STAT_MISSES = 1
+    STAT_BYPASSED = 2
+
+    def __init__(self, captions: Sequence[str], tokenize_strategy, strategy_key: str):
+        self.strategy_key = strategy_key
+        self.slots: Dict[str, int] = {}
+        for caption in captions:
+            if caption not in self.slots:
+                self.slots[caption] = len(self.slots)
+        num_slots = len(self.slots)
+
+        # shapes of token ids for each tokenizer, the length is fixed by padding
+        sample = tokenize_strategy.tokenize(next(iter(self.slots.keys())) if num_slots > 0 else "")
+        self.shapes = [tuple(ids[0].shape) for ids in sample]
+
+        # layout: flags (uint8, num_slots), stats (int64, 3), token ids (int32, num_slots x shape) for each tokenizer
+        self.layout = []
+        offset = 0
+        for dtype, shape in [(np.uint8, (max(1, num_slots),)), (np.int64, (3,))] + [
+            (np.int32, (max(1, num_slots),) + shape) for shape in self.shapes
+        ]:
+            offset = _align(offset)
+            self.layout.append((offset, dtype, shape))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        name_hash = hashlib.sha256(strategy_key.encode("utf-8")).hexdigest()[:8]
+        fd, self.path = tempfile.mkstemp(prefix=f"token_ids_{name_hash}_", suffix=".bin")
+        with os.fdopen(fd, "wb") as f:
+            f.truncate(offset)  # sparse, filled with zero
+
+        self.owner_pid = os.getpid()
+        self.pid = None
+        self.arrays = None
+        atexit.register(self.close)
+
+        logger.info(f"token id cache: {num_slots} captions / トークンIDキャッシュ: {num_slots}キャプション")
+
+    def __getstate__(self):
+        # memmaps are reopened in each worker process
+        state = self.__dict__.copy()
+        state["pid"] = None
+        state["arrays"] = None
+        return state
+
+    def _get_arrays(self) -> List[np.memmap]:
+        if self.arrays is None or self.pid != os.getpid():
+            self.arrays = [np.memmap(self.path, dtype=dtype, mode="r+", offset=offset, shape=shape) for offset, dtype, shape in self.layout]
+            self.pid = os.getpid()
+        return self.arrays
+
+    def count_bypassed(self):
+        self._get_arrays()[1][self.STAT_BYPASSED] += 1
+
+    def tokenize(self, tokenize_strategy, caption: str) -> List[torch.Tensor]:
+        r"""token ids without batch dimension, same as `[ids[0] for ids in tokenize_strategy.tokenize(caption)]`"""
+        arrays = self._get_arrays()
+        flags, stats, token_arrays = arrays[0], arrays[1], arrays[2:]
+
+        slot = self.slots.get(caption)
+        if slot is not None and flags[slot]:
+            stats[self.STAT_HITS] += 1
+            return [torch.from_numpy(token_array[slot].astype(np.int64)) for token_array in token_arrays]
+
+        stats[self.STAT_MISSES] += 1
+        input_ids = [ids[0] for ids in tokenize_strategy.tokenize(caption)]
+        if slot is not None and [tuple(ids.shape) for ids in input_ids] == self.shapes:
+            for token_array, ids in zip(token_arrays, input_ids):
+                token_array[slot] = ids.numpy()
+            flags[slot] = 1  # set after the ids are written
+        return input_ids
+
+    def get_stats(self) -> Dict[str, float]:
+        hits, misses, bypassed = (int(v) for v in self._get_arrays()[1])
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "bypassed": bypassed,
+            "hit_rate": hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def close(self):
+        self.arrays = None
+        if os.getpid() == self.owner_pid and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass  # still opened on Windows
@@ -3,8 +3,10 @@
 import argparse
 import ast
 import asyncio
+import collections
 from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
+from collections import deque
 import importlib
 import json
 import logging
@@ -13,7 +15,7 @@ import re
 import shutil
 import time
 import typing
-from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
 from accelerate import Accelerator, InitProcessGroupKwargs, DistributedDataParallelKwargs, PartialState
 import glob
 import math
@@ -31,6 +33,7 @@ from packaging.version import Version
 
 import torch
 from library.device_utils import init_ipex, clean_memory_on_device
+from library import cache_manifest
 from library.strategy_base import LatentsCachingStrategy, TokenizeStrategy, TextEncoderOutputsCachingStrategy, TextEncodingStrategy
 
 init_ipex()
@@ -74,7 +77,14 @@ import library.model_util as model_util
 import library.huggingface_util as huggingface_util
 import library.sai_model_spec as sai_model_spec
 import library.deepspeed_utils as deepspeed_utils
-from library.utils import setup_logging, pil_resize
+from library.image_size_cache import ImageSizeCache, get_image_size
+from library.image_registry import ImageInfo, ImageRegistry
+from library.token_id_cache import TokenIdCache
+from library.caption_processor import CaptionProcessor, dropout_tags
+from library import step_profiler
+from library import sample_engine
+from library import metadata_util
+from library.utils import setup_logging, pil_resize, MemoryEfficientSafeOpen, build_safetensors_header, safetensors_tensor_bytes
 
 setup_logging()
 import logging
@@ -176,37 +186,6 @@ def split_train_val(
         return paths[split:], sizes[split:]
 
 
-class ImageInfo:
-    def __init__(self, image_key: str, num_repeats: int, caption: str, is_reg: bool, absolute_path: str) -> None:
-        self.image_key: str = image_key
-        self.num_repeats: int = num_repeats
-        self.caption: str = caption
-        self.is_reg: bool = is_reg
-        self.absolute_path: str = absolute_path
-        self.image_size: Tuple[int, int] = None
-        self.resized_size: Tuple[int, int] = None
-        self.bucket_reso: Tuple[int, int] = None
-        self.latents: Optional[torch.Tensor] = None
-        self.latents_flipped: Optional[torch.Tensor] = None
-        self.latents_npz: Optional[str] = None  # set in cache_latents
-        self.latents_original_size: Optional[Tuple[int, int]] = None  # original image size, not latents size
-        self.latents_crop_ltrb: Optional[Tuple[int, int]] = (
-            None  # crop left top right bottom in original pixel size, not latents size
-        )
-        self.cond_img_path: Optional[str] = None
-        self.image: Optional[Image.Image] = None  # optional, original PIL Image
-        self.text_encoder_outputs_npz: Optional[str] = None  # set in cache_text_encoder_outputs
-
-        # new
-        self.text_encoder_outputs: Optional[List[torch.Tensor]] = None
-        # old
-        self.text_encoder_outputs1: Optional[torch.Tensor] = None
-        self.text_encoder_outputs2: Optional[torch.Tensor] = None
-        self.text_encoder_pool2: Optional[torch.Tensor] = None
-
-        self.alpha_mask: Optional[torch.Tensor] = None  # alpha mask can be flipped in runtime
-
-
 class BucketManager:
     def __init__(self, no_upscale, max_reso, min_size, max_size, reso_steps) -> None:
         if max_size is not None:
@@ -229,15 +208,29 @@ class BucketManager:
 
         self.resos = []
         self.reso_to_id = {}
-        self.buckets = []  # 前処理時は (image_key, image, original size, crop left/top)、学習時は image_key
+        self.buckets = []  # 前処理時は (image_key, image, original size, crop left/top)、学習時は ImageRegistry の index の np.ndarray
 
     def add_image(self, reso, image_or_info):
         bucket_id = self.reso_to_id[reso]
         self.buckets[bucket_id].append(image_or_info)
 
+    def set_bucket_indices(self, bucket_ids: np.ndarray, num_repeats: np.ndarray):
+        r"""fill the buckets with the indices of the images, image i is added to bucket_ids[i] num_repeats[i] times in order"""
+        indices = np.repeat(np.arange(len(bucket_ids), dtype=np.int32), num_repeats)
+        entry_bucket_ids = np.repeat(bucket_ids, num_repeats)
+        order = np.argsort(entry_bucket_ids, kind="stable")
+        counts = np.bincount(entry_bucket_ids, minlength=len(self.buckets))
+        self.buckets = np.split(indices[order], np.cumsum(counts)[:-1]) if len(counts) > 0 else []
+
     def shuffle(self):
-        for bucket in self.buckets:
-            random.shuffle(bucket)
+        for i, bucket in enumerate(self.buckets):
+            if isinstance(bucket, np.ndarray):
+                # same permutation as random.shuffle of a list
+                permutation = list(range(len(bucket)))
+                random.shuffle(permutation)
+                self.buckets[i] = bucket[permutation]
+            else:
+                random.shuffle(bucket)
 
     def sort(self):
         # 解像度順にソートする（表示時、メタデータ格納時の見栄えをよくするためだけ）。bucketsも入れ替えてreso_to_idも振り直す
@@ -339,6 +332,97 @@ class BucketManager:
         ar_error = (reso[0] / reso[1]) - aspect_ratio
         return reso, resized_size, ar_error
 
+    def select_buckets(self, image_widths, image_heights) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        r"""
+        batch version of select_bucket. returns bucket resos (N, 2), resized sizes (N, 2) and ar errors (N,) as arrays.
+        the results and the order of the new buckets are the same as calling select_bucket for each image in order: the
+        same float64 operations are done in the same order, and int(x + 0.5) is floor(x + 0.5) for positive x.
+        """
+        widths = np.asarray(image_widths, dtype=np.int64).reshape(-1)
+        heights = np.asarray(image_heights, dtype=np.int64).reshape(-1)
+        num_images = len(widths)
+        if num_images == 0:
+            return np.zeros((0, 2), dtype=np.int64), np.zeros((0, 2), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+
+        def round_half_up(x: np.ndarray) -> np.ndarray:
+            return np.floor(x + 0.5).astype(np.int64)
+
+        def round_to_steps(x: np.ndarray) -> np.ndarray:
+            x = round_half_up(x)
+            return x - x % self.reso_steps
+
+        # rows with zero division in select_bucket, they are done by select_bucket to raise the same error
+        invalid = (widths <= 0) | (heights <= 0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aspect_ratios = widths / heights
+
+            if not self.no_upscale:
+                predefined_resos = np.array(list(self.predefined_resos), dtype=np.int64).reshape(-1, 2)
+                bucket_resos = np.empty((num_images, 2), dtype=np.int64)
+
+                # same resolution as the image has priority
+                reso_keys = predefined_resos[:, 0] * (1 << 32) + predefined_resos[:, 1]
+                image_keys = widths * (1 << 32) + heights
+                exact = np.isin(image_keys, reso_keys)
+                bucket_resos[exact, 0] = widths[exact]
+                bucket_resos[exact, 1] = heights[exact]
+
+                # otherwise the least aspect ratio error, in chunks to limit the memory of (images, resos) errors
+                not_exact = np.flatnonzero(~exact)
+                chunk_size = max(1, 2**24 // max(1, len(self.predefined_aspect_ratios)))
+                for i in range(0, len(not_exact), chunk_size):
+                    rows = not_exact[i : i + chunk_size]
+                    ar_errors = self.predefined_aspect_ratios[None, :] - aspect_ratios[rows, None]
+                    bucket_resos[rows] = predefined_resos[np.abs(ar_errors).argmin(axis=1)]
+
+                ar_resos = bucket_resos[:, 0] / bucket_resos[:, 1]
+                scales = np.where(aspect_ratios > ar_resos, bucket_resos[:, 1] / heights, bucket_resos[:, 0] / widths)
+                resized_sizes = np.stack([round_half_up(widths * scales), round_half_up(heights * scales)], axis=1)
+            else:
+                resized_sizes = np.stack([widths, heights], axis=1)
+
+                too_large = widths * heights > self.max_area
+                if np.any(too_large):
+                    ar = aspect_ratios[too_large]
+                    resized_width = np.sqrt(self.max_area * ar)
+                    resized_height = self.max_area / resized_width
+                    assert np.all(np.abs(resized_width / resized_height - ar) < 1e-2), "aspect is illegal"
+
+                    b_width_rounded = round_to_steps(resized_width)
+                    b_height_in_wr = round_to_steps(b_width_rounded / ar)
+                    ar_width_rounded = b_width_rounded / b_height_in_wr
+
+                    b_height_rounded = round_to_steps(resized_height)
+                    b_width_in_hr = round_to_steps(b_height_rounded * ar)
+                    ar_height_rounded = b_width_in_hr / b_height_rounded
+
+                    use_width = np.abs(ar_width_rounded - ar) < np.abs(ar_height_rounded - ar)
+                    resized_sizes[too_large] = np.where(
+                        use_width[:, None],
+                        np.stack([b_width_rounded, round_half_up(b_width_rounded / ar)], axis=1),
+                        np.stack([round_half_up(b_height_rounded * ar), b_height_rounded], axis=1),
+                    )
+                    invalid[too_large] |= (b_height_in_wr == 0) | (b_height_rounded == 0)
+
+                bucket_resos = resized_sizes - resized_sizes % self.reso_steps
+
+            invalid |= bucket_resos[:, 1] == 0
+            ar_errors = bucket_resos[:, 0] / bucket_resos[:, 1] - aspect_ratios
+
+        # add new buckets in the order of the first image
+        valid_resos = bucket_resos[~invalid]
+        if len(valid_resos) > 0:
+            _, first_indices = np.unique(valid_resos[:, 0] * (1 << 32) + valid_resos[:, 1], return_index=True)
+            for width, height in valid_resos[np.sort(first_indices)]:
+                self.add_if_new_reso((int(width), int(height)))
+
+        for i in np.flatnonzero(invalid):
+            reso, resized_size, ar_error = self.select_bucket(int(widths[i]), int(heights[i]))
+            bucket_resos[i], resized_sizes[i], ar_errors[i] = reso, resized_size, ar_error
+
+        return bucket_resos, resized_sizes, ar_errors
+
     @staticmethod
     def get_crop_ltrb(bucket_reso: Tuple[int, int], image_size: Tuple[int, int]):
         # Stability AIの前処理に合わせてcrop left/topを計算する。crop rightはflipのaugmentationのために求める
@@ -671,6 +755,7 @@ class BaseDataset(torch.utils.data.Dataset):
         resolution: Optional[Tuple[int, int]],
         network_multiplier: float,
         debug_dataset: bool,
+        image_size_cache: bool = False,
     ) -> None:
         super().__init__()
 
@@ -679,6 +764,9 @@ class BaseDataset(torch.utils.data.Dataset):
         self.network_multiplier = network_multiplier
         self.debug_dataset = debug_dataset
 
+        # parallel image size scanner, with persistent size cache in each image directory if image_size_cache is True
+        self.image_size_cache = ImageSizeCache(persistent=image_size_cache)
+
         self.subsets: List[Union[DreamBoothSubset, FineTuningSubset]] = []
 
         self.token_padding_disabled = False
@@ -705,10 +793,13 @@ class BaseDataset(torch.utils.data.Dataset):
 
         self.image_transforms = IMAGE_TRANSFORMS
 
-        self.image_data: Dict[str, ImageInfo] = {}
-        self.image_to_subset: Dict[str, Union[DreamBoothSubset, FineTuningSubset]] = {}
+        # images are stored in columns, image_data and image_to_subset are read-only mappings by image_key
+        self.image_registry = ImageRegistry()
+        self.image_data: Mapping[str, ImageInfo] = self.image_registry.image_data
+        self.image_to_subset: Mapping[str, Union[DreamBoothSubset, FineTuningSubset]] = self.image_registry.image_to_subset
 
         self.replacements = {}
+        self.caption_processor = CaptionProcessor()
 
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
@@ -716,11 +807,54 @@ class BaseDataset(torch.utils.data.Dataset):
         self.tokenize_strategy = None
         self.text_encoder_output_caching_strategy = None
         self.latents_caching_strategy = None
+        self.token_id_cache: Optional[TokenIdCache] = None
 
     def set_current_strategies(self):
         self.tokenize_strategy = TokenizeStrategy.get_strategy()
         self.text_encoder_output_caching_strategy = TextEncoderOutputsCachingStrategy.get_strategy()
         self.latents_caching_strategy = LatentsCachingStrategy.get_strategy()
+        self.setup_token_id_cache()
+
+    def is_caption_deterministic(self, subset: BaseSubset) -> bool:
+        # process_caption returns the same caption for the same image every time
+        if subset.shuffle_caption or subset.caption_tag_dropout_rate > 0 or subset.token_warmup_step > 0:
+            return False
+        if subset.caption_dropout_rate > 0 or subset.caption_dropout_every_n_epochs > 0 or subset.enable_wildcard:
+            return False
+        return not any(type(str_to) == list for str_to in self.replacements.values())
+
+    def setup_token_id_cache(self):
+        r"""
+        register the processed captions of deterministic subsets to the token id cache, called in the main process before
+        the dataloader workers are created. the ids are filled lazily in __getitem__ and shared by the workers.
+        """
+        if self.token_id_cache is not None:
+            self.token_id_cache.close()
+            self.token_id_cache = None
+        if self.tokenize_strategy is None:
+            return
+
+        captions = []
+        for image_key, image_info in self.image_data.items():
+            subset = self.image_to_subset[image_key]
+            if self.is_caption_deterministic(subset):
+                captions.append(self.process_caption(subset, image_info.caption))
+        if len(captions) == 0:
+            return
+
+        self.token_id_cache = TokenIdCache(captions, self.tokenize_strategy, self.tokenize_strategy.get_cache_key())
+
+    def tokenize_caption(self, subset: BaseSubset, caption: str) -> List[torch.Tensor]:
+        r"""token ids of the processed caption without batch dimension, from the token id cache if possible"""
+        if self.token_id_cache is None:
+            return [ids[0] for ids in self.tokenize_strategy.tokenize(caption)]
+        if not self.is_caption_deterministic(subset):
+            self.token_id_cache.count_bypassed()
+            return [ids[0] for ids in self.tokenize_strategy.tokenize(caption)]
+        return self.token_id_cache.tokenize(self.tokenize_strategy, caption)
+
+    def get_token_id_cache_stats(self) -> Optional[Dict[str, float]]:
+        return self.token_id_cache.get_stats() if self.token_id_cache is not None else None
 
     def adjust_min_max_bucket_reso_by_steps(
         self, resolution: Tuple[int, int], min_bucket_reso: int, max_bucket_reso: int, bucket_reso_steps: int
@@ -822,48 +956,16 @@ class BaseDataset(torch.utils.data.Dataset):
 
                 # wildcard is like '{aaa|bbb|ccc...}'
                 # escape the curly braces like {{ or }}
-                replacer1 = "⦅"
-                replacer2 = "⦆"
-                while replacer1 in caption or replacer2 in caption:
-                    replacer1 += "⦅"
-                    replacer2 += "⦆"
-
-                caption = caption.replace("{{", replacer1).replace("}}", replacer2)
-
-                # replace the wildcard
-                def replace_wildcard(match):
-                    return random.choice(match.group(1).split("|"))
-
-                caption = re.sub(r"\{([^}]+)\}", replace_wildcard, caption)
-
-                # unescape the curly braces
-                caption = caption.replace(replacer1, "{").replace(replacer2, "}")
+                caption = self.caption_processor.process_wildcard(caption)
             else:
                 # if caption is multiline, use the first line
                 caption = caption.split("\n")[0]
 
             if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
-                fixed_tokens = []
-                flex_tokens = []
-                fixed_suffix_tokens = []
-                if (
-                    hasattr(subset, "keep_tokens_separator")
-                    and subset.keep_tokens_separator
-                    and subset.keep_tokens_separator in caption
-                ):
-                    fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
-                    if subset.keep_tokens_separator in flex_part:
-                        flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
-                        fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
-
-                    fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
-                    flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
-                else:
-                    tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
-                    flex_tokens = tokens[:]
-                    if subset.keep_tokens > 0:
-                        fixed_tokens = flex_tokens[: subset.keep_tokens]
-                        flex_tokens = tokens[subset.keep_tokens :]
+                fixed_tokens, flex_tokens, fixed_suffix_tokens = self.caption_processor.split(
+                    caption, subset.caption_separator, subset.keep_tokens, getattr(subset, "keep_tokens_separator", None)
+                )
+                flex_tokens = list(flex_tokens)
 
                 if subset.token_warmup_step < 1:  # 初回に上書きする
                     subset.token_warmup_step = math.floor(subset.token_warmup_step * self.max_train_steps)
@@ -876,21 +978,12 @@ class BaseDataset(torch.utils.data.Dataset):
                     )
                     flex_tokens = flex_tokens[:tokens_len]
 
-                def dropout_tags(tokens):
-                    if subset.caption_tag_dropout_rate <= 0:
-                        return tokens
-                    l = []
-                    for token in tokens:
-                        if random.random() >= subset.caption_tag_dropout_rate:
-                            l.append(token)
-                    return l
-
                 if subset.shuffle_caption:
                     random.shuffle(flex_tokens)
 
-                flex_tokens = dropout_tags(flex_tokens)
+                flex_tokens = dropout_tags(flex_tokens, subset.caption_tag_dropout_rate)
 
-                caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
+                caption = ", ".join(fixed_tokens + tuple(flex_tokens) + fixed_suffix_tokens)
 
             # process secondary separator
             if subset.secondary_separator:
@@ -959,8 +1052,8 @@ class BaseDataset(torch.utils.data.Dataset):
         return input_ids
 
     def register_image(self, info: ImageInfo, subset: BaseSubset):
-        self.image_data[info.image_key] = info
-        self.image_to_subset[info.image_key] = subset
+        # info becomes a view of the row in the registry
+        self.image_registry.add(info, subset)
 
     def make_buckets(self):
         """
@@ -968,26 +1061,13 @@ class BaseDataset(torch.utils.data.Dataset):
         min_size and max_size are ignored when enable_bucket is False
         """
         logger.info("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
-
-        # # run in parallel
-        # max_workers = min(os.cpu_count(), len(self.image_data))  # TODO consider multi-gpu (processes)
-        # with ThreadPoolExecutor(max_workers) as executor:
-        #     futures = []
-        #     for info in tqdm(self.image_data.values(), desc="loading image sizes"):
-        #         if info.image_size is None:
-        #             def get_and_set_image_size(info):
-        #                 info.image_size = self.get_image_size(info.absolute_path)
-        #             futures.append(executor.submit(get_and_set_image_size, info))
-        #             # consume futures to reduce memory usage and prevent Ctrl-C hang
-        #             if len(futures) >= max_workers:
-        #                 for future in futures:
-        #                     future.result()
-        #                 futures = []
-        #     for future in futures:
-        #         future.result()
+        infos_without_size = [info for info in self.image_data.values() if info.image_size is None]
+        sizes = self.image_size_cache.get_sizes([info.absolute_path for info in infos_without_size])
+        for info, size in zip(infos_without_size, sizes):
+            info.image_size = size
+
+        registry = self.image_registry
+        assert np.all(registry.get_column("image_size") >= 0), "some image sizes are not loaded / 一部の画像サイズが読み込まれていません"
 
         if self.enable_bucket:
             logger.info("make buckets")
@@ -1011,27 +1091,25 @@ class BaseDataset(torch.utils.data.Dataset):
                         "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
                     )
 
-            img_ar_errors = []
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, ar_error = self.bucket_manager.select_bucket(
-                    image_width, image_height
-                )
-
-                # logger.info(image_info.image_key, image_info.bucket_reso)
-                img_ar_errors.append(abs(ar_error))
+            image_sizes = registry.get_column("image_size")
+            bucket_resos, resized_sizes, ar_errors = self.bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
+            img_ar_errors = np.abs(ar_errors)
 
             self.bucket_manager.sort()
         else:
             self.bucket_manager = BucketManager(False, (self.width, self.height), None, None, None)
             self.bucket_manager.set_predefined_resos([(self.width, self.height)])  # ひとつの固定サイズbucketのみ
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, _ = self.bucket_manager.select_bucket(image_width, image_height)
+            image_sizes = registry.get_column("image_size")
+            bucket_resos, resized_sizes, _ = self.bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
 
-        for image_info in self.image_data.values():
-            for _ in range(image_info.num_repeats):
-                self.bucket_manager.add_image(image_info.bucket_reso, image_info.image_key)
+        registry.set_column("bucket_reso", bucket_resos)
+        registry.set_column("resized_size", resized_sizes)
+
+        # buckets hold the indices of the images in the registry, repeated num_repeats times
+        reso_to_id = {(w << 32) + h: bucket_id for (w, h), bucket_id in self.bucket_manager.reso_to_id.items()}
+        reso_keys, inverse = np.unique(bucket_resos[:, 0] * (1 << 32) + bucket_resos[:, 1], return_inverse=True)
+        reso_ids = np.array([reso_to_id[int(key)] for key in reso_keys], dtype=np.int64)
+        self.bucket_manager.set_bucket_indices(reso_ids[inverse.reshape(-1)], registry.get_column("num_repeats"))
 
         # bucket情報を表示、格納する
         if self.enable_bucket:
@@ -1058,6 +1136,8 @@ class BaseDataset(torch.utils.data.Dataset):
         self.shuffle_buckets()
         self._length = len(self.buckets_indices)
 
+        self.image_registry.compact()
+
     def shuffle_buckets(self):
         # set random seed for this epoch
         random.seed(self.seed + self.current_epoch)
@@ -1087,10 +1167,11 @@ class BaseDataset(torch.utils.data.Dataset):
             ]
         )
 
-    def new_cache_latents(self, model: Any, accelerator: Accelerator):
+    def new_cache_latents(self, model: Any, accelerator: Accelerator) -> int:
         r"""
         a brand new method to cache latents. This method caches latents with caching strategy.
         normal cache_latents method is used by default, but this method is used when caching strategy is specified.
+        only `num_processes` and `process_index` of accelerator are used. returns the number of images cached by this process.
         """
         logger.info("caching latents with caching strategy.")
         caching_strategy = LatentsCachingStrategy.get_strategy()
@@ -1115,6 +1196,7 @@ class BaseDataset(torch.utils.data.Dataset):
                     and self.random_crop == other.random_crop
                 )
 
+        batches: List[Tuple[Condition, List[ImageInfo]]] = []
         batch: List[ImageInfo] = []
         current_condition = None
 
@@ -1122,74 +1204,122 @@ class BaseDataset(torch.utils.data.Dataset):
         num_processes = accelerator.num_processes
         process_index = accelerator.process_index
 
-        # define a function to submit a batch to cache
-        def submit_batch(batch, cond):
-            for info in batch:
-                if info.image is not None and isinstance(info.image, Future):
-                    info.image = info.image.result()  # future to image
-            caching_strategy.cache_batch_latents(model, batch, cond.flip_aug, cond.alpha_mask, cond.random_crop)
-
-            # remove image from memory
-            for info in batch:
-                info.image = None
-
-        # define ThreadPoolExecutor to load images in parallel
-        max_workers = min(os.cpu_count(), len(image_infos))
-        max_workers = max(1, max_workers // num_processes)  # consider multi-gpu
-        max_workers = min(max_workers, caching_strategy.batch_size)  # max_workers should be less than batch_size
-        executor = ThreadPoolExecutor(max_workers)
+        validate_start = time.perf_counter()
 
-        try:
-            # iterate images
-            logger.info("caching latents...")
-            for i, info in enumerate(tqdm(image_infos)):
-                subset = self.image_to_subset[info.image_key]
+        # validate the disk caches of this process at once with the cache manifest, instead of loading each npz
+        if (
+            caching_strategy.cache_to_disk
+            and not caching_strategy.skip_disk_cache_validity_check
+            and caching_strategy.cache_backend == "npz"
+        ):
+            infos_to_check = [
+                info for i, info in enumerate(image_infos) if i % num_processes == process_index and info.latents_npz is None
+            ]
+            cache_manifest.validate_cache_files(
+                [caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size) for info in infos_to_check],
+                [info.absolute_path for info in infos_to_check],
+            )
 
-                if info.latents_npz is not None:  # fine tuning dataset
+        logger.info("checking cache validity...")
+        for i, info in enumerate(tqdm(image_infos)):
+            subset = self.image_to_subset[info.image_key]
+
+            if info.latents_npz is not None:  # fine tuning dataset
+                continue
+
+            # check disk cache exists and size of latents
+            if caching_strategy.cache_to_disk:
+                # info.latents_npz = os.path.splitext(info.absolute_path)[0] + file_suffix
+                info.latents_npz = caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size)
+
+                # if the modulo of num_processes is not equal to process_index, skip caching
+                # this makes each process cache different latents
+                if i % num_processes != process_index:
                     continue
 
-                # check disk cache exists and size of latents
-                if caching_strategy.cache_to_disk:
-                    # info.latents_npz = os.path.splitext(info.absolute_path)[0] + file_suffix
-                    info.latents_npz = caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size)
+                # print(f"{process_index}/{num_processes} {i}/{len(image_infos)} {info.latents_npz}")
 
-                    # if the modulo of num_processes is not equal to process_index, skip caching
-                    # this makes each process cache different latents
-                    if i % num_processes != process_index:
-                        continue
+                cache_available = caching_strategy.is_disk_cached_latents_expected(
+                    info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
+                )
+                if cache_available:  # do not add to batch
+                    continue
 
-                    # print(f"{process_index}/{num_processes} {i}/{len(image_infos)} {info.latents_npz}")
+            # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
+            condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
+            if len(batch) > 0 and current_condition != condition:
+                batches.append((current_condition, batch))
+                batch = []
 
-                    cache_available = caching_strategy.is_disk_cached_latents_expected(
-                        info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
-                    )
-                    if cache_available:  # do not add to batch
-                        continue
+            batch.append(info)
+            current_condition = condition
 
-                # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
-                condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
-                if len(batch) > 0 and current_condition != condition:
-                    submit_batch(batch, current_condition)
-                    batch = []
+            # if number of data in batch is enough, flush the batch
+            if len(batch) >= caching_strategy.batch_size:
+                batches.append((current_condition, batch))
+                batch = []
+                current_condition = None
 
-                if info.image is None:
-                    # load image in parallel
-                    info.image = executor.submit(load_image, info.absolute_path, condition.alpha_mask)
+        if len(batch) > 0:
+            batches.append((current_condition, batch))
+        step_profiler.record("validate", validate_start, time.perf_counter())
 
-                batch.append(info)
-                current_condition = condition
+        if len(batches) == 0:
+            logger.info("no latents to cache")
+            cache_manifest.save_cache_manifests()  # records may be updated by the validity check
+            return 0
 
-                # if number of data in batch is enough, flush the batch
-                if len(batch) >= caching_strategy.batch_size:
-                    submit_batch(batch, current_condition)
-                    batch = []
-                    current_condition = None
+        # pipeline: decode/resize images in a thread pool -> encode in this thread -> write in the writer threads of the strategy.
+        # decoding runs `prefetch_batches` batches ahead, so the encoder does not wait for PIL/cv2
+        prefetch_batches = 2
+        max_workers = caching_strategy.num_decode_workers
+        if max_workers is None:
+            max_workers = max(1, os.cpu_count() // num_processes)  # consider multi-gpu
+            max_workers = min(max_workers, caching_strategy.batch_size * prefetch_batches)
+        executor = ThreadPoolExecutor(max_workers)
 
-            if len(batch) > 0:
-                submit_batch(batch, current_condition)
+        def submit_decode(batch_index: int) -> List[Optional[Future]]:
+            condition, batch = batches[batch_index]
+            return [
+                (
+                    executor.submit(load_image_and_mask_for_caching, info, condition.alpha_mask, condition.random_crop)
+                    if info.image is None
+                    else None  # image is already loaded
+                )
+                for info in batch
+            ]
+
+        try:
+            logger.info(f"caching latents... decode workers: {max_workers}, write workers: {caching_strategy.num_write_workers}")
+            pending = deque(submit_decode(j) for j in range(min(prefetch_batches, len(batches))))
+            next_batch_index = len(pending)
+
+            for condition, batch in tqdm(batches, smoothing=1, total=len(batches)):
+                futures = pending.popleft()
+                if next_batch_index < len(batches):
+                    pending.append(submit_decode(next_batch_index))
+                    next_batch_index += 1
+
+                with step_profiler.span("decode_wait"):
+                    for info, future in zip(batch, futures):
+                        if future is not None:
+                            info.image = future.result()  # ImageForCaching
+                with step_profiler.span("encode"):
+                    caching_strategy.cache_batch_latents(
+                        model, batch, condition.flip_aug, condition.alpha_mask, condition.random_crop
+                    )
+
+                # remove image from memory
+                for info in batch:
+                    info.image = None
 
         finally:
-            executor.shutdown()
+            executor.shutdown(wait=True, cancel_futures=True)
+            with step_profiler.span("write_wait"):
+                caching_strategy.wait_for_pending_writes()
+            cache_manifest.save_cache_manifests()
+
+        return sum(len(batch) for _, batch in batches)
 
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True, file_suffix=".npz"):
         # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
@@ -1286,6 +1416,14 @@ class BaseDataset(torch.utils.data.Dataset):
         num_processes = accelerator.num_processes
         process_index = accelerator.process_index
 
+        # validate the disk caches of this process at once with the cache manifest, instead of loading each npz
+        if caching_strategy.cache_to_disk and not caching_strategy.skip_disk_cache_validity_check:
+            infos_to_check = [info for i, info in enumerate(image_infos) if i % num_processes == process_index]
+            # text encoder outputs do not depend on the image, so the image is not checked
+            cache_manifest.validate_cache_files(
+                [caching_strategy.get_outputs_npz_path(info.absolute_path) for info in infos_to_check]
+            )
+
         logger.info("checking cache validity...")
         for i, info in enumerate(tqdm(image_infos)):
             # check disk cache exists and size of text encoder outputs
@@ -1314,6 +1452,7 @@ class BaseDataset(torch.utils.data.Dataset):
 
         if len(batches) == 0:
             logger.info("no Text Encoder outputs to cache")
+            cache_manifest.save_cache_manifests()  # records may be updated by the validity check
             return
 
         # iterate batches
@@ -1322,6 +1461,8 @@ class BaseDataset(torch.utils.data.Dataset):
             # cache_batch_latents(vae, cache_to_disk, batch, subset.flip_aug, subset.alpha_mask, subset.random_crop)
             caching_strategy.cache_batch_outputs(tokenize_strategy, models, text_encoding_strategy, batch)
 
+        cache_manifest.save_cache_manifests()
+
     # if weight_dtype is specified, Text Encoder itself and output will be converted to the dtype
     # this method is only for SDXL, but it should be implemented here because it needs to be a method of dataset
     # to support SD1/2, it needs a flag for v2, but it is postponed
@@ -1448,17 +1589,7 @@ class BaseDataset(torch.utils.data.Dataset):
                 )
 
     def get_image_size(self, image_path):
-        # return imagesize.get(image_path)
-        image_size = imagesize.get(image_path)
-        if image_size[0] <= 0:
-            # imagesize doesn't work for some images, so use PIL as a fallback
-            try:
-                with Image.open(image_path) as img:
-                    image_size = img.size
-            except Exception as e:
-                logger.warning(f"failed to get image size: {image_path}, error: {e}")
-                image_size = (0, 0)
-        return image_size
+        return get_image_size(image_path)
 
     def load_image_with_face_info(self, subset: BaseSubset, image_path: str, alpha_mask=False):
         img = load_image(image_path, alpha_mask)
@@ -1546,9 +1677,9 @@ class BaseDataset(torch.utils.data.Dataset):
         text_encoder_outputs_list = []
         custom_attributes = []
 
-        for image_key in bucket[image_index : image_index + bucket_batch_size]:
-            image_info = self.image_data[image_key]
-            subset = self.image_to_subset[image_key]
+        for registry_index in bucket[image_index : image_index + bucket_batch_size]:
+            image_info = self.image_registry.view(registry_index)
+            subset = self.image_registry.get_subset(registry_index)
 
             custom_attributes.append(subset.custom_attributes)
 
@@ -1682,7 +1813,7 @@ class BaseDataset(torch.utils.data.Dataset):
 
             if tokenization_required:
                 caption = self.process_caption(subset, image_info.caption)
-                input_ids = [ids[0] for ids in self.tokenize_strategy.tokenize(caption)]  # remove batch dimension
+                input_ids = self.tokenize_caption(subset, caption)  # without batch dimension
                 # if self.XTI_layers:
                 #     caption_layer = []
                 #     for layer in self.XTI_layers:
@@ -1760,7 +1891,7 @@ class BaseDataset(torch.utils.data.Dataset):
         example["network_multipliers"] = torch.FloatTensor([self.network_multiplier] * len(captions))
 
         if self.debug_dataset:
-            example["image_keys"] = bucket[image_index : image_index + self.batch_size]
+            example["image_keys"] = [self.image_registry.get_image_key(i) for i in bucket[image_index : image_index + self.batch_size]]
         return example
 
     def get_item_for_caching(self, bucket, bucket_batch_size, image_index):
@@ -1775,9 +1906,9 @@ class BaseDataset(torch.utils.data.Dataset):
         alpha_mask = None
         random_crop = None
 
-        for image_key in bucket[image_index : image_index + bucket_batch_size]:
-            image_info = self.image_data[image_key]
-            subset = self.image_to_subset[image_key]
+        for registry_index in bucket[image_index : image_index + bucket_batch_size]:
+            image_info = self.image_registry.view(registry_index)
+            subset = self.image_registry.get_subset(registry_index)
 
             if flip_aug is None:
                 flip_aug = subset.flip_aug
@@ -1852,8 +1983,9 @@ class DreamBoothDataset(BaseDataset):
         debug_dataset: bool,
         validation_split: float,
         validation_seed: Optional[int],
+        image_size_cache: bool = False,
     ) -> None:
-        super().__init__(resolution, network_multiplier, debug_dataset)
+        super().__init__(resolution, network_multiplier, debug_dataset, image_size_cache)
 
         assert resolution is not None, f"resolution is required / resolution（解像度）指定は必須です"
 
@@ -2035,7 +2167,7 @@ class DreamBoothDataset(BaseDataset):
 
             if not use_cached_info_for_subset and subset.cache_info:
                 logger.info(f"cache image info for / 画像情報をキャッシュします : {info_cache_file}")
-                sizes = [self.get_image_size(img_path) for img_path in tqdm(img_paths, desc="get image size")]
+                sizes = self.image_size_cache.get_sizes(img_paths)
                 matas = {}
                 for img_path, caption, size in zip(img_paths, captions, sizes):
                     matas[img_path] = {"caption": caption, "resolution": list(size)}
@@ -2133,8 +2265,9 @@ class FineTuningDataset(BaseDataset):
         debug_dataset: bool,
         validation_seed: int,
         validation_split: float,
+        image_size_cache: bool = False,
     ) -> None:
-        super().__init__(resolution, network_multiplier, debug_dataset)
+        super().__init__(resolution, network_multiplier, debug_dataset, image_size_cache)
 
         self.batch_size = batch_size
 
@@ -2154,22 +2287,16 @@ class FineTuningDataset(BaseDataset):
                 )
                 continue
 
-            # メタデータを読み込む
+            # メタデータを読み込む. JSON Lines is streamed, the entries are not kept in memory
             if os.path.exists(subset.metadata_file):
                 logger.info(f"loading existing metadata: {subset.metadata_file}")
-                with open(subset.metadata_file, "rt", encoding="utf-8") as f:
-                    metadata = json.load(f)
             else:
                 raise ValueError(f"no metadata / メタデータファイルがありません: {subset.metadata_file}")
 
-            if len(metadata) < 1:
-                logger.warning(
-                    f"ignore subset with '{subset.metadata_file}': no image entries found / 画像に関するデータが見つからないためサブセットを無視します"
-                )
-                continue
-
+            num_entries = 0
             tags_list = []
-            for image_key, img_md in metadata.items():
+            for image_key, img_md in metadata_util.iter_metadata(subset.metadata_file):
+                num_entries += 1
                 # path情報を作る
                 abs_path = None
 
@@ -2227,11 +2354,17 @@ class FineTuningDataset(BaseDataset):
 
                 self.register_image(image_info, subset)
 
-            self.num_train_images += len(metadata) * subset.num_repeats
+            if num_entries < 1:
+                logger.warning(
+                    f"ignore subset with '{subset.metadata_file}': no image entries found / 画像に関するデータが見つからないためサブセットを無視します"
+                )
+                continue
+
+            self.num_train_images += num_entries * subset.num_repeats
 
             # TODO do not record tag freq when no tag
             self.set_tag_frequency(os.path.basename(subset.metadata_file), tags_list)
-            subset.img_count = len(metadata)
+            subset.img_count = num_entries
             self.subsets.append(subset)
 
         # check existence of all npz files
@@ -2361,8 +2494,9 @@ class ControlNetDataset(BaseDataset):
         debug_dataset: bool,
         validation_split: float,
         validation_seed: Optional[int],
+        image_size_cache: bool = False,
     ) -> None:
-        super().__init__(resolution, network_multiplier, debug_dataset)
+        super().__init__(resolution, network_multiplier, debug_dataset, image_size_cache)
 
         db_subsets = []
         for subset in subsets:
@@ -2412,6 +2546,7 @@ class ControlNetDataset(BaseDataset):
             debug_dataset,
             validation_split,
             validation_seed,
+            image_size_cache,
         )
 
         # config_util等から参照される値をいれておく（若干微妙なのでなんとかしたい）
@@ -2467,6 +2602,9 @@ class ControlNetDataset(BaseDataset):
     def set_current_strategies(self):
         return self.dreambooth_dataset_delegate.set_current_strategies()
 
+    def get_token_id_cache_stats(self) -> Optional[Dict[str, float]]:
+        return self.dreambooth_dataset_delegate.get_token_id_cache_stats()
+
     def make_buckets(self):
         self.dreambooth_dataset_delegate.make_buckets()
         self.bucket_manager = self.dreambooth_dataset_delegate.bucket_manager
@@ -2475,7 +2613,7 @@ class ControlNetDataset(BaseDataset):
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
         return self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
 
-    def new_cache_latents(self, model: Any, accelerator: Accelerator):
+    def new_cache_latents(self, model: Any, accelerator: Accelerator) -> int:
         return self.dreambooth_dataset_delegate.new_cache_latents(model, accelerator)
 
     def new_cache_text_encoder_outputs(self, models: List[Any], is_main_process: bool):
@@ -2495,8 +2633,8 @@ class ControlNetDataset(BaseDataset):
 
         conditioning_images = []
 
-        for i, image_key in enumerate(bucket[image_index : image_index + bucket_batch_size]):
-            image_info = self.dreambooth_dataset_delegate.image_data[image_key]
+        for i, registry_index in enumerate(bucket[image_index : image_index + bucket_batch_size]):
+            image_info = self.dreambooth_dataset_delegate.image_registry.view(registry_index)
 
             target_size_hw = example["target_sizes_hw"][i]
             original_size_hw = example["original_sizes_hw"][i]
@@ -2544,15 +2682,14 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
 
         super().__init__(datasets)
 
-        self.image_data = {}
         self.num_train_images = 0
         self.num_reg_images = 0
 
-        # simply concat together
+        # simply concat together, the later dataset has priority same as dict.update
         # TODO: handling image_data key duplication among dataset
         #   In practical, this is not the big issue because image_data is accessed from outside of dataset only for debug_dataset.
+        self.image_data = collections.ChainMap(*[dataset.image_data for dataset in reversed(datasets)])
         for dataset in datasets:
-            self.image_data.update(dataset.image_data)
             self.num_train_images += dataset.num_train_images
             self.num_reg_images += dataset.num_reg_images
 
@@ -2629,6 +2766,17 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.set_current_strategies()
 
+    def get_token_id_cache_stats(self) -> Optional[Dict[str, float]]:
+        r"""total of the token id cache stats of the datasets, None if no dataset has the cache"""
+        all_stats = [dataset.get_token_id_cache_stats() for dataset in self.datasets]
+        all_stats = [stats for stats in all_stats if stats is not None]
+        if len(all_stats) == 0:
+            return None
+        total = {key: sum(stats[key] for stats in all_stats) for key in ["hits", "misses", "bypassed"]}
+        lookups = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / lookups if lookups > 0 else 0.0
+        return total
+
     def set_current_epoch(self, epoch):
         for dataset in self.datasets:
             dataset.set_current_epoch(epoch)
@@ -2955,12 +3103,43 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
+class ImageForCaching(NamedTuple):
+    image: torch.Tensor  # [3, H, W], normalized to [-1, 1]
+    alpha_mask: Optional[torch.Tensor]  # [H, W], normalized to [0, 1]
+    original_size: Tuple[int, int]  # (W, H)
+    crop_ltrb: Tuple[int, int, int, int]  # (L, T, R, B)
+
+
+def load_image_and_mask_for_caching(info: ImageInfo, use_alpha_mask: bool, random_crop: bool) -> ImageForCaching:
+    r"""
+    decode, resize and trim the image for caching. this is thread-safe, so it can be called in the decode workers
+    """
+    image = load_image(info.absolute_path, use_alpha_mask) if info.image is None else np.array(info.image, np.uint8)
+    # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
+    image, original_size, crop_ltrb = trim_and_resize_if_required(random_crop, image, info.bucket_reso, info.resized_size)
+
+    if use_alpha_mask:
+        if image.shape[2] == 4:
+            alpha_mask = image[:, :, 3]  # [H,W]
+            alpha_mask = alpha_mask.astype(np.float32) / 255.0
+            alpha_mask = torch.FloatTensor(alpha_mask)  # [H,W]
+        else:
+            alpha_mask = torch.ones_like(image[:, :, 0], dtype=torch.float32)  # [H,W]
+    else:
+        alpha_mask = None
+
+    image = image[:, :, :3]  # remove alpha channel if exists
+    image = IMAGE_TRANSFORMS(image)
+    return ImageForCaching(image, alpha_mask, original_size, crop_ltrb)
+
+
 # for new_cache_latents
 def load_images_and_masks_for_caching(
     image_infos: List[ImageInfo], use_alpha_mask: bool, random_crop: bool
 ) -> Tuple[torch.Tensor, List[np.ndarray], List[Tuple[int, int]], List[Tuple[int, int, int, int]]]:
     r"""
     requires image_infos to have: [absolute_path or image], bucket_reso, resized_size
+    info.image can be an ImageForCaching which is already prepared by the decode workers
 
     returns: image_tensor, alpha_masks, original_sizes, crop_ltrbs
 
@@ -2974,27 +3153,15 @@ def load_images_and_masks_for_caching(
     original_sizes: List[Tuple[int, int]] = []
     crop_ltrbs: List[Tuple[int, int, int, int]] = []
     for info in image_infos:
-        image = load_image(info.absolute_path, use_alpha_mask) if info.image is None else np.array(info.image, np.uint8)
-        # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
-        image, original_size, crop_ltrb = trim_and_resize_if_required(random_crop, image, info.bucket_reso, info.resized_size)
-
-        original_sizes.append(original_size)
-        crop_ltrbs.append(crop_ltrb)
-
-        if use_alpha_mask:
-            if image.shape[2] == 4:
-                alpha_mask = image[:, :, 3]  # [H,W]
-                alpha_mask = alpha_mask.astype(np.float32) / 255.0
-                alpha_mask = torch.FloatTensor(alpha_mask)  # [H,W]
-            else:
-                alpha_mask = torch.ones_like(image[:, :, 0], dtype=torch.float32)  # [H,W]
+        if isinstance(info.image, ImageForCaching):
+            prepared = info.image
         else:
-            alpha_mask = None
-        alpha_masks.append(alpha_mask)
+            prepared = load_image_and_mask_for_caching(info, use_alpha_mask, random_crop)
 
-        image = image[:, :, :3]  # remove alpha channel if exists
-        image = IMAGE_TRANSFORMS(image)
-        images.append(image)
+        images.append(prepared.image)
+        alpha_masks.append(prepared.alpha_mask)
+        original_sizes.append(prepared.original_size)
+        crop_ltrbs.append(prepared.crop_ltrb)
 
     img_tensor = torch.stack(images, dim=0)
     return img_tensor, alpha_masks, original_sizes, crop_ltrbs
@@ -3223,12 +3390,76 @@ def precalculate_safetensors_hashes(tensors, metadata):
     # calculating the hash, as they are meant to be immutable
     metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
 
-    bytes = safetensors.torch.save(tensors, metadata)
-    b = BytesIO(bytes)
+    # hash the header and the bytes of each tensor in the layout of safetensors.torch.save, without serializing the
+    # whole model to memory. metadata keys are written in insertion order, safetensors.torch.save writes them in the
+    # order of a Rust HashMap: the header has the same length, so the hashes differ only if the header reaches the
+    # offset of the legacy hash (1 MiB, e.g. huge ss_tag_frequency) and metadata has multiple keys
+    header, layout = build_safetensors_header({k: (v.dtype, v.shape) for k, v in tensors.items()}, metadata)
+    hasher = SafetensorsHasher()
+    hasher.update_header(header)
+    for name, start, end in layout:
+        if end > start:
+            hasher.update(safetensors_tensor_bytes(tensors[name]))
+    return hasher.hexdigests()
+
+
+class SafetensorsHasher:
+    """
+    Incremental addnet_hash_safetensors / addnet_hash_legacy. Feed the bytes of a safetensors file in order:
+    first the header (8 bytes length + header JSON), then the data section.
+    """
+
+    LEGACY_OFFSET = 0x100000
+    LEGACY_LENGTH = 0x10000
+
+    def __init__(self):
+        self.position = 0
+        self.data_offset = None
+        self.model_hash = hashlib.sha256()
+        self.legacy_hash = hashlib.sha256()
+
+    def update_header(self, header: bytes):
+        self.data_offset = len(header)
+        self._update_legacy(header)
+        self.position += len(header)
+
+    def update(self, data):
+        data = memoryview(data).cast("B")
+        self.model_hash.update(data)
+        self._update_legacy(data)
+        self.position += len(data)
+
+    def _update_legacy(self, data):
+        start = max(self.LEGACY_OFFSET, self.position)
+        end = min(self.LEGACY_OFFSET + self.LEGACY_LENGTH, self.position + len(data))
+        if start < end:
+            self.legacy_hash.update(data[start - self.position : end - self.position])
+
+    def hexdigests(self) -> Tuple[str, str]:
+        """returns (model_hash, legacy_hash)"""
+        return self.model_hash.hexdigest(), self.legacy_hash.hexdigest()[0:8]
+
+
+def precalculate_safetensors_hashes_from_file(filename, metadata):
+    """
+    Same as precalculate_safetensors_hashes, for tensors already saved to a safetensors file in the layout of
+    safetensors.torch.save (e.g. by MemoryEfficientSafeWriter). The data section is read in chunks, so the tensors
+    are not loaded into memory.
+    """
+    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+
+    with MemoryEfficientSafeOpen(filename) as f:
+        specs = {k: (MemoryEfficientSafeOpen._get_torch_dtype(f.header[k]["dtype"]), f.header[k]["shape"]) for k in f.keys()}
+        data_offset = f.header_size + 8
+    header, _ = build_safetensors_header(specs, metadata)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
-    return model_hash, legacy_hash
+    hasher = SafetensorsHasher()
+    hasher.update_header(header)
+    with open(filename, "rb") as f:
+        f.seek(data_offset)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigests()
 
 
 def addnet_hash_legacy(b):
@@ -4067,6 +4298,15 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         ],
         help=f"sampler (scheduler) type for sample images / サンプル出力時のサンプラー（スケジューラ）の種類",
     )
+    parser.add_argument(
+        "--sample_batch_size",
+        type=int,
+        default=1,
+        help="generate sample images of the prompts with the same size, steps, scale and sampler in a batch of this size (default 1)."
+        " the initial noise is same for the seed, but the noise of ancestral samplers depends on the batch"
+        " / 同じサイズ、ステップ数、スケール、サンプラーのプロンプトのサンプル画像をこのバッチサイズでまとめて生成する（デフォルト1）。"
+        "初期ノイズはシードごとに同じだが、ancestral系サンプラーのノイズはバッチの内容に依存する",
+    )
 
     parser.add_argument(
         "--config_file",
@@ -4368,6 +4608,12 @@ def add_dataset_arguments(
         help="cache meta information (caption and image size) for faster dataset loading. only available for DreamBooth"
         + " / メタ情報（キャプションとサイズ）をキャッシュしてデータセット読み込みを高速化する。DreamBooth方式のみ有効",
     )
+    parser.add_argument(
+        "--image_size_cache",
+        action="store_true",
+        help="cache image sizes to image_size_cache.json in each image directory, keyed by mtime and file size. image headers are not read again on restart"
+        + " / 画像サイズを各画像ディレクトリのimage_size_cache.jsonにキャッシュする（更新日時とファイルサイズで判定）。再起動時に画像ヘッダを再読み込みしない",
+    )
     parser.add_argument(
         "--shuffle_caption", action="store_true", help="shuffle separated caption / 区切られたcaptionの各要素をshuffleする"
     )
@@ -4465,6 +4711,20 @@ def add_dataset_arguments(
         help="skip the content validation of cache (latent and text encoder output). Cache file existence check is always performed, and cache processing is performed if the file does not exist"
         " / cacheの内容の検証をスキップする（latentとテキストエンコーダの出力）。キャッシュファイルの存在確認は常に行われ、ファイルがなければキャッシュ処理が行われる",
     )
+    parser.add_argument(
+        "--rebuild_cache_manifest",
+        action="store_true",
+        help="ignore the existing cache manifests (cache_manifest.json) and rebuild them by loading all npz files"
+        + " / 既存のキャッシュマニフェスト（cache_manifest.json）を無視し、すべてのnpzファイルを読み込んで再作成する",
+    )
+    parser.add_argument(
+        "--latents_cache_backend",
+        type=str,
+        default="npz",
+        choices=["npz", "store"],
+        help="backend of latents disk cache. npz: one .npz file per image, store: sharded memory-mapped store per image directory (latents_store_*)"
+        + " / latentのディスクキャッシュの形式。npz: 画像ごとの.npzファイル、store: 画像ディレクトリごとのシャード化されたメモリマップストア（latents_store_*）",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -5299,6 +5559,8 @@ def prepare_dataset_args(args: argparse.Namespace, support_metadata: bool):
     else:
         args.face_crop_aug_range = None
 
+    cache_manifest.set_rebuild_cache_manifest(args.rebuild_cache_manifest)
+
     if support_metadata:
         if args.in_json is not None and (args.color_aug or args.random_crop):
             logger.warning(
@@ -6217,6 +6479,7 @@ def sample_images_common(
     unet,
     prompt_replacement=None,
     controlnet=None,
+    cache_prompt_embeddings: bool = False,
 ):
     """
     StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
@@ -6255,18 +6518,11 @@ def sample_images_common(
     else:
         text_encoder = accelerator.unwrap_model(text_encoder)
 
-    # read prompts
-    if args.sample_prompts.endswith(".txt"):
-        with open(args.sample_prompts, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        prompts = [line.strip() for line in lines if len(line.strip()) > 0 and line[0] != "#"]
-    elif args.sample_prompts.endswith(".toml"):
-        with open(args.sample_prompts, "r", encoding="utf-8") as f:
-            data = toml.load(f)
-        prompts = [dict(**data["prompt"], **subset) for subset in data["prompt"]["subset"]]
-    elif args.sample_prompts.endswith(".json"):
-        with open(args.sample_prompts, "r", encoding="utf-8") as f:
-            prompts = json.load(f)
+    prompts = load_prompts(args.sample_prompts)
+
+    # the text encoder outputs of the prompts are cached in the pipeline
+    prompt_encoding_cache = sample_engine.get_prompt_encoding_cache()
+    text_encoders = text_encoder if isinstance(text_encoder, (list, tuple)) else [text_encoder]
 
     default_scheduler = get_my_scheduler(sample_sampler=args.sample_sampler, v_parameterization=args.v_parameterization)
 
@@ -6281,22 +6537,13 @@ def sample_images_common(
         requires_safety_checker=False,
         clip_skip=args.clip_skip,
     )
+    pipeline._encode_prompt = prompt_encoding_cache.wrap(pipeline._encode_prompt)
     pipeline.to(distributed_state.device)
+    prompt_encoding_cache.begin(text_encoders, persistent=cache_prompt_embeddings)
+
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
-    # preprocess prompts
-    for i in range(len(prompts)):
-        prompt_dict = prompts[i]
-        if isinstance(prompt_dict, str):
-            prompt_dict = line_to_prompt_dict(prompt_dict)
-            prompts[i] = prompt_dict
-        assert isinstance(prompt_dict, dict)
-
-        # Adds an enumerator to the dict based on prompt position. Used later to name image files. Also cleanup of extra data in original prompt dict.
-        prompt_dict["enum"] = i
-        prompt_dict.pop("subset", None)
-
     # save random state to restore later
     rng_state = torch.get_rng_state()
     cuda_rng_state = None
@@ -6305,26 +6552,28 @@ def sample_images_common(
     except Exception:
         pass
 
-    if distributed_state.num_processes <= 1:
-        # If only one device is available, just use the original prompt list. We don't need to care about the distribution of prompts.
-        with torch.no_grad():
-            for prompt_dict in prompts:
-                sample_image_inference(
-                    accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
-                )
-    else:
-        # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
-        # prompt_dicts are assigned to lists based on order of processes, to attempt to time the image creation time to match enum order. Probably only works when steps and sampler are identical.
-        per_process_prompts = []  # list of lists
-        for i in range(distributed_state.num_processes):
-            per_process_prompts.append(prompts[i :: distributed_state.num_processes])
+    def get_batch_key(prompt_dict):
+        if prompt_dict.get("controlnet_image") is not None:
+            return ("controlnet", prompt_dict["enum"])  # the image is per prompt, not batched
+        width = prompt_dict.get("width", 512)
+        height = prompt_dict.get("height", 512)
+        return (
+            max(64, width - width % 8),
+            max(64, height - height % 8),
+            prompt_dict.get("sample_steps", 30),
+            prompt_dict.get("scale", 7.5),
+            prompt_dict.get("sample_sampler", args.sample_sampler),
+        )
 
-        with torch.no_grad():
-            with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
-                for prompt_dict in prompt_dict_lists[0]:
-                    sample_image_inference(
-                        accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
-                    )
+    # prompts with the same settings are generated in a batch. batches are assigned to the processes in order, to attempt to
+    # time the image creation time to match enum order
+    batches = sample_engine.make_sample_batches(prompts, args.sample_batch_size, get_batch_key)
+    with torch.no_grad(), sample_engine.split_sample_batches(distributed_state, batches) as process_batches:
+        for prompt_dicts in process_batches:
+            sample_image_inference_batch(
+                accelerator, args, pipeline, save_dir, prompt_dicts, epoch, steps, prompt_replacement, controlnet=controlnet
+            )
+    prompt_encoding_cache.log_stats()
 
     # clear pipeline and cache to reduce vram usage
     del pipeline
@@ -6349,30 +6598,48 @@ def sample_image_inference(
     controlnet=None,
 ):
     assert isinstance(prompt_dict, dict)
-    negative_prompt = prompt_dict.get("negative_prompt")
+    sample_image_inference_batch(
+        accelerator, args, pipeline, save_dir, [prompt_dict], epoch, steps, prompt_replacement, controlnet=controlnet
+    )
+
+
+def sample_image_inference_batch(
+    accelerator: Accelerator,
+    args: argparse.Namespace,
+    pipeline: Union[StableDiffusionLongPromptWeightingPipeline, SdxlStableDiffusionLongPromptWeightingPipeline],
+    save_dir,
+    prompt_dicts: List[Dict],
+    epoch,
+    steps,
+    prompt_replacement,
+    controlnet=None,
+):
+    r"""
+    generate the images of the prompts in a batch. the prompts must have the same size, steps, scale and sampler (the first
+    prompt's are used), and at most one prompt can have controlnet_image. the initial noise of each image is generated from
+    its seed, so a batch of one prompt is same as before.
+    """
+    prompt_dict = prompt_dicts[0]
     sample_steps = prompt_dict.get("sample_steps", 30)
     width = prompt_dict.get("width", 512)
     height = prompt_dict.get("height", 512)
     scale = prompt_dict.get("scale", 7.5)
-    seed = prompt_dict.get("seed")
     controlnet_image = prompt_dict.get("controlnet_image")
-    prompt: str = prompt_dict.get("prompt", "")
     sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
 
-    if prompt_replacement is not None:
-        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-        if negative_prompt is not None:
-            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
-
-    if seed is not None:
-        torch.manual_seed(seed)
-        if torch.cuda.is_available():
-            torch.cuda.manual_seed(seed)
-    else:
-        # True random sample image generation
-        torch.seed()
-        if torch.cuda.is_available():
-            torch.cuda.seed()
+    prompts: List[str] = []
+    negative_prompts: List[str] = []
+    seeds: List[Optional[int]] = []
+    for prompt_dict in prompt_dicts:
+        prompt: str = prompt_dict.get("prompt", "")
+        negative_prompt = prompt_dict.get("negative_prompt")
+        if prompt_replacement is not None:
+            prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+            if negative_prompt is not None:
+                negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+        prompts.append(prompt)
+        negative_prompts.append(negative_prompt or "")
+        seeds.append(prompt_dict.get("seed"))
 
     scheduler = get_my_scheduler(
         sample_sampler=sampler_name,
@@ -6386,51 +6653,56 @@ def sample_image_inference(
 
     height = max(64, height - height % 8)  # round to divisible by 8
     width = max(64, width - width % 8)  # round to divisible by 8
-    logger.info(f"prompt: {prompt}")
-    logger.info(f"negative_prompt: {negative_prompt}")
+    for prompt, negative_prompt, seed in zip(prompts, negative_prompts, seeds):
+        logger.info(f"prompt: {prompt}")
+        logger.info(f"negative_prompt: {negative_prompt}")
+        if seed is not None:
+            logger.info(f"seed: {seed}")
     logger.info(f"height: {height}")
     logger.info(f"width: {width}")
     logger.info(f"sample_steps: {sample_steps}")
     logger.info(f"scale: {scale}")
     logger.info(f"sample_sampler: {sampler_name}")
-    if seed is not None:
-        logger.info(f"seed: {seed}")
+    if len(prompts) > 1:
+        logger.info(f"batch size: {len(prompts)}")
     with accelerator.autocast():
         latents = pipeline(
-            prompt=prompt,
+            prompt=prompts,
             height=height,
             width=width,
             num_inference_steps=sample_steps,
             guidance_scale=scale,
-            negative_prompt=negative_prompt,
+            negative_prompt=negative_prompts,
             controlnet=controlnet,
             controlnet_image=controlnet_image,
+            seeds=seeds,
         )
 
     if torch.cuda.is_available():
         with torch.cuda.device(torch.cuda.current_device()):
             torch.cuda.empty_cache()
 
-    image = pipeline.latents_to_image(latents)[0]
+    images = pipeline.latents_to_image(latents)
 
     # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
     # but adding 'enum' to the filename should be enough
 
-    ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-    num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-    seed_suffix = "" if seed is None else f"_{seed}"
-    i: int = prompt_dict["enum"]
-    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
+    for prompt_dict, prompt, seed, image in zip(prompt_dicts, prompts, seeds, images):
+        ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+        seed_suffix = "" if seed is None else f"_{seed}"
+        i: int = prompt_dict["enum"]
+        img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
+        image.save(os.path.join(save_dir, img_filename))
 
-    # send images to wandb if enabled
-    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
-        wandb_tracker = accelerator.get_tracker("wandb")
+        # send images to wandb if enabled
+        if "wandb" in [tracker.name for tracker in accelerator.trackers]:
+            wandb_tracker = accelerator.get_tracker("wandb")
 
-        import wandb
+            import wandb
 
-        # not to commit images to avoid inconsistency between training and logging steps
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+            # not to commit images to avoid inconsistency between training and logging steps
+            wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
 
 
 def init_trackers(accelerator: Accelerator, args: argparse.Namespace, default_tracker_name: str):
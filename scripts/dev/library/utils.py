@@ -1,3 +1,4 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import sys
 import threading
@@ -21,6 +22,46 @@ def fire_in_thread(f, *args, **kwargs):
     threading.Thread(target=f, args=args, kwargs=kwargs).start()
 
 
+class BoundedThreadPoolExecutor:
+    r"""
+    ThreadPoolExecutor with a bounded number of pending tasks. `submit` blocks while `max_pending` tasks are not finished,
+    so a fast producer cannot queue unlimited work (and memory). Exceptions in tasks are raised on the next `submit` or `shutdown`.
+    """
+
+    def __init__(self, max_workers: int, max_pending: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending or max_workers * 2)
+        self.futures: List[Future] = []
+
+    def _check_done(self):
+        not_done = []
+        for future in self.futures:
+            if future.done():
+                future.result()  # raise exception if any
+            else:
+                not_done.append(future)
+        self.futures = not_done
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self._check_done()
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self.semaphore.release())
+        self.futures.append(future)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+        if wait:
+            futures, self.futures = self.futures, []
+            for future in futures:
+                future.result()
+
+
 # region Logging
 
 
@@ -260,6 +301,138 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
                 v.contiguous().view(torch.uint8).numpy().tofile(f)
 
 
+# dtype order of safetensors (Rust Dtype enum). safetensors.torch.save sorts tensors by dtype (descending) and then by name
+_SAFETENSORS_DTYPE_ORDER = ["BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "F64", "I64", "U64"]
+
+
+def safetensors_dtype_name(dtype: torch.dtype) -> str:
+    names = {
+        torch.float64: "F64",
+        torch.float32: "F32",
+        torch.float16: "F16",
+        torch.bfloat16: "BF16",
+        torch.int64: "I64",
+        torch.int32: "I32",
+        torch.int16: "I16",
+        torch.int8: "I8",
+        torch.uint8: "U8",
+        torch.bool: "BOOL",
+    }
+    if hasattr(torch, "float8_e5m2"):
+        names[torch.float8_e5m2] = "F8_E5M2"
+    if hasattr(torch, "float8_e4m3fn"):
+        names[torch.float8_e4m3fn] = "F8_E4M3"
+    return names[dtype]
+
+
+def safetensors_tensor_bytes(tensor: torch.Tensor) -> np.ndarray:
+    """raw bytes of the tensor as stored in the data section of safetensors, as uint8 array (a view if possible)"""
+    v = tensor.detach().to("cpu").contiguous()
+    if v.dim() == 0:
+        v = v.unsqueeze(0)
+    return v.view(torch.uint8).numpy()
+
+
+def build_safetensors_header(
+    specs: Dict[str, Tuple[torch.dtype, Sequence[int]]], metadata: Optional[Dict[str, str]] = None
+) -> Tuple[bytes, List[Tuple[str, int, int]]]:
+    """
+    build the header of a safetensors file in the same layout as `safetensors.torch.save`: tensors sorted by dtype
+    (descending) and name, no padding between tensors, header JSON padded with spaces to a multiple of 8 bytes.
+
+    Args:
+        specs: tensor name -> (dtype, shape)
+        metadata: `__metadata__` of the file, omitted if None
+
+    Returns:
+        the first bytes of the file (8 bytes header length + header), and [(name, start, end)] of the data section
+    """
+    entries = []
+    for name, (dtype, shape) in specs.items():
+        dtype_name = safetensors_dtype_name(dtype)
+        numel = 1
+        for s in shape:
+            numel *= s
+        nbytes = numel * torch.empty(0, dtype=dtype).element_size()
+        entries.append((name, dtype_name, [int(s) for s in shape], nbytes))
+    entries.sort(key=lambda e: (-_SAFETENSORS_DTYPE_ORDER.index(e[1]), e[0]))
+
+    header = {}
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    layout = []
+    offset = 0
+    for name, dtype_name, shape, nbytes in entries:
+        header[name] = {"dtype": dtype_name, "shape": shape, "data_offsets": [offset, offset + nbytes]}
+        layout.append((name, offset, offset + nbytes))
+        offset += nbytes
+
+    # same as serde_json: compact, non-ASCII characters are not escaped
+    hjson = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    hjson += b" " * (-len(hjson) % 8)
+    return struct.pack("<Q", len(hjson)) + hjson, layout
+
+
+class MemoryEfficientSafeWriter:
+    """
+    Write a safetensors file tensor by tensor. Names, dtypes and shapes are declared first, then tensors are written
+    in any order, so only one tensor has to be in memory at a time. The layout is the same as `safetensors.torch.save`.
+
+    `update_metadata` rewrites the header after the tensors are written (e.g. to add hashes of the data), as long as
+    the new header is not longer than the first one: reserve the space with placeholder values of the same length.
+    """
+
+    def __init__(self, filename: str, specs: Dict[str, Tuple[torch.dtype, Sequence[int]]], metadata: Optional[Dict[str, str]] = None):
+        self.filename = filename
+        self.specs = {k: (dtype, [int(s) for s in shape]) for k, (dtype, shape) in specs.items()}
+        self.header, layout = build_safetensors_header(self.specs, metadata)
+        self.offsets = {name: (start, end) for name, start, end in layout}
+        self.written = set()
+
+        self.file = open(filename, "wb")
+        self.file.write(self.header)
+        data_size = layout[-1][2] if layout else 0
+        self.file.truncate(len(self.header) + data_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # do not hide the original error by the check of unwritten tensors
+            self.written = set(self.specs.keys())
+        self.close()
+
+    def write(self, key: str, tensor: torch.Tensor):
+        dtype, shape = self.specs[key]
+        if tensor.dtype != dtype or list(tensor.shape) != shape:
+            raise ValueError(f"tensor {key} is {tensor.dtype} {list(tensor.shape)}, but declared as {dtype} {shape}")
+
+        start, end = self.offsets[key]
+        if end > start:
+            self.file.seek(len(self.header) + start)
+            safetensors_tensor_bytes(tensor).tofile(self.file)
+        self.written.add(key)
+
+    def update_metadata(self, metadata: Optional[Dict[str, str]]):
+        header, _ = build_safetensors_header(self.specs, metadata)
+        if len(header) > len(self.header):
+            raise ValueError("new header is longer than the reserved one / 新しいヘッダーが長すぎます")
+        # keep the header length, pad the JSON with spaces
+        hjson = header[8:] + b" " * (len(self.header) - len(header))
+        self.file.seek(0)
+        self.file.write(struct.pack("<Q", len(hjson)) + hjson)
+
+    def close(self):
+        if self.file is None:
+            return
+        missing = set(self.specs.keys()) - self.written
+        self.file.close()
+        self.file = None
+        if missing:
+            raise ValueError(f"tensors are not written / 書き込まれていないテンソルがあります: {sorted(missing)[:10]}")
+
+
 class MemoryEfficientSafeOpen:
     def __init__(self, filename):
         self.filename = filename
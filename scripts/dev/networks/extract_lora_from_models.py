@@ -9,7 +9,7 @@ import time
 import torch
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, model_util, sdxl_model_util
+from library import sai_model_spec, model_util, sdxl_model_util, svd_utils
 import lora
 from library.utils import setup_logging
 setup_logging()
@@ -49,6 +49,11 @@ def svd(
     load_precision=None,
     load_original_model_to=None,
     load_tuned_model_to=None,
+    svd_mode="exact",
+    svd_oversample=8,
+    svd_niter=2,
+    svd_workers=None,
+    svd_verify=False,
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -170,11 +175,11 @@ def svd(
 
     # make LoRA with svd
     logger.info("calculating by svd")
-    lora_weights = {}
-    with torch.no_grad():
-        for lora_name, mat in tqdm(list(diffs.items())):
-            if args.device:
-                mat = mat.to(args.device)
+    decomposer = svd_utils.LowRankDecomposer(svd_mode, device, svd_oversample, svd_niter, svd_workers, svd_verify)
+    shapes = {}  # lora_name -> (out_dim, in_dim, kernel_size)
+
+    def svd_items():
+        for lora_name, mat in diffs.items():
             mat = mat.to(torch.float)  # calc by float
 
             # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
@@ -184,9 +189,7 @@ def svd(
 
             rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
             out_dim, in_dim = mat.size()[0:2]
-
-            if device:
-                mat = mat.to(device)
+            shapes[lora_name] = (out_dim, in_dim, kernel_size)
 
             # logger.info(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
             rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
@@ -197,13 +200,15 @@ def svd(
                 else:
                     mat = mat.squeeze()
 
-            U, S, Vh = torch.linalg.svd(mat)
+            yield lora_name, mat, rank
 
-            U = U[:, :rank]
-            S = S[:rank]
-            U = U @ torch.diag(S)
+    lora_weights = {}
+    with torch.no_grad():
+        for lora_name, U, S, Vh, _ in tqdm(decomposer.decompose(svd_items()), total=len(diffs)):
+            out_dim, in_dim, kernel_size = shapes[lora_name]
+            rank = S.size()[0]
 
-            Vh = Vh[:rank, :]
+            U = U @ torch.diag(S)
 
             dist = torch.cat([U.flatten(), Vh.flatten()])
             hi_val = torch.quantile(dist, clamp_quantile)
@@ -212,7 +217,7 @@ def svd(
             U = U.clamp(low_val, hi_val)
             Vh = Vh.clamp(low_val, hi_val)
 
-            if conv2d:
+            if kernel_size is not None:
                 U = U.reshape(out_dim, rank, 1, 1)
                 Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
 
@@ -220,6 +225,7 @@ def svd(
             Vh = Vh.to(work_device, dtype=save_dtype).contiguous()
 
             lora_weights[lora_name] = (U, Vh)
+    decomposer.log_summary()
 
     # make state dict for LoRA
     lora_sd = {}
@@ -349,6 +355,7 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="location to load tuned model, cpu or cuda, cuda:0, etc, default is cpu, only for SDXL / 派生モデル読み込み先、cpuまたはcuda、cuda:0など、省略時はcpu、SDXLのみ有効",
     )
+    svd_utils.add_svd_arguments(parser)
 
     return parser
 
@@ -10,7 +10,7 @@ import torch
 from safetensors.torch import load_file, save_file
 from safetensors import safe_open
 from tqdm import tqdm
-from library import flux_utils, sai_model_spec, model_util, sdxl_model_util
+from library import flux_utils, sai_model_spec, model_util, sdxl_model_util, svd_utils
 import lora
 from library.utils import MemoryEfficientSafeOpen
 from library.utils import setup_logging
@@ -45,6 +45,11 @@ def svd(
     min_diff=0.01,
     no_metadata=False,
     mem_eff_safe_open=False,
+    svd_mode="exact",
+    svd_oversample=8,
+    svd_niter=2,
+    svd_workers=None,
+    svd_verify=False,
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -81,29 +86,26 @@ def svd(
             keys.append(key)
 
         with open_fn(model_tuned) as f_tuned:
-            for key in tqdm(keys):
-                # get tensors and calculate difference
-                value_o = f_org.get_tensor(key)
-                value_t = f_tuned.get_tensor(key)
-                mat = value_t.to(calc_dtype) - value_o.to(calc_dtype)
-                del value_o, value_t
 
-                # extract LoRA weights
-                if device:
-                    mat = mat.to(device)
-                out_dim, in_dim = mat.size()[0:2]
-                rank = min(dim, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+            def svd_items():
+                for key in keys:
+                    # get tensors and calculate difference
+                    value_o = f_org.get_tensor(key)
+                    value_t = f_tuned.get_tensor(key)
+                    mat = value_t.to(calc_dtype) - value_o.to(calc_dtype)
+                    del value_o, value_t
 
-                mat = mat.squeeze()
+                    out_dim, in_dim = mat.size()[0:2]
+                    rank = min(dim, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
 
-                U, S, Vh = torch.linalg.svd(mat)
+                    mat = mat.squeeze()
+                    yield key, mat, rank
 
-                U = U[:, :rank]
-                S = S[:rank]
+            # extract LoRA weights
+            decomposer = svd_utils.LowRankDecomposer(svd_mode, device, svd_oversample, svd_niter, svd_workers, svd_verify)
+            for key, U, S, Vh, _ in tqdm(decomposer.decompose(svd_items()), total=len(keys)):
                 U = U @ torch.diag(S)
 
-                Vh = Vh[:rank, :]
-
                 dist = torch.cat([U.flatten(), Vh.flatten()])
                 hi_val = torch.quantile(dist, clamp_quantile)
                 low_val = -hi_val
@@ -116,7 +118,8 @@ def svd(
 
                 # print(f"key: {key}, U: {U.size()}, Vh: {Vh.size()}")
                 lora_weights[key] = (U, Vh)
-                del mat, U, S, Vh
+                del U, S, Vh
+            decomposer.log_summary()
 
     # make state dict for LoRA
     lora_sd = {}
@@ -209,6 +212,7 @@ def setup_parser() -> argparse.ArgumentParser:
         help="do not save sai modelspec metadata (minimum ss_metadata for LoRA is saved) / "
         + "sai modelspecのメタデータを保存しない（LoRAの最低限のss_metadataは保存される）",
     )
+    svd_utils.add_svd_arguments(parser)
     return parser
 
 
@@ -18,6 +18,7 @@ logger = logging.getLogger(__name__)
 
 import lora_flux as lora_flux
 from library import sai_model_spec, train_util
+from library.lora_merge_utils import StreamingLoRAMerger
 
 
 def load_state_dict(file_name, dtype):
@@ -444,110 +445,16 @@ def merge_to_flux_model_diffusers(
 
 
 def merge_lora_models(models, ratios, merge_dtype, concat=False, shuffle=False):
-    base_alphas = {}  # alpha for merged model
-    base_dims = {}
-
-    merged_sd = {}
-    base_model = None
-    for model, ratio in zip(models, ratios):
-        logger.info(f"loading: {model}")
-        lora_sd, lora_metadata = load_state_dict(model, merge_dtype)
-
-        if lora_metadata is not None:
-            if base_model is None:
-                base_model = lora_metadata.get(train_util.SS_METADATA_KEY_BASE_MODEL_VERSION, None)
-
-        # get alpha and dim
-        alphas = {}  # alpha for current model
-        dims = {}  # dims for current model
-        for key in lora_sd.keys():
-            if "alpha" in key:
-                lora_module_name = key[: key.rfind(".alpha")]
-                alpha = float(lora_sd[key].detach().numpy())
-                alphas[lora_module_name] = alpha
-                if lora_module_name not in base_alphas:
-                    base_alphas[lora_module_name] = alpha
-            elif "lora_down" in key:
-                lora_module_name = key[: key.rfind(".lora_down")]
-                dim = lora_sd[key].size()[0]
-                dims[lora_module_name] = dim
-                if lora_module_name not in base_dims:
-                    base_dims[lora_module_name] = dim
-
-        for lora_module_name in dims.keys():
-            if lora_module_name not in alphas:
-                alpha = dims[lora_module_name]
-                alphas[lora_module_name] = alpha
-                if lora_module_name not in base_alphas:
-                    base_alphas[lora_module_name] = alpha
-
-        logger.info(f"dim: {list(set(dims.values()))}, alpha: {list(set(alphas.values()))}")
-
-        # merge
+    merger = StreamingLoRAMerger(models, ratios, merge_dtype, concat, shuffle)
+    try:
         logger.info("merging...")
-        for key in tqdm(lora_sd.keys()):
-            if "alpha" in key:
-                continue
-
-            if "lora_up" in key and concat:
-                concat_dim = 1
-            elif "lora_down" in key and concat:
-                concat_dim = 0
-            else:
-                concat_dim = None
-
-            lora_module_name = key[: key.rfind(".lora_")]
-
-            base_alpha = base_alphas[lora_module_name]
-            alpha = alphas[lora_module_name]
-
-            scale = math.sqrt(alpha / base_alpha) * ratio
-            scale = abs(scale) if "lora_up" in key else scale  # マイナスの重みに対応する。
-
-            if key in merged_sd:
-                assert (
-                    merged_sd[key].size() == lora_sd[key].size() or concat_dim is not None
-                ), "weights shape mismatch, different dims? / 重みのサイズが合いません。dimが異なる可能性があります。"
-                if concat_dim is not None:
-                    merged_sd[key] = torch.cat([merged_sd[key], lora_sd[key] * scale], dim=concat_dim)
-                else:
-                    merged_sd[key] = merged_sd[key] + lora_sd[key] * scale
-            else:
-                merged_sd[key] = lora_sd[key] * scale
-
-    # set alpha to sd
-    for lora_module_name, alpha in base_alphas.items():
-        key = lora_module_name + ".alpha"
-        merged_sd[key] = torch.tensor(alpha)
-        if shuffle:
-            key_down = lora_module_name + ".lora_down.weight"
-            key_up = lora_module_name + ".lora_up.weight"
-            dim = merged_sd[key_down].shape[0]
-            perm = torch.randperm(dim)
-            merged_sd[key_down] = merged_sd[key_down][perm]
-            merged_sd[key_up] = merged_sd[key_up][:, perm]
-
-    logger.info("merged model")
-    logger.info(f"dim: {list(set(base_dims.values()))}, alpha: {list(set(base_alphas.values()))}")
-
-    # check all dims are same
-    dims_list = list(set(base_dims.values()))
-    alphas_list = list(set(base_alphas.values()))
-    all_same_dims = True
-    all_same_alphas = True
-    for dims in dims_list:
-        if dims != dims_list[0]:
-            all_same_dims = False
-            break
-    for alphas in alphas_list:
-        if alphas != alphas_list[0]:
-            all_same_alphas = False
-            break
+        merged_sd = merger.merge_to_state_dict()
+    finally:
+        merger.close()
 
     # build minimum metadata
-    dims = f"{dims_list[0]}" if all_same_dims else "Dynamic"
-    alphas = f"{alphas_list[0]}" if all_same_alphas else "Dynamic"
-    metadata = train_util.build_minimum_network_metadata(str(False), base_model, "networks.lora", dims, alphas, None)
+    dims, alphas = merger.get_dims_and_alphas_str()
+    metadata = train_util.build_minimum_network_metadata(str(False), merger.base_model, "networks.lora", dims, alphas, None)
 
     return merged_sd, metadata
 
@@ -634,24 +541,23 @@ def merge(args):
             save_to_file(args.t5xxl_save_to, t5xxl_state_dict, save_dtype, None, args.mem_eff_load_save)
 
     else:
-        flux_state_dict, metadata = merge_lora_models(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
-
-        logger.info("calculating hashes and creating metadata...")
-
-        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(flux_state_dict, metadata)
-        metadata["sshs_model_hash"] = model_hash
-        metadata["sshs_legacy_hash"] = legacy_hash
-
-        if not args.no_metadata:
-            merged_from = sai_model_spec.build_merged_from(args.models)
-            title = os.path.splitext(os.path.basename(args.save_to))[0]
-            sai_metadata = sai_model_spec.build_metadata(
-                flux_state_dict, False, False, False, True, False, time.time(), title=title, merged_from=merged_from, flux="dev"
-            )
-            metadata.update(sai_metadata)
-
-        logger.info(f"saving model to: {args.save_to}")
-        save_to_file(args.save_to, flux_state_dict, save_dtype, metadata)
+        # merge module by module and write to the file directly, without holding the merged model in memory
+        merger = StreamingLoRAMerger(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
+        try:
+            dims, alphas = merger.get_dims_and_alphas_str()
+            metadata = train_util.build_minimum_network_metadata(str(False), merger.base_model, "networks.lora", dims, alphas, None)
+
+            if not args.no_metadata:
+                merged_from = sai_model_spec.build_merged_from(args.models)
+                title = os.path.splitext(os.path.basename(args.save_to))[0]
+                sai_metadata = sai_model_spec.build_metadata(
+                    None, False, False, False, True, False, time.time(), title=title, merged_from=merged_from, flux="dev"
+                )
+                metadata.update(sai_metadata)
+
+            merger.save(args.save_to, save_dtype, metadata)
+        finally:
+            merger.close()
 
 
 def setup_parser() -> argparse.ArgumentParser:
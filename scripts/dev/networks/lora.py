@@ -155,9 +155,34 @@ class LoRAInfModule(LoRAModule):
 
         self.network: LoRANetwork = None
 
+        # fused delta: the weights of the original module and all LoRAs on it are summed and cached, see get_fused_weight
+        self.fused_delta = False
+        self.fusable = False
+        self.fused_cache = None  # (key, fused weight)
+        self.lora_group = None
+
     def set_network(self, network):
         self.network = network
 
+    def apply_to(self):
+        org_module = self.org_module
+        super().apply_to()
+
+        # LoRAInfModules applied to the same module (by multiple networks), from inner to outer
+        if not hasattr(org_module, "_lora_inf_modules"):
+            org_module._lora_inf_modules = []
+        group = org_module._lora_inf_modules
+
+        # fusable only if the forward chain to the original module consists of LoRAInfModules
+        if group:
+            self.fusable = group[-1].fusable and self.org_forward == group[-1].forward
+        else:
+            self.fusable = isinstance(org_module, (torch.nn.Linear, torch.nn.Conv2d)) and (
+                getattr(self.org_forward, "__func__", None) is type(org_module).forward
+            )
+        group.append(self)
+        self.lora_group = group
+
     # freezeしてマージする
     def merge_to(self, sd, dtype, device):
         # get up/down weight
@@ -225,13 +250,60 @@ class LoRAInfModule(LoRAModule):
         # logger.info(f"default_forward {self.lora_name} {x.size()}")
         return self.org_forward(x) + self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
 
+    def is_default_forward(self):
+        # not regional / sub prompt in the current generation
+        if self.network is None or self.network.sub_prompt_index is None:
+            return True
+        return not self.regional and not self.use_sub_prompt
+
+    def get_fused_weight(self):
+        r"""
+        weight of the original module + ΔW of this and inner enabled LoRAs, cached until a multiplier or a weight is changed.
+        returns None if any of them can't be fused (regional / sub prompt), then forward falls back to the normal chain.
+        """
+        active = []
+        for lora in self.lora_group[: self.lora_group.index(self) + 1]:
+            if not lora.enabled:
+                continue  # passes through or already merged by pre_calculation
+            if not lora.fused_delta or not lora.is_default_forward():
+                return None
+            active.append(lora)
+
+        org_weight = self.org_module_ref[0].weight
+        key = (
+            org_weight._version,
+            org_weight.dtype,
+            org_weight.device,
+            tuple((id(lora), lora.multiplier, lora.lora_up.weight._version, lora.lora_down.weight._version) for lora in active),
+        )
+        if self.fused_cache is None or self.fused_cache[0] != key:
+            # only the outermost module in use keeps the cache
+            for lora in self.lora_group:
+                lora.fused_cache = None
+
+            with torch.no_grad():
+                weight = org_weight.to(torch.float)
+                for lora in active:
+                    weight = weight + lora.get_weight().to(weight.device)
+                self.fused_cache = (key, weight.to(org_weight.dtype))
+        return self.fused_cache[1]
+
+    def fused_forward(self, x, weight):
+        org_module = self.org_module_ref[0]
+        if isinstance(org_module, torch.nn.Conv2d):
+            return org_module._conv_forward(x, weight, org_module.bias)
+        return torch.nn.functional.linear(x, weight, org_module.bias)
+
     def forward(self, x):
         if not self.enabled:
             return self.org_forward(x)
 
-        if self.network is None or self.network.sub_prompt_index is None:
-            return self.default_forward(x)
-        if not self.regional and not self.use_sub_prompt:
+        if self.fused_delta and self.fusable:
+            weight = self.get_fused_weight()
+            if weight is not None:
+                return self.fused_forward(x, weight)
+
+        if self.is_default_forward():
             return self.default_forward(x)
 
         if self.regional:
@@ -1329,6 +1401,15 @@ class LoRANetwork(torch.nn.Module):
 
         self.mask_dic = mask_dic
 
+    def set_fused_delta(self, enabled: bool):
+        # 推論時、元の重みと全ネットワークのΔWを合算した重みをモジュールごとにキャッシュして1回の行列積で計算する
+        # the cache is invalidated automatically when a multiplier or a weight is changed, and it needs memory for a copy of the weights
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if isinstance(lora, LoRAInfModule):
+                lora.fused_delta = enabled
+                if not enabled:
+                    lora.fused_cache = None
+
     def backup_weights(self):
         # 重みのバックアップを行う
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
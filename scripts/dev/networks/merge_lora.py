@@ -7,6 +7,7 @@ from safetensors.torch import load_file, save_file
 from library import sai_model_spec, train_util
 import library.model_util as model_util
 import lora
+from library.lora_merge_utils import StreamingLoRAMerger
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -114,114 +115,18 @@ def merge_to_sd_model(text_encoder, unet, models, ratios, merge_dtype):
 
 
 def merge_lora_models(models, ratios, merge_dtype, concat=False, shuffle=False):
-    base_alphas = {}  # alpha for merged model
-    base_dims = {}
-
-    merged_sd = {}
-    v2 = None
-    base_model = None
-    for model, ratio in zip(models, ratios):
-        logger.info(f"loading: {model}")
-        lora_sd, lora_metadata = load_state_dict(model, merge_dtype)
-
-        if lora_metadata is not None:
-            if v2 is None:
-                v2 = lora_metadata.get(train_util.SS_METADATA_KEY_V2, None)  # return string
-            if base_model is None:
-                base_model = lora_metadata.get(train_util.SS_METADATA_KEY_BASE_MODEL_VERSION, None)
-
-        # get alpha and dim
-        alphas = {}  # alpha for current model
-        dims = {}  # dims for current model
-        for key in lora_sd.keys():
-            if "alpha" in key:
-                lora_module_name = key[: key.rfind(".alpha")]
-                alpha = float(lora_sd[key].detach().numpy())
-                alphas[lora_module_name] = alpha
-                if lora_module_name not in base_alphas:
-                    base_alphas[lora_module_name] = alpha
-            elif "lora_down" in key:
-                lora_module_name = key[: key.rfind(".lora_down")]
-                dim = lora_sd[key].size()[0]
-                dims[lora_module_name] = dim
-                if lora_module_name not in base_dims:
-                    base_dims[lora_module_name] = dim
-
-        for lora_module_name in dims.keys():
-            if lora_module_name not in alphas:
-                alpha = dims[lora_module_name]
-                alphas[lora_module_name] = alpha
-                if lora_module_name not in base_alphas:
-                    base_alphas[lora_module_name] = alpha
-
-        logger.info(f"dim: {list(set(dims.values()))}, alpha: {list(set(alphas.values()))}")
-
-        # merge
-        logger.info(f"merging...")
-        for key in lora_sd.keys():
-            if "alpha" in key:
-                continue
-            if "lora_up" in key and concat:
-                concat_dim = 1
-            elif "lora_down" in key and concat:
-                concat_dim = 0
-            else:
-                concat_dim = None
-
-            lora_module_name = key[: key.rfind(".lora_")]
-
-            base_alpha = base_alphas[lora_module_name]
-            alpha = alphas[lora_module_name]
-
-            scale = math.sqrt(alpha / base_alpha) * ratio
-            scale = abs(scale) if "lora_up" in key else scale # マイナスの重みに対応する。
-
-            if key in merged_sd:
-                assert (
-                    merged_sd[key].size() == lora_sd[key].size() or concat_dim is not None
-                ), f"weights shape mismatch merging v1 and v2, different dims? / 重みのサイズが合いません。v1とv2、または次元数の異なるモデルはマージできません"
-                if concat_dim is not None:
-                    merged_sd[key] = torch.cat([merged_sd[key], lora_sd[key] * scale], dim=concat_dim)
-                else:
-                    merged_sd[key] = merged_sd[key] + lora_sd[key] * scale
-            else:
-                merged_sd[key] = lora_sd[key] * scale
-
-    # set alpha to sd
-    for lora_module_name, alpha in base_alphas.items():
-        key = lora_module_name + ".alpha"
-        merged_sd[key] = torch.tensor(alpha)
-        if shuffle:
-            key_down = lora_module_name + ".lora_down.weight"
-            key_up = lora_module_name + ".lora_up.weight"
-            dim = merged_sd[key_down].shape[0]
-            perm = torch.randperm(dim)
-            merged_sd[key_down] = merged_sd[key_down][perm]
-            merged_sd[key_up] = merged_sd[key_up][:,perm]
-
-    logger.info("merged model")
-    logger.info(f"dim: {list(set(base_dims.values()))}, alpha: {list(set(base_alphas.values()))}")
-
-    # check all dims are same
-    dims_list = list(set(base_dims.values()))
-    alphas_list = list(set(base_alphas.values()))
-    all_same_dims = True
-    all_same_alphas = True
-    for dims in dims_list:
-        if dims != dims_list[0]:
-            all_same_dims = False
-            break
-    for alphas in alphas_list:
-        if alphas != alphas_list[0]:
-            all_same_alphas = False
-            break
+    merger = StreamingLoRAMerger(models, ratios, merge_dtype, concat, shuffle)
+    try:
+        logger.info("merging...")
+        merged_sd = merger.merge_to_state_dict()
+    finally:
+        merger.close()
 
     # build minimum metadata
-    dims = f"{dims_list[0]}" if all_same_dims else "Dynamic"
-    alphas = f"{alphas_list[0]}" if all_same_alphas else "Dynamic"
-    metadata = train_util.build_minimum_network_metadata(v2, base_model, "networks.lora", dims, alphas, None)
+    dims, alphas = merger.get_dims_and_alphas_str()
+    metadata = train_util.build_minimum_network_metadata(merger.v2, merger.base_model, "networks.lora", dims, alphas, None)
 
-    return merged_sd, metadata, v2 == "True"
+    return merged_sd, metadata, merger.v2 == "True"
 
 
 def merge(args):
@@ -276,29 +181,41 @@ def merge(args):
             args.v2, args.save_to, text_encoder, unet, args.sd_model, 0, 0, sai_metadata, save_dtype, vae
         )
     else:
-        state_dict, metadata, v2 = merge_lora_models(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
-
-        logger.info(f"calculating hashes and creating metadata...")
-
-        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-        metadata["sshs_model_hash"] = model_hash
-        metadata["sshs_legacy_hash"] = legacy_hash
-
-        if not args.no_metadata:
-            merged_from = sai_model_spec.build_merged_from(args.models)
-            title = os.path.splitext(os.path.basename(args.save_to))[0]
-            sai_metadata = sai_model_spec.build_metadata(
-                state_dict, v2, v2, False, True, False, time.time(), title=title, merged_from=merged_from
-            )
-            if v2:
-                # TODO read sai modelspec
-                logger.warning(
-                    "Cannot determine if LoRA is for v-prediction, so save metadata as v-prediction / LoRAがv-prediction用か否か不明なため、仮にv-prediction用としてmetadataを保存します"
+        merger = StreamingLoRAMerger(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
+        try:
+            v2 = merger.v2 == "True"  # metadata is string
+            dims, alphas = merger.get_dims_and_alphas_str()
+            metadata = train_util.build_minimum_network_metadata(merger.v2, merger.base_model, "networks.lora", dims, alphas, None)
+
+            if not args.no_metadata:
+                merged_from = sai_model_spec.build_merged_from(args.models)
+                title = os.path.splitext(os.path.basename(args.save_to))[0]
+                sai_metadata = sai_model_spec.build_metadata(
+                    None, v2, v2, False, True, False, time.time(), title=title, merged_from=merged_from
                 )
-            metadata.update(sai_metadata)
+                if v2:
+                    # TODO read sai modelspec
+                    logger.warning(
+                        "Cannot determine if LoRA is for v-prediction, so save metadata as v-prediction / LoRAがv-prediction用か否か不明なため、仮にv-prediction用としてmetadataを保存します"
+                    )
+                metadata.update(sai_metadata)
 
-        logger.info(f"saving model to: {args.save_to}")
-        save_to_file(args.save_to, state_dict, state_dict, save_dtype, metadata)
+            if os.path.splitext(args.save_to)[1] == ".safetensors":
+                # merge module by module and write to the file directly, without holding the merged model in memory
+                merger.save(args.save_to, save_dtype, metadata)
+            else:
+                logger.info(f"merging...")
+                state_dict = merger.merge_to_state_dict()
+
+                logger.info(f"calculating hashes and creating metadata...")
+                model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
+                metadata["sshs_model_hash"] = model_hash
+                metadata["sshs_legacy_hash"] = legacy_hash
+
+                logger.info(f"saving model to: {args.save_to}")
+                save_to_file(args.save_to, state_dict, state_dict, save_dtype, metadata)
+        finally:
+            merger.close()
 
 
 def setup_parser() -> argparse.ArgumentParser:
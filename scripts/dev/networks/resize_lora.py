@@ -11,6 +11,7 @@ import numpy as np
 
 from library import train_util
 from library import model_util
+from library import svd_utils
 from library.utils import setup_logging
 
 setup_logging()
@@ -78,43 +79,6 @@ def index_sv_ratio(S, target):
 
 
 # Modified from Kohaku-blueleaf's extract/merge functions
-def extract_conv(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
-    out_size, in_size, kernel_size, _ = weight.size()
-    U, S, Vh = torch.linalg.svd(weight.reshape(out_size, -1).to(device))
-
-    param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
-    lora_rank = param_dict["new_rank"]
-
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
-
-    param_dict["lora_down"] = Vh.reshape(lora_rank, in_size, kernel_size, kernel_size).cpu()
-    param_dict["lora_up"] = U.reshape(out_size, lora_rank, 1, 1).cpu()
-    del U, S, Vh, weight
-    return param_dict
-
-
-def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
-    out_size, in_size = weight.size()
-
-    U, S, Vh = torch.linalg.svd(weight.to(device))
-
-    param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
-    lora_rank = param_dict["new_rank"]
-
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
-
-    param_dict["lora_down"] = Vh.reshape(lora_rank, in_size).cpu()
-    param_dict["lora_up"] = U.reshape(out_size, lora_rank).cpu()
-    del U, S, Vh, weight
-    return param_dict
-
-
 def merge_conv(lora_down, lora_up, device):
     in_rank, in_size, kernel_size, k_ = lora_down.shape
     out_size, out_rank, _, _ = lora_up.shape
@@ -191,7 +155,9 @@ def rank_resize(S, rank, dynamic_method, dynamic_param, scale=1):
     return param_dict
 
 
-def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dynamic_method, dynamic_param, verbose):
+def resize_lora_model(
+    lora_sd, new_rank, new_conv_rank, save_dtype, device, dynamic_method, dynamic_param, verbose, decomposer=None
+):
     network_alpha = None
     network_dim = None
     verbose_str = "\n"
@@ -215,73 +181,93 @@ def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dyna
             f"Dynamically determining new alphas and dims based off {dynamic_method}: {dynamic_param}, max rank is {new_rank}"
         )
 
-    lora_down_weight = None
-    lora_up_weight = None
+    if decomposer is None:
+        decomposer = svd_utils.LowRankDecomposer(device=device)
 
     o_lora_sd = lora_sd.copy()
-    block_down_name = None
-    block_up_name = None
+    modules = {}  # block name -> (conv2d, size of lora_down, size of lora_up, scale)
 
-    with torch.no_grad():
-        for key, value in tqdm(lora_sd.items()):
-            weight_name = None
-            if "lora_down" in key:
-                block_down_name = key.rsplit(".lora_down", 1)[0]
-                weight_name = key.rsplit(".", 1)[-1]
-                lora_down_weight = value
-            else:
+    def svd_items():
+        for key, value in lora_sd.items():
+            if "lora_down" not in key:
                 continue
+            block_down_name = key.rsplit(".lora_down", 1)[0]
+            weight_name = key.rsplit(".", 1)[-1]
+            lora_down_weight = value
 
             # find corresponding lora_up and alpha
-            block_up_name = block_down_name
-            lora_up_weight = lora_sd.get(block_up_name + ".lora_up." + weight_name, None)
+            lora_up_weight = lora_sd.get(block_down_name + ".lora_up." + weight_name, None)
             lora_alpha = lora_sd.get(block_down_name + ".alpha", None)
+            if lora_up_weight is None:
+                continue
+
+            conv2d = len(lora_down_weight.size()) == 4
+            if lora_alpha is None:
+                scale = 1.0
+            else:
+                scale = lora_alpha / lora_down_weight.size()[0]
+            modules[block_down_name] = (conv2d, lora_down_weight.size(), lora_up_weight.size(), scale)
+
+            if decomposer.mode == "fast":
+                # the weight is already low rank: SVD from the factors is exact and does not need the full matrix
+                up = lora_up_weight.reshape(lora_up_weight.size()[0], -1)
+                down = lora_down_weight.reshape(lora_down_weight.size()[0], -1)
+                yield block_down_name, (up, down), None
+            elif conv2d:
+                full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
+                yield block_down_name, full_weight_matrix.reshape(full_weight_matrix.size()[0], -1), None
+            else:
+                yield block_down_name, merge_linear(lora_down_weight, lora_up_weight, device), None
+
+    num_modules = len([key for key in lora_sd.keys() if "lora_down" in key])
+    with torch.no_grad():
+        for block_down_name, U, S, Vh, _ in tqdm(decomposer.decompose(svd_items()), total=num_modules):
+            block_up_name = block_down_name
+            conv2d, down_size, up_size, scale = modules[block_down_name]
+
+            param_dict = rank_resize(S, new_conv_rank if conv2d else new_rank, dynamic_method, dynamic_param, scale)
+            lora_rank = param_dict["new_rank"]
+            if lora_rank > len(S):
+                # the rank is larger than the original one: pad with zero
+                U = torch.nn.functional.pad(U, (0, lora_rank - len(S)))
+                Vh = torch.nn.functional.pad(Vh, (0, 0, 0, lora_rank - len(S)))
+                S = torch.nn.functional.pad(S, (0, lora_rank - len(S)))
+
+            U = U[:, :lora_rank]
+            S = S[:lora_rank]
+            U = U @ torch.diag(S)
+            Vh = Vh[:lora_rank, :]
+
+            if conv2d:
+                lora_down = Vh.reshape(lora_rank, *down_size[1:])
+                lora_up = U.reshape(up_size[0], lora_rank, 1, 1)
+            else:
+                lora_down = Vh.reshape(lora_rank, down_size[1])
+                lora_up = U.reshape(up_size[0], lora_rank)
+            del U, S, Vh
+
+            if verbose:
+                max_ratio = param_dict["max_ratio"]
+                sum_retained = param_dict["sum_retained"]
+                fro_retained = param_dict["fro_retained"]
+                if not np.isnan(fro_retained):
+                    fro_list.append(float(fro_retained))
+
+                verbose_str += f"{block_down_name:75} | "
+                verbose_str += (
+                    f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
+                )
+
+            if verbose and dynamic_method:
+                verbose_str += f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
+            else:
+                verbose_str += "\n"
 
-            weights_loaded = lora_down_weight is not None and lora_up_weight is not None
-
-            if weights_loaded:
-
-                conv2d = len(lora_down_weight.size()) == 4
-                if lora_alpha is None:
-                    scale = 1.0
-                else:
-                    scale = lora_alpha / lora_down_weight.size()[0]
-
-                if conv2d:
-                    full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
-                    param_dict = extract_conv(full_weight_matrix, new_conv_rank, dynamic_method, dynamic_param, device, scale)
-                else:
-                    full_weight_matrix = merge_linear(lora_down_weight, lora_up_weight, device)
-                    param_dict = extract_linear(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale)
-
-                if verbose:
-                    max_ratio = param_dict["max_ratio"]
-                    sum_retained = param_dict["sum_retained"]
-                    fro_retained = param_dict["fro_retained"]
-                    if not np.isnan(fro_retained):
-                        fro_list.append(float(fro_retained))
-
-                    verbose_str += f"{block_down_name:75} | "
-                    verbose_str += (
-                        f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
-                    )
-
-                if verbose and dynamic_method:
-                    verbose_str += f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
-                else:
-                    verbose_str += "\n"
-
-                new_alpha = param_dict["new_alpha"]
-                o_lora_sd[block_down_name + "." + "lora_down.weight"] = param_dict["lora_down"].to(save_dtype).contiguous()
-                o_lora_sd[block_up_name + "." + "lora_up.weight"] = param_dict["lora_up"].to(save_dtype).contiguous()
-                o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict["new_alpha"]).to(save_dtype)
-
-                block_down_name = None
-                block_up_name = None
-                lora_down_weight = None
-                lora_up_weight = None
-                weights_loaded = False
-                del param_dict
+            new_alpha = param_dict["new_alpha"]
+            o_lora_sd[block_down_name + "." + "lora_down.weight"] = lora_down.to(save_dtype).contiguous()
+            o_lora_sd[block_up_name + "." + "lora_up.weight"] = lora_up.to(save_dtype).contiguous()
+            o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict["new_alpha"]).to(save_dtype)
+            del param_dict
 
     if verbose:
         print(verbose_str)
@@ -322,8 +308,17 @@ def resize(args):
     lora_sd, metadata = load_state_dict(args.model, merge_dtype)
 
     logger.info("Resizing Lora...")
+    decomposer = svd_utils.create_decomposer(args, args.device)
     state_dict, old_dim, new_alpha = resize_lora_model(
-        lora_sd, args.new_rank, args.new_conv_rank, save_dtype, args.device, args.dynamic_method, args.dynamic_param, args.verbose
+        lora_sd,
+        args.new_rank,
+        args.new_conv_rank,
+        save_dtype,
+        args.device,
+        args.dynamic_method,
+        args.dynamic_param,
+        args.verbose,
+        decomposer,
     )
 
     # update metadata
@@ -401,6 +396,7 @@ def setup_parser() -> argparse.ArgumentParser:
         help="Specify dynamic resizing method, --new_rank is used as a hard limit for max rank",
     )
     parser.add_argument("--dynamic_param", type=float, default=None, help="Specify target for dynamic reduction")
+    svd_utils.add_svd_arguments(parser)
 
     return parser
 
@@ -7,7 +7,7 @@ import time
 import torch
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, train_util
+from library import sai_model_spec, svd_utils, train_util
 import library.model_util as model_util
 import lora
 from library.utils import setup_logging
@@ -250,7 +250,7 @@ def format_lbws(lbws):
     return lbws, is_sdxl, LBW_TARGET_IDX
 
 
-def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype):
+def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype, decomposer=None):
     logger.info(f"new rank: {new_rank}, new conv rank: {new_conv_rank}")
     merged_sd = {}
     v2 = None  # This is meaning LoRA Metadata v2, Not meaning SD2
@@ -340,16 +340,18 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
 
     # extract from merged weights
     logger.info("extract new lora...")
-    merged_lora_sd = {}
-    with torch.no_grad():
-        for lora_module_name, mat in tqdm(list(merged_sd.items())):
-            if device:
-                mat = mat.to(device)
+    if decomposer is None:
+        decomposer = svd_utils.LowRankDecomposer(device=device)
+
+    shapes = {}  # lora_module_name -> (out_dim, in_dim, kernel_size)
 
+    def svd_items():
+        for lora_module_name, mat in merged_sd.items():
             conv2d = len(mat.size()) == 4
             kernel_size = None if not conv2d else mat.size()[2:4]
             conv2d_3x3 = conv2d and kernel_size != (1, 1)
             out_dim, in_dim = mat.size()[0:2]
+            shapes[lora_module_name] = (out_dim, in_dim, kernel_size)
 
             if conv2d:
                 if conv2d_3x3:
@@ -359,15 +361,16 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
 
             module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
             module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+            yield lora_module_name, mat, module_new_rank
 
-            U, S, Vh = torch.linalg.svd(mat)
+    merged_lora_sd = {}
+    with torch.no_grad():
+        for lora_module_name, U, S, Vh, _ in tqdm(decomposer.decompose(svd_items()), total=len(merged_sd)):
+            out_dim, in_dim, kernel_size = shapes[lora_module_name]
+            module_new_rank = S.size()[0]
 
-            U = U[:, :module_new_rank]
-            S = S[:module_new_rank]
             U = U @ torch.diag(S)
 
-            Vh = Vh[:module_new_rank, :]
-
             dist = torch.cat([U.flatten(), Vh.flatten()])
             hi_val = torch.quantile(dist, CLAMP_QUANTILE)
             low_val = -hi_val
@@ -375,7 +378,7 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
             U = U.clamp(low_val, hi_val)
             Vh = Vh.clamp(low_val, hi_val)
 
-            if conv2d:
+            if kernel_size is not None:
                 U = U.reshape(out_dim, module_new_rank, 1, 1)
                 Vh = Vh.reshape(module_new_rank, in_dim, kernel_size[0], kernel_size[1])
 
@@ -385,6 +388,7 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
             merged_lora_sd[lora_module_name + ".lora_up.weight"] = up_weight.to("cpu").contiguous()
             merged_lora_sd[lora_module_name + ".lora_down.weight"] = down_weight.to("cpu").contiguous()
             merged_lora_sd[lora_module_name + ".alpha"] = torch.tensor(module_new_rank, device="cpu")
+    decomposer.log_summary()
 
     # build minimum metadata
     dims = f"{new_rank}"
@@ -424,8 +428,9 @@ def merge(args):
         save_dtype = merge_dtype
 
     new_conv_rank = args.new_conv_rank if args.new_conv_rank is not None else args.new_rank
+    decomposer = svd_utils.create_decomposer(args, args.device)
     state_dict, metadata, v2, base_model = merge_lora_models(
-        args.models, args.ratios, args.lbws, args.new_rank, new_conv_rank, args.device, merge_dtype
+        args.models, args.ratios, args.lbws, args.new_rank, new_conv_rank, args.device, merge_dtype, decomposer
     )
 
     # cast to save_dtype before calculating hashes
@@ -498,6 +503,7 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う"
     )
+    svd_utils.add_svd_arguments(parser)
     parser.add_argument(
         "--no_metadata",
         action="store_true",
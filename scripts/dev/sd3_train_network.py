@@ -151,7 +151,7 @@ class Sd3NetworkTrainer(train_network.NetworkTrainer):
 
     def get_latents_caching_strategy(self, args):
         latents_caching_strategy = strategy_sd3.Sd3LatentsCachingStrategy(
-            args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check
+            args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check, args.latents_cache_backend
         )
         return latents_caching_strategy
 
@@ -296,7 +296,15 @@ class Sd3NetworkTrainer(train_network.NetworkTrainer):
         text_encoders = self.get_models_for_text_encoding(args, accelerator, text_encoders)
 
         sd3_train_utils.sample_images(
-            accelerator, args, epoch, global_step, mmdit, vae, text_encoders, self.sample_prompts_te_outputs
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            mmdit,
+            vae,
+            text_encoders,
+            self.sample_prompts_te_outputs,
+            cache_prompt_embeddings=not self.is_train_text_encoder(args),
         )
 
     def get_noise_scheduler(self, args: argparse.Namespace, device: torch.device) -> Any:
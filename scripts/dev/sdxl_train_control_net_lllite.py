@@ -93,7 +93,7 @@ def train(args):
 
     # prepare caching strategy: this must be set before preparing dataset. because dataset may use this strategy for initialization.
     latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(
-        False, args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check
+        False, args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check, args.latents_cache_backend
     )
     strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
@@ -0,0 +1,56 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from library.train_util import BucketManager
+
+
+def make_image_sizes(num_images, seed):
+    rng = random.Random(seed)
+    sizes = [(rng.randint(128, 4096), rng.randint(128, 4096)) for _ in range(num_images)]
+    # the sizes of the predefined buckets, duplicated sizes and extreme aspect ratios
+    sizes += [(1024, 1024), (512, 768), (768, 512), (1024, 1024), (64, 4096), (4096, 64), (63, 65)]
+    return sizes
+
+
+def make_bucket_manager(no_upscale):
+    if no_upscale:
+        return BucketManager(True, (1024, 1024), None, None, 64)
+    bucket_manager = BucketManager(False, (1024, 1024), 256, 2048, 64)
+    bucket_manager.make_buckets()
+    return bucket_manager
+
+
+@pytest.mark.parametrize("no_upscale", [False, True])
+def test_select_buckets_matches_select_bucket(no_upscale):
+    sizes = make_image_sizes(2000, seed=42)
+
+    expected_manager = make_bucket_manager(no_upscale)
+    expected = [expected_manager.select_bucket(width, height) for width, height in sizes]
+
+    bucket_manager = make_bucket_manager(no_upscale)
+    bucket_resos, resized_sizes, ar_errors = bucket_manager.select_buckets(
+        [width for width, _ in sizes], [height for _, height in sizes]
+    )
+
+    assert [tuple(r) for r in bucket_resos.tolist()] == [reso for reso, _, _ in expected]
+    assert [tuple(r) for r in resized_sizes.tolist()] == [tuple(resized_size) for _, resized_size, _ in expected]
+    assert ar_errors.tolist() == [ar_error for _, _, ar_error in expected]
+
+    # new buckets are added in the same order
+    assert bucket_manager.resos == expected_manager.resos
+    assert bucket_manager.reso_to_id == expected_manager.reso_to_id
+
+
+@pytest.mark.parametrize("no_upscale", [False, True])
+def test_select_buckets_empty(no_upscale):
+    bucket_manager = make_bucket_manager(no_upscale)
+    bucket_resos, resized_sizes, ar_errors = bucket_manager.select_buckets([], [])
+
+    assert bucket_resos.shape == (0, 2)
+    assert resized_sizes.shape == (0, 2)
+    assert ar_errors.shape == (0,)
+    assert bucket_manager.resos == []
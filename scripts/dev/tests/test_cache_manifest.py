@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from library import cache_manifest
+from library.strategy_base import LatentsCachingStrategy
+
+
+LATENTS_STRIDE = 8
+BUCKET_RESOS = [(64, 64), (128, 64)]  # W, H
+
+
+@pytest.fixture
+def manifests(monkeypatch):
+    monkeypatch.setattr(cache_manifest, "_manifests", {})
+
+
+def reload_manifests():
+    # as a new training run: the manifests are saved and loaded from the disk
+    cache_manifest.save_cache_manifests()
+    cache_manifest._manifests.clear()
+
+
+def save_latents(strategy, npz_path, bucket_reso, value):
+    width, height = bucket_reso
+    latents = torch.full((4, height // LATENTS_STRIDE, width // LATENTS_STRIDE), float(value))
+    key_reso_suffix = f"_{latents.shape[1]}x{latents.shape[2]}"
+    strategy.save_latents_to_disk(npz_path, latents, bucket_reso, (0, 0, width, height), key_reso_suffix=key_reso_suffix)
+
+
+def is_cached(strategy, npz_path, image_path):
+    cache_manifest.validate_cache_files([npz_path], [image_path])
+    return [
+        strategy._default_is_disk_cached_latents_expected(LATENTS_STRIDE, reso, npz_path, False, False, True)
+        for reso in BUCKET_RESOS
+    ]
+
+
+def test_source_changed_drops_other_resolutions(tmp_path, manifests):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    image_path = str(tmp_path / "image.png")
+    npz_path = str(tmp_path / "image_0128x0064_test.npz")
+    with open(image_path, "wb") as f:
+        f.write(b"image")
+
+    cache_manifest.validate_cache_files([npz_path], [image_path])
+    for reso in BUCKET_RESOS:
+        save_latents(strategy, npz_path, reso, 0)
+    reload_manifests()
+    assert is_cached(strategy, npz_path, image_path) == [True, True]
+
+    # the image is changed: both resolutions are outdated
+    st = os.stat(image_path)
+    os.utime(image_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    reload_manifests()
+    assert is_cached(strategy, npz_path, image_path) == [False, False]
+
+    # re-cache only the first resolution, the latents of the second one from the old image must not be kept
+    save_latents(strategy, npz_path, BUCKET_RESOS[0], 1)
+    assert is_cached(strategy, npz_path, image_path) == [True, False]
+    with np.load(npz_path) as npz:
+        assert sorted(npz.files) == ["crop_ltrb_8x8", "latents_8x8", "original_size_8x8"]
+        assert np.all(npz["latents_8x8"] == 1)
+
+    reload_manifests()
+    assert is_cached(strategy, npz_path, image_path) == [True, False]
+
+    # the second resolution is cached from the new image, and merged
+    save_latents(strategy, npz_path, BUCKET_RESOS[1], 1)
+    reload_manifests()
+    assert is_cached(strategy, npz_path, image_path) == [True, True]
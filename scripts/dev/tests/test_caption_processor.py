@@ -0,0 +1,206 @@
+import copy
+import itertools
+import math
+import random
+import re
+import types
+
+import pytest
+
+pytest.importorskip("torch")
+
+from library.caption_processor import CaptionProcessor
+from library.train_util import BaseDataset
+
+
+def process_caption_reference(self, subset, caption):
+    r"""BaseDataset.process_caption before the captions were parsed with CaptionProcessor"""
+    # caption に prefix/suffix を付ける
+    if subset.caption_prefix:
+        caption = subset.caption_prefix + " " + caption
+    if subset.caption_suffix:
+        caption = caption + " " + subset.caption_suffix
+
+    # dropoutの決定：tag dropがこのメソッド内にあるのでここで行うのが良い
+    is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
+    is_drop_out = (
+        is_drop_out
+        or subset.caption_dropout_every_n_epochs > 0
+        and self.current_epoch % subset.caption_dropout_every_n_epochs == 0
+    )
+
+    if is_drop_out:
+        caption = ""
+    else:
+        # process wildcards
+        if subset.enable_wildcard:
+            # if caption is multiline, random choice one line
+            if "\n" in caption:
+                caption = random.choice(caption.split("\n"))
+
+            # wildcard is like '{aaa|bbb|ccc...}'
+            # escape the curly braces like {{ or }}
+            replacer1 = "⦅"
+            replacer2 = "⦆"
+            while replacer1 in caption or replacer2 in caption:
+                replacer1 += "⦅"
+                replacer2 += "⦆"
+
+            caption = caption.replace("{{", replacer1).replace("}}", replacer2)
+
+            # replace the wildcard
+            def replace_wildcard(match):
+                return random.choice(match.group(1).split("|"))
+
+            caption = re.sub(r"\{([^}]+)\}", replace_wildcard, caption)
+
+            # unescape the curly braces
+            caption = caption.replace(replacer1, "{").replace(replacer2, "}")
+        else:
+            # if caption is multiline, use the first line
+            caption = caption.split("\n")[0]
+
+        if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
+            fixed_tokens = []
+            flex_tokens = []
+            fixed_suffix_tokens = []
+            if (
+                hasattr(subset, "keep_tokens_separator")
+                and subset.keep_tokens_separator
+                and subset.keep_tokens_separator in caption
+            ):
+                fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
+                if subset.keep_tokens_separator in flex_part:
+                    flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
+                    fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
+
+                fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
+                flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+            else:
+                tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
+                flex_tokens = tokens[:]
+                if subset.keep_tokens > 0:
+                    fixed_tokens = flex_tokens[: subset.keep_tokens]
+                    flex_tokens = tokens[subset.keep_tokens :]
+
+            if subset.token_warmup_step < 1:  # 初回に上書きする
+                subset.token_warmup_step = math.floor(subset.token_warmup_step * self.max_train_steps)
+            if subset.token_warmup_step and self.current_step < subset.token_warmup_step:
+                tokens_len = (
+                    math.floor(
+                        (self.current_step) * ((len(flex_tokens) - subset.token_warmup_min) / (subset.token_warmup_step))
+                    )
+                    + subset.token_warmup_min
+                )
+                flex_tokens = flex_tokens[:tokens_len]
+
+            def dropout_tags(tokens):
+                if subset.caption_tag_dropout_rate <= 0:
+                    return tokens
+                l = []
+                for token in tokens:
+                    if random.random() >= subset.caption_tag_dropout_rate:
+                        l.append(token)
+                return l
+
+            if subset.shuffle_caption:
+                random.shuffle(flex_tokens)
+
+            flex_tokens = dropout_tags(flex_tokens)
+
+            caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
+
+        # process secondary separator
+        if subset.secondary_separator:
+            caption = caption.replace(subset.secondary_separator, subset.caption_separator)
+
+        # textual inversion対応
+        for str_from, str_to in self.replacements.items():
+            if str_from == "":
+                # replace all
+                if type(str_to) == list:
+                    caption = random.choice(str_to)
+                else:
+                    caption = str_to
+            else:
+                caption = caption.replace(str_from, str_to)
+
+    return caption
+
+
+CAPTIONS = [
+    "1girl, solo, long hair, smile, looking at viewer, outdoors, sky, cloud, tree, dress",
+    "masterpiece, best quality ||| 1girl, {red|blue|green} hair, {smile|open mouth}, school uniform ||| artist name, signature",
+    "sks dog ||| sitting, grass, {day|night|sunset}",
+    "a photo of {a cat|a dog|a {{bird}}}, {{literal}}, {indoors|outdoors}\nsecond line, {x|y}\nthird line",
+    "a ⦅strange⦆ caption, {aaa|bbb}, }}, {{",
+    "  spaces , around,tokens ,, empty ,  ",
+    "",
+]
+
+
+def make_subset(**kwargs):
+    subset = types.SimpleNamespace(
+        caption_prefix=None,
+        caption_suffix=None,
+        caption_dropout_rate=0.0,
+        caption_dropout_every_n_epochs=0,
+        enable_wildcard=False,
+        shuffle_caption=False,
+        caption_separator=",",
+        keep_tokens=0,
+        keep_tokens_separator=None,
+        token_warmup_step=0,
+        token_warmup_min=1,
+        caption_tag_dropout_rate=0.0,
+        secondary_separator=None,
+    )
+    for key, value in kwargs.items():
+        setattr(subset, key, value)
+    return subset
+
+
+def make_dataset(current_step=0):
+    return types.SimpleNamespace(
+        current_epoch=1,
+        current_step=current_step,
+        max_train_steps=100,
+        replacements={},
+        caption_processor=CaptionProcessor(),
+    )
+
+
+SUBSET_OPTIONS = [
+    dict(shuffle_caption=True),
+    dict(shuffle_caption=True, keep_tokens=2),
+    dict(shuffle_caption=True, keep_tokens_separator="|||"),
+    dict(caption_tag_dropout_rate=0.3),
+    dict(caption_tag_dropout_rate=0.3, shuffle_caption=True, keep_tokens_separator="|||"),
+    dict(caption_dropout_rate=0.5, shuffle_caption=True),
+    dict(enable_wildcard=True),
+    dict(enable_wildcard=True, shuffle_caption=True, keep_tokens=1, caption_tag_dropout_rate=0.2),
+    dict(enable_wildcard=True, shuffle_caption=True, keep_tokens_separator="|||", caption_prefix="prefix", caption_suffix="suffix"),
+    dict(token_warmup_step=0.5, token_warmup_min=2, shuffle_caption=True),
+    dict(secondary_separator=";;;", shuffle_caption=True),
+]
+
+
+@pytest.mark.parametrize("options", SUBSET_OPTIONS)
+def test_process_caption_matches_reference(options):
+    for caption, current_step in itertools.product(CAPTIONS, [0, 10, 60]):
+        reference_dataset = make_dataset(current_step)
+        dataset = make_dataset(current_step)
+        reference_subset = make_subset(**copy.deepcopy(options))
+        subset = make_subset(**copy.deepcopy(options))
+
+        for seed in range(20):
+            # the captions are parsed at the first call and reused by the later calls
+            random.seed(seed)
+            expected = process_caption_reference(reference_dataset, reference_subset, caption)
+            expected_state = random.getstate()
+
+            random.seed(seed)
+            actual = BaseDataset.process_caption(dataset, subset, caption)
+
+            assert actual == expected, (options, caption, current_step, seed)
+            assert random.getstate() == expected_state  # same calls to random, the later samples are not changed
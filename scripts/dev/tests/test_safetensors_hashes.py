@@ -0,0 +1,96 @@
+import hashlib
+import json
+from io import BytesIO
+
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+from library import train_util, utils
+
+
+def make_tensors():
+    generator = torch.Generator().manual_seed(0)
+    return {
+        # larger than 0x110000 bytes in total, so the legacy hash reads the data section
+        "lora_unet_down.lora_down.weight": torch.randn(320, 640, generator=generator),
+        "lora_unet_down.lora_up.weight": torch.randn(640, 320, generator=generator).to(torch.float16),
+        "lora_unet_down.alpha": torch.tensor(4.0),
+        "lora_te_mid.lora_down.weight": torch.randn(16, 768, generator=generator).to(torch.bfloat16),
+        "lora_te_mid.lora_up.weight": torch.randn(768, 16, generator=generator).to(torch.float16),
+        "lora_te_mid.alpha": torch.tensor(8.0, dtype=torch.bfloat16),
+        "step": torch.tensor([1234], dtype=torch.int64),
+        "mask": torch.tensor([True, False, True]),
+        "empty": torch.zeros(0, 4),
+    }
+
+
+def make_metadata():
+    # one ss_ key: safetensors.torch.save writes __metadata__ from a HashMap, the order of multiple keys is not defined
+    return {
+        "ss_tag_frequency": '{"1_girl": {"1girl": 10, "日本語": 2}}',
+        "modelspec.title": "not hashed",
+        "user_comment": "not hashed",
+    }
+
+
+def make_multi_key_metadata():
+    return {
+        "ss_network_module": "networks.lora",
+        "ss_network_dim": "16",
+        "ss_tag_frequency": '{"1_girl": {"1girl": 10, "日本語": 2}}',
+        "modelspec.title": "not hashed",
+    }
+
+
+def split_safetensors(b):
+    n = int.from_bytes(b[:8], "little")
+    return n, json.loads(b[8 : 8 + n]), b[8 + n :]
+
+
+def expected_hashes(tensors, metadata):
+    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    b = BytesIO(safetensors_torch.save(tensors, metadata))
+    return train_util.addnet_hash_safetensors(b), train_util.addnet_hash_legacy(b)
+
+
+@pytest.mark.parametrize("with_metadata", [True, False])
+def test_precalculate_safetensors_hashes(with_metadata):
+    tensors = make_tensors()
+    metadata = make_metadata() if with_metadata else {}
+
+    assert train_util.precalculate_safetensors_hashes(tensors, metadata) == expected_hashes(tensors, metadata)
+
+
+def test_precalculate_safetensors_hashes_small_model():
+    # the data section ends before the offset of the legacy hash
+    tensors = {"a": torch.ones(2, 3), "b": torch.zeros(5, dtype=torch.float16)}
+    metadata = make_metadata()
+
+    assert train_util.precalculate_safetensors_hashes(tensors, metadata) == expected_hashes(tensors, metadata)
+
+
+def test_precalculate_safetensors_hashes_from_file(tmp_path):
+    tensors = make_tensors()
+    metadata = make_metadata()
+    filename = str(tmp_path / "model.safetensors")
+    safetensors_torch.save_file(tensors, filename, {k: v for k, v in metadata.items() if k.startswith("ss_")})
+
+    assert train_util.precalculate_safetensors_hashes_from_file(filename, metadata) == expected_hashes(tensors, metadata)
+
+
+def test_safetensors_header_with_multiple_metadata_keys():
+    # the order of the metadata keys may differ from safetensors.torch.save, but the header has the same content and
+    # length, and the data section is the same
+    tensors = make_tensors()
+    metadata = {k: v for k, v in make_multi_key_metadata().items() if k.startswith("ss_")}
+    header, _ = utils.build_safetensors_header({k: (v.dtype, v.shape) for k, v in tensors.items()}, metadata)
+    expected_length, expected_header, expected_data = split_safetensors(safetensors_torch.save(tensors, metadata))
+
+    length, parsed_header, _ = split_safetensors(header)
+    assert length == expected_length
+    assert parsed_header == expected_header
+
+    model_hash, _ = train_util.precalculate_safetensors_hashes(tensors, make_multi_key_metadata())
+    assert model_hash == hashlib.sha256(expected_data).hexdigest()
@@ -2,14 +2,19 @@
 
 import argparse
 import math
+import multiprocessing
 from multiprocessing import Value
 import os
+import queue
+import time
+from typing import Dict, List, Tuple
 
 from accelerate.utils import set_seed
 import torch
 from tqdm import tqdm
 
 from library import config_util, flux_train_utils, flux_utils, strategy_base, strategy_flux, strategy_sd, strategy_sdxl
+from library import step_profiler
 from library import train_util
 from library import sdxl_train_util
 from library.config_util import (
@@ -48,6 +53,110 @@ def set_tokenize_strategy(is_sd: bool, is_sdxl: bool, is_flux: bool, args: argpa
     strategy_base.TokenizeStrategy.set_strategy(tokenize_strategy)
 
 
+def create_latents_caching_strategy(is_sd: bool, is_sdxl: bool, args: argparse.Namespace) -> strategy_base.LatentsCachingStrategy:
+    if is_sd or is_sdxl:
+        latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(
+            is_sd, True, args.vae_batch_size, args.skip_cache_check, args.latents_cache_backend
+        )
+    else:
+        latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(
+            True, args.vae_batch_size, args.skip_cache_check, args.latents_cache_backend
+        )
+    latents_caching_strategy.set_caching_workers(args.num_decode_workers, args.num_write_workers)
+    return latents_caching_strategy
+
+
+def load_vae(args: argparse.Namespace, is_sd: bool, is_sdxl: bool, accelerator, device: torch.device):
+    # mixed precisionに対応した型を用意しておき適宜castする
+    weight_dtype, _ = train_util.prepare_dtype(args)
+    vae_dtype = torch.float32 if args.no_half_vae else weight_dtype
+
+    # モデルを読み込む
+    logger.info("load model")
+    if is_sd:
+        _, vae, _, _ = train_util.load_target_model(args, weight_dtype, accelerator)
+    elif is_sdxl:
+        (_, _, _, vae, _, _, _) = sdxl_train_util.load_target_model(args, accelerator, "sdxl", weight_dtype)
+    else:
+        vae = flux_utils.load_ae(args.ae, weight_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors)
+
+    if is_sd or is_sdxl:
+        if torch.__version__ >= "2.0.0":  # PyTorch 2.0.0 以上対応のxformersなら以下が使える
+            vae.set_use_memory_efficient_attention_xformers(args.xformers)
+
+    vae.to(device, dtype=vae_dtype)
+    vae.requires_grad_(False)
+    vae.eval()
+    return vae
+
+
+class CacheShard:
+    r"""the images with index % num_processes == process_index are cached by the process, same as multi-GPU caching"""
+
+    def __init__(self, num_processes: int, process_index: int):
+        self.num_processes = num_processes
+        self.process_index = process_index
+
+
+def get_cache_devices(args: argparse.Namespace, num_processes: int) -> List[str]:
+    if args.cache_devices:
+        devices = [d.strip() for d in args.cache_devices.split(",") if d.strip()]
+    elif torch.cuda.is_available():
+        devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    else:
+        devices = ["cpu"]
+    return [devices[i % len(devices)] for i in range(num_processes)]
+
+
+def cache_worker(args: argparse.Namespace, process_index: int, num_processes: int, device: str, train_dataset_group, results):
+    r"""cache a shard of the images in a spawned process, with its own VAE on the device"""
+    setup_logging(args, reset=True)
+    is_sd = not args.sdxl and not args.flux
+    is_sdxl = args.sdxl
+    is_flux = args.flux
+
+    # strategies are not inherited by spawned processes
+    set_tokenize_strategy(is_sd, is_sdxl, is_flux, args)
+    strategy_base.LatentsCachingStrategy.set_strategy(create_latents_caching_strategy(is_sd, is_sdxl, args))
+
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    elif device.type == "cpu":
+        # share the cores with the other processes
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_processes))
+
+    profiler = step_profiler.StepProfiler()
+    step_profiler.set_profiler(profiler)
+
+    start_time = time.perf_counter()
+    args.deepspeed = False
+    accelerator = train_util.prepare_accelerator(args)
+    vae = load_vae(args, is_sd, is_sdxl, accelerator, device)
+    profiler.record("load_model", start_time, time.perf_counter())
+
+    num_cached = 0
+    shard = CacheShard(num_processes, process_index)
+    for i, dataset in enumerate(train_dataset_group.datasets):
+        logger.info(f"[Worker {process_index}, Dataset {i}]")
+        num_cached += dataset.new_cache_latents(vae, shard) or 0
+
+    results.put((process_index, num_cached, profiler.get_span_totals()))
+
+
+def print_throughput_report(num_cached: int, elapsed: float, span_totals: List[Dict[str, Tuple[int, float]]]):
+    logger.info(f"cached {num_cached} images in {elapsed:.1f}s, {num_cached / max(elapsed, 1e-9):.2f} images/s")
+    totals: Dict[str, Tuple[int, float]] = {}
+    for spans in span_totals:
+        for name, (count, total) in spans.items():
+            c, t = totals.get(name, (0, 0.0))
+            totals[name] = (c + count, t + total)
+    # time per stage, total of all workers. stages may overlap (decoding and writing run in threads)
+    for name, (count, total) in totals.items():
+        per_image = f", {total / num_cached * 1000:.1f}ms/image" if num_cached > 0 else ""
+        logger.info(f"  {name}: {total:.1f}s ({count} calls{per_image})")
+
+
 def cache_to_disk(args: argparse.Namespace) -> None:
     setup_logging(args, reset=True)
     train_util.prepare_dataset_args(args, True)
@@ -67,12 +176,7 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     is_flux = args.flux
 
     set_tokenize_strategy(is_sd, is_sdxl, is_flux, args)
-
-    if is_sd or is_sdxl:
-        latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(is_sd, True, args.vae_batch_size, args.skip_cache_check)
-    else:
-        latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(True, args.vae_batch_size, args.skip_cache_check)
-    strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
+    strategy_base.LatentsCachingStrategy.set_strategy(create_latents_caching_strategy(is_sd, is_sdxl, args))
 
     # データセットを準備する
     use_user_config = args.dataset_config is not None
@@ -122,37 +226,70 @@ def cache_to_disk(args: argparse.Namespace) -> None:
         train_dataset_group = train_util.load_arbitrary_dataset(args)
         val_dataset_group = None
 
+    if args.num_cache_processes > 1:
+        # shard the images to worker processes, each has its own VAE. already cached images are skipped by the validity
+        # check, so interrupted caching can be resumed by running again
+        assert (
+            args.latents_cache_backend != "store"
+        ), "store backend cannot be written by multiple processes / storeバックエンドは複数プロセスで書き込めません"
+        num_processes = args.num_cache_processes
+        devices = get_cache_devices(args, num_processes)
+        logger.info(f"caching latents with {num_processes} processes: {', '.join(devices)}")
+
+        start_time = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [
+            context.Process(target=cache_worker, args=(args, i, num_processes, devices[i], train_dataset_group, results))
+            for i in range(num_processes)
+        ]
+        for process in processes:
+            process.start()
+
+        worker_results = {}
+        while len(worker_results) < num_processes:
+            try:
+                process_index, num_cached, span_totals = results.get(timeout=5)
+                worker_results[process_index] = (num_cached, span_totals)
+            except queue.Empty:
+                failed = [i for i, p in enumerate(processes) if p.exitcode not in (None, 0) and i not in worker_results]
+                if failed:
+                    for process in processes:
+                        process.terminate()
+                    raise RuntimeError(f"latents caching worker failed / latentキャッシュのワーカーが失敗しました: {failed}")
+        for process in processes:
+            process.join()
+
+        elapsed = time.perf_counter() - start_time
+        print_throughput_report(
+            sum(num_cached for num_cached, _ in worker_results.values()),
+            elapsed,
+            [span_totals for _, span_totals in worker_results.values()],
+        )
+        logger.info("Finished caching latents to disk.")
+        return
+
     # acceleratorを準備する
     logger.info("prepare accelerator")
     args.deepspeed = False
     accelerator = train_util.prepare_accelerator(args)
 
-    # mixed precisionに対応した型を用意しておき適宜castする
-    weight_dtype, _ = train_util.prepare_dtype(args)
-    vae_dtype = torch.float32 if args.no_half_vae else weight_dtype
+    profiler = step_profiler.StepProfiler()
+    step_profiler.set_profiler(profiler)
+    start_time = time.perf_counter()
 
-    # モデルを読み込む
-    logger.info("load model")
-    if is_sd:
-        _, vae, _, _ = train_util.load_target_model(args, weight_dtype, accelerator)
-    elif is_sdxl:
-        (_, _, _, vae, _, _, _) = sdxl_train_util.load_target_model(args, accelerator, "sdxl", weight_dtype)
-    else:
-        vae = flux_utils.load_ae(args.ae, weight_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors)
-
-    if is_sd or is_sdxl:
-        if torch.__version__ >= "2.0.0":  # PyTorch 2.0.0 以上対応のxformersなら以下が使える
-            vae.set_use_memory_efficient_attention_xformers(args.xformers)
+    vae = load_vae(args, is_sd, is_sdxl, accelerator, accelerator.device)
+    profiler.record("load_model", start_time, time.perf_counter())
 
-    vae.to(accelerator.device, dtype=vae_dtype)
-    vae.requires_grad_(False)
-    vae.eval()
-
-    # cache latents with dataset
-    # TODO use DataLoader to speed up
-    train_dataset_group.new_cache_latents(vae, accelerator)
+    # cache latents with dataset. with multiple GPUs (accelerate), each process caches a part of the images
+    num_cached = 0
+    for i, dataset in enumerate(train_dataset_group.datasets):
+        logger.info(f"[Dataset {i}]")
+        num_cached += dataset.new_cache_latents(vae, accelerator) or 0
 
     accelerator.wait_for_everyone()
+    print_throughput_report(num_cached, time.perf_counter() - start_time, [profiler.get_span_totals()])
+    step_profiler.set_profiler(None)
     accelerator.print(f"Finished caching latents to disk.")
 
 
@@ -175,6 +312,34 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="do not use fp16/bf16 VAE in mixed precision (use float VAE) / mixed precisionでも fp16/bf16 VAEを使わずfloat VAEを使う",
     )
+    parser.add_argument(
+        "--num_decode_workers",
+        type=int,
+        default=None,
+        help="number of threads to decode and resize images. default is cpu count / number of processes (at most 2x vae_batch_size)"
+        " / 画像のデコードとリサイズを行うスレッド数。デフォルトはCPU数/プロセス数（最大でvae_batch_sizeの2倍）",
+    )
+    parser.add_argument(
+        "--num_write_workers",
+        type=int,
+        default=1,
+        help="number of threads to write latents to disk. 0 to write synchronously / latentをディスクに書き込むスレッド数。0で同期書き込み",
+    )
+    parser.add_argument(
+        "--num_cache_processes",
+        type=int,
+        default=1,
+        help="number of processes to cache latents in parallel, each loads its own VAE. images are sharded to the processes"
+        " / latentを並列にキャッシュするプロセス数。各プロセスがVAEを読み込み、画像を分担する",
+    )
+    parser.add_argument(
+        "--cache_devices",
+        type=str,
+        default=None,
+        help="comma separated devices for the processes of --num_cache_processes, e.g. 'cuda:0,cuda:1' or 'cpu'. default is all GPUs"
+        " (or cpu), assigned in turn / --num_cache_processesの各プロセスのデバイスをカンマ区切りで指定（例：'cuda:0,cuda:1'、'cpu'）。"
+        "デフォルトは全GPU（またはCPU）を順に割り当てる",
+    )
     parser.add_argument(
         "--skip_existing",
         action="store_true",
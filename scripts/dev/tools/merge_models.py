@@ -1,11 +1,13 @@
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import os
 
 import torch
 from safetensors import safe_open
-from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library.utils import setup_logging
+from library.utils import setup_logging, MemoryEfficientSafeOpen, MemoryEfficientSafeWriter
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
@@ -30,6 +32,15 @@ def replace_text_encoder_key(key):
     return False, key
 
 
+def get_keys_in_file_order(model):
+    # keys sorted by the offset in the file, to read the file sequentially
+    with MemoryEfficientSafeOpen(model) as f:
+        header = f.header
+    keys = [k for k in header.keys() if k != "__metadata__"]
+    keys.sort(key=lambda k: header[k]["data_offsets"][0])
+    return keys, {k: header[k]["shape"] for k in keys}
+
+
 def merge(args):
     if args.precision == "fp16":
         dtype = torch.float16
@@ -56,94 +67,91 @@ def merge(args):
 
     assert args.ratios is None or len(args.models) == len(args.ratios), "ratios must be the same length as models"
 
-    # load and merge
-    ratio = 1.0 / len(args.models)  # default
-    supplementary_key_ratios = {}  # [key] = ratio, for keys not in all models, add later
-
-    merged_sd = None
-    first_model_keys = set()  # check missing keys in other models
-    for i, model in enumerate(args.models):
-        if args.ratios is not None:
-            ratio = args.ratios[i]
-
-        if merged_sd is None:
-            # load first model
-            logger.info(f"Loading model {model}, ratio = {ratio}...")
-            merged_sd = {}
-            with safe_open(model, framework="pt", device=args.device) as f:
-                for key in tqdm(f.keys()):
-                    value = f.get_tensor(key)
-                    _, key = replace_text_encoder_key(key)
-
-                    first_model_keys.add(key)
-
-                    if not is_unet_key(key) and args.unet_only:
-                        supplementary_key_ratios[key] = 1.0  # use first model's value for VAE or TextEncoder
-                        continue
+    ratios = args.ratios if args.ratios is not None else [1.0 / len(args.models)] * len(args.models)
+    for model, ratio in zip(args.models, ratios):
+        logger.info(f"Model {model}, ratio = {ratio}")
 
-                    value = ratio * value.to(dtype)  # first model's value * ratio
-                    merged_sd[key] = value
+    # keys of the output are the keys of the first model
+    first_keys, shapes = get_keys_in_file_order(args.models[0])
+    first_model_keys = set()
+    output_keys = []  # (original key, new key)
+    for key in first_keys:
+        _, new_key = replace_text_encoder_key(key)
+        first_model_keys.add(new_key)
+        output_keys.append((key, new_key))
+    logger.info(f"Model has {len(output_keys)} keys " + ("(UNet only)" if args.unet_only else ""))
 
-            logger.info(f"Model has {len(merged_sd)} keys " + ("(UNet only)" if args.unet_only else ""))
-            continue
+    output_file = args.output
+    if not output_file.endswith(".safetensors"):
+        output_file = output_file + ".safetensors"
 
-        # load other models
-        logger.info(f"Loading model {model}, ratio = {ratio}...")
+    with ExitStack() as stack:
+        # open all models at once, tensors are read lazily
+        files = [stack.enter_context(safe_open(model, framework="pt", device=args.device)) for model in args.models]
 
-        with safe_open(model, framework="pt", device=args.device) as f:
-            model_keys = f.keys()
-            for key in tqdm(model_keys):
+        # new key -> original key, for other models
+        model_key_maps = [None]
+        for model, f in zip(args.models[1:], files[1:]):
+            key_map = {}
+            for key in f.keys():
                 _, new_key = replace_text_encoder_key(key)
-                if new_key not in merged_sd:
-                    if args.show_skipped and new_key not in first_model_keys:
+                if new_key not in first_model_keys:
+                    if args.show_skipped:
                         logger.info(f"Skip: {new_key}")
                     continue
+                key_map[new_key] = key
+            model_key_maps.append(key_map)
+
+        def read_tensors(key, new_key):
+            # tensors of all models for the key, None for the model without the key
+            tensors = [files[0].get_tensor(key)]
+            if args.unet_only and not is_unet_key(new_key):
+                return tensors  # use first model's value for VAE or TextEncoder
+            for f, key_map in zip(files[1:], model_key_maps[1:]):
+                tensors.append(f.get_tensor(key_map[new_key]) if new_key in key_map else None)
+            return tensors
+
+        executor = None
+        if args.num_workers > 0:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=args.num_workers))
+        prefetch = deque()  # futures of read_tensors, in the order of output_keys
+
+        writer = stack.enter_context(
+            MemoryEfficientSafeWriter(output_file, {new_key: (save_dtype, shapes[key]) for key, new_key in output_keys})
+        )
+        logger.info(f"Merging and saving to {output_file}...")
+        for i, (key, new_key) in enumerate(tqdm(output_keys)):
+            if executor is None:
+                tensors = read_tensors(key, new_key)
+            else:
+                # read ahead the next keys while merging
+                while len(prefetch) < args.num_workers * 2 and i + len(prefetch) < len(output_keys):
+                    prefetch.append(executor.submit(read_tensors, *output_keys[i + len(prefetch)]))
+                tensors = prefetch.popleft().result()
+
+            first_value = tensors[0].to(dtype)
+            if args.unet_only and not is_unet_key(new_key):
+                merged = first_value
+            else:
+                # first model's value * ratio, then add other models' values
+                merged = ratios[0] * first_value
+                supplementary_ratio = 0.0  # for models without the key
+                for model, ratio, value in zip(args.models[1:], ratios[1:], tensors[1:]):
+                    if value is None:
+                        logger.warning(f"Key {new_key} not in model {model}, use first model's value")
+                        supplementary_ratio += ratio
+                        continue
+                    merged.add_(value.to(dtype) * ratio)
+                    del value
 
-                value = f.get_tensor(key)
-                merged_sd[new_key] = merged_sd[new_key] + ratio * value.to(dtype)
-
-            # enumerate keys not in this model
-            model_keys = set(model_keys)
-            for key in merged_sd.keys():
-                if key in model_keys:
-                    continue
-                logger.warning(f"Key {key} not in model {model}, use first model's value")
-                if key in supplementary_key_ratios:
-                    supplementary_key_ratios[key] += ratio
-                else:
-                    supplementary_key_ratios[key] = ratio
-
-    # add supplementary keys' value (including VAE and TextEncoder)
-    if len(supplementary_key_ratios) > 0:
-        logger.info("add first model's value")
-        with safe_open(args.models[0], framework="pt", device=args.device) as f:
-            for key in tqdm(f.keys()):
-                _, new_key = replace_text_encoder_key(key)
-                if new_key not in supplementary_key_ratios:
-                    continue
-
-                if is_unet_key(new_key):  # not VAE or TextEncoder
-                    logger.warning(f"Key {new_key} not in all models, ratio = {supplementary_key_ratios[new_key]}")
-
-                value = f.get_tensor(key)  # original key
-
-                if new_key not in merged_sd:
-                    merged_sd[new_key] = supplementary_key_ratios[new_key] * value.to(dtype)
-                else:
-                    merged_sd[new_key] = merged_sd[new_key] + supplementary_key_ratios[new_key] * value.to(dtype)
-
-    # save
-    output_file = args.output
-    if not output_file.endswith(".safetensors"):
-        output_file = output_file + ".safetensors"
-
-    logger.info(f"Saving to {output_file}...")
-
-    # convert to save_dtype
-    for k in merged_sd.keys():
-        merged_sd[k] = merged_sd[k].to(save_dtype)
+                if supplementary_ratio > 0:
+                    if is_unet_key(new_key):  # not VAE or TextEncoder
+                        logger.warning(f"Key {new_key} not in all models, ratio = {supplementary_ratio}")
+                    merged.add_(supplementary_ratio * first_value)
 
-    save_file(merged_sd, output_file)
+            del tensors, first_value
+            writer.write(new_key, merged.to(save_dtype))
+            del merged
 
     logger.info("Done!")
 
@@ -166,6 +174,9 @@ if __name__ == "__main__":
         help="Saving precision, default is float",
     )
     parser.add_argument("--show_skipped", action="store_true", help="Show skipped keys (keys not in first model)")
+    parser.add_argument(
+        "--num_workers", type=int, default=0, help="Number of threads to read models ahead, default is 0 (read in main thread)"
+    )
 
     args = parser.parse_args()
     merge(args)
@@ -1,107 +1,234 @@
-import glob
+import concurrent.futures
 import os
 import cv2
 import argparse
 import shutil
 import math
+import time
 from PIL import Image
 import numpy as np
+from library.image_size_cache import IMAGE_SIZE_CACHE_FILE, ImageSizeCache
 from library.utils import setup_logging, pil_resize
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
 
-def resize_images(src_img_folder, dst_img_folder, max_resolution="512x512", divisible_by=2, interpolation=None, save_as_png=False, copy_associated_files=False):
-  # Split the max_resolution string by "," and strip any whitespaces
-  max_resolutions = [res.strip() for res in max_resolution.split(',')]
+IMG_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")                   # copy from train_util.py
 
-  # # Calculate max_pixels from max_resolution string
-  # max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
 
-  # Create destination folder if it does not exist
-  if not os.path.exists(dst_img_folder):
-    os.makedirs(dst_img_folder)
+def is_up_to_date(src_path, dst_path):
+  # the output is written after the source, so it is up to date if it is not older than the source
+  try:
+    return os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+  except OSError:
+    return False
+
+
+def get_output_filename(base, max_resolution, save_as_png):
+  return base + '+' + max_resolution + ('.png' if save_as_png else '.jpg')
+
+
+def get_max_pixels(max_resolution):
+  return int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
+
+
+def init_worker():
+  # one image per process, avoid oversubscription of cv2 threads
+  cv2.setNumThreads(1)
+
 
+def resize_image_file(src_path, dst_img_folder, max_resolutions, divisible_by, interpolation, save_as_png, asoc_files, use_draft=True):
+  r"""
+  resize an image to the resolutions and copy its associated files, runs in a worker process.
+  returns [(output filename, width, height, resized)] and the number of copied files.
+  """
   # Select interpolation method
   if interpolation == 'lanczos4':
     pil_interpolation = Image.LANCZOS
+    cv2_interpolation = None
   elif interpolation == 'cubic':
     pil_interpolation = Image.BICUBIC
+    cv2_interpolation = None
   else:
     cv2_interpolation = cv2.INTER_AREA
 
-  # Iterate through all files in src_img_folder
-  img_exts = (".png", ".jpg", ".jpeg", ".webp", ".bmp")                   # copy from train_util.py
-  for filename in os.listdir(src_img_folder):
-    # Check if the image is png, jpg or webp etc...
-    if not filename.endswith(img_exts):
-      # Copy the file to the destination folder if not png, jpg or webp etc (.txt or .caption or etc.)
-      shutil.copy(os.path.join(src_img_folder, filename), os.path.join(dst_img_folder, filename))
-      continue
+  # Load image
+  with Image.open(src_path) as image:
+    # size of the original image, the JPEG draft below may decode it smaller
+    width, height = image.size
+
+    # decode JPEG at 1/2, 1/4 or 1/8 scale if the first resolution is at most half of it. the decoded image is kept at
+    # least twice as large as the output, so the output is almost same as resizing the full size image
+    scale = math.sqrt(get_max_pixels(max_resolutions[0]) / (width * height))
+    if use_draft and image.format == "JPEG" and scale <= 0.5:
+      image.draft("RGB", (int(width * scale * 2), int(height * scale * 2)))
 
-    # Load image
-    # img = cv2.imread(os.path.join(src_img_folder, filename))
-    image = Image.open(os.path.join(src_img_folder, filename))
     if not image.mode == "RGB":
       image = image.convert("RGB")
     img = np.array(image, np.uint8)
 
-    base, _ = os.path.splitext(filename)
+  base, _ = os.path.splitext(os.path.basename(src_path))
+  outputs = []
+  for max_resolution in max_resolutions:
+    # Calculate max_pixels from max_resolution string
+    max_pixels = get_max_pixels(max_resolution)
+
+    # Calculate current number of pixels
+    current_pixels = width * height
+
+    # Check if the image needs resizing
+    if current_pixels > max_pixels:
+      # Calculate scaling factor
+      scale_factor = max_pixels / current_pixels
+
+      # Calculate new dimensions
+      new_height = int(height * math.sqrt(scale_factor))
+      new_width = int(width * math.sqrt(scale_factor))
+
+      # Resize image
+      if cv2_interpolation:
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2_interpolation)
+      else:
+        img = pil_resize(img, (new_width, new_height), interpolation=pil_interpolation)
+    else:
+      new_height, new_width = img.shape[0:2]
+
+    # Calculate the new height and width that are divisible by divisible_by (with/without resizing)
+    new_height = new_height if new_height % divisible_by == 0 else new_height - new_height % divisible_by
+    new_width = new_width if new_width % divisible_by == 0 else new_width - new_width % divisible_by
+
+    # Center crop the image to the calculated dimensions
+    y = int((img.shape[0] - new_height) / 2)
+    x = int((img.shape[1] - new_width) / 2)
+    img = img[y:y + new_height, x:x + new_width]
+    height, width = img.shape[0:2]
+
+    new_filename = get_output_filename(base, max_resolution, save_as_png)
+
+    # Save resized image in dst_img_folder, via a temporary file not to leave a broken image which looks up to date
+    new_path = os.path.join(dst_img_folder, new_filename)
+    tmp_path = f"{new_path}.{os.getpid()}.tmp"
+    Image.fromarray(img).save(tmp_path, format="PNG" if save_as_png else "JPEG", quality=100)
+    os.replace(tmp_path, new_path)
+
+    outputs.append((new_filename, width, height, current_pixels > max_pixels))
+
+  # If other files with same basename, copy them with resolution suffix
+  num_copied = 0
+  for asoc_file in asoc_files:
+    ext = os.path.splitext(asoc_file)[1]
     for max_resolution in max_resolutions:
-      # Calculate max_pixels from max_resolution string
-      max_pixels = int(max_resolution.split("x")[0]) * int(max_resolution.split("x")[1])
-
-      # Calculate current number of pixels
-      current_pixels = img.shape[0] * img.shape[1]
-
-      # Check if the image needs resizing
-      if current_pixels > max_pixels:
-        # Calculate scaling factor
-        scale_factor = max_pixels / current_pixels
-
-        # Calculate new dimensions
-        new_height = int(img.shape[0] * math.sqrt(scale_factor))
-        new_width = int(img.shape[1] * math.sqrt(scale_factor))
-
-        # Resize image
-        if cv2_interpolation:
-          img = cv2.resize(img, (new_width, new_height), interpolation=cv2_interpolation)
-        else:
-          img = pil_resize(img, (new_width, new_height), interpolation=pil_interpolation)
+      shutil.copy(asoc_file, os.path.join(dst_img_folder, base + '+' + max_resolution + ext))
+      num_copied += 1
+
+  return outputs, num_copied
+
+
+def resize_images(src_img_folder, dst_img_folder, max_resolution="512x512", divisible_by=2, interpolation=None, save_as_png=False, copy_associated_files=False, max_workers=None, force=False, use_draft=True):
+  start_time = time.perf_counter()
+
+  # Split the max_resolution string by "," and strip any whitespaces
+  max_resolutions = [res.strip() for res in max_resolution.split(',')]
+
+  # Create destination folder if it does not exist
+  if not os.path.exists(dst_img_folder):
+    os.makedirs(dst_img_folder)
+
+  # list the folder once. associated files are the files matching "{base}.*", same as glob, for each base of the images
+  filenames = sorted(entry.name for entry in os.scandir(src_img_folder) if entry.is_file())
+  asoc_files_by_base = {}
+  for filename in filenames:
+    if filename.endswith(IMG_EXTS):
+      continue
+    for i, c in enumerate(filename):
+      if c == '.' and i > 0:
+        asoc_files_by_base.setdefault(filename[:i], []).append(os.path.join(src_img_folder, filename))
+
+  # image sizes of the outputs, the dataset reads them with image_size_cache instead of the image headers
+  size_cache = ImageSizeCache(persistent=True)
+  skipped_outputs = []
+
+  num_resized = 0
+  num_saved = 0
+  num_skipped = 0
+  num_copied = 0
+  failed = []
+
+  def handle_result(filename, future):
+    nonlocal num_resized, num_saved, num_copied
+    try:
+      outputs, copied = future.result()
+    except Exception as e:
+      logger.error(f"Failed to resize image: {filename}, error: {e}")
+      failed.append(filename)
+      return
+    num_copied += copied
+    for new_filename, width, height, resized in outputs:
+      size_cache.set_size(os.path.join(dst_img_folder, new_filename), width, height)
+      if resized:
+        num_resized += 1
       else:
-        new_height, new_width = img.shape[0:2]
-
-      # Calculate the new height and width that are divisible by divisible_by (with/without resizing)
-      new_height = new_height if new_height % divisible_by == 0 else new_height - new_height % divisible_by
-      new_width = new_width if new_width % divisible_by == 0 else new_width - new_width % divisible_by
-
-      # Center crop the image to the calculated dimensions
-      y = int((img.shape[0] - new_height) / 2)
-      x = int((img.shape[1] - new_width) / 2)
-      img = img[y:y + new_height, x:x + new_width]
-
-      # Split filename into base and extension
-      new_filename = base + '+' + max_resolution + ('.png' if save_as_png else '.jpg')
-
-      # Save resized image in dst_img_folder
-      # cv2.imwrite(os.path.join(dst_img_folder, new_filename), img, [cv2.IMWRITE_JPEG_QUALITY, 100])
-      image = Image.fromarray(img)
-      image.save(os.path.join(dst_img_folder, new_filename), quality=100)
-
-      proc = "Resized" if current_pixels > max_pixels else "Saved"
-      logger.info(f"{proc} image: {filename} with size {img.shape[0]}x{img.shape[1]} as {new_filename}")
-
-    # If other files with same basename, copy them with resolution suffix
-    if copy_associated_files:
-      asoc_files = glob.glob(os.path.join(src_img_folder, base + ".*"))
-      for asoc_file in asoc_files:
-        ext = os.path.splitext(asoc_file)[1]
-        if ext in img_exts:
+        num_saved += 1
+      proc = "Resized" if resized else "Saved"
+      logger.info(f"{proc} image: {filename} with size {height}x{width} as {new_filename}")
+
+  max_workers = max_workers or os.cpu_count() or 1
+  max_in_flight = max_workers * 4  # bound the number of submitted tasks, not to queue all images at once
+  with concurrent.futures.ProcessPoolExecutor(max_workers, initializer=init_worker) as executor:
+    futures = {}
+    for filename in filenames:
+      src_path = os.path.join(src_img_folder, filename)
+
+      # Check if the image is png, jpg or webp etc...
+      if not filename.endswith(IMG_EXTS):
+        # Copy the file to the destination folder if not png, jpg or webp etc (.txt or .caption or etc.)
+        if filename == IMAGE_SIZE_CACHE_FILE:
+          continue  # the size index of the source images, not valid for the outputs
+        dst_path = os.path.join(dst_img_folder, filename)
+        if force or not is_up_to_date(src_path, dst_path):
+          shutil.copy(src_path, dst_path)
+          num_copied += 1
+        continue
+
+      base, _ = os.path.splitext(filename)
+      asoc_files = asoc_files_by_base.get(base, []) if copy_associated_files else []
+      output_paths = [os.path.join(dst_img_folder, get_output_filename(base, res, save_as_png)) for res in max_resolutions]
+      if not force:
+        dst_paths = output_paths + [
+          os.path.join(dst_img_folder, base + '+' + res + os.path.splitext(f)[1]) for f in asoc_files for res in max_resolutions
+        ]
+        if all(is_up_to_date(src_path, dst_path) for dst_path in dst_paths):
+          num_skipped += 1
+          skipped_outputs.extend(output_paths)
           continue
-        for max_resolution in max_resolutions:
-          new_asoc_file = base + '+' + max_resolution + ext
-          logger.info(f"Copy {asoc_file} as {new_asoc_file}")
-          shutil.copy(os.path.join(src_img_folder, asoc_file), os.path.join(dst_img_folder, new_asoc_file))
+
+      if len(futures) >= max_in_flight:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          handle_result(futures.pop(future), future)
+
+      future = executor.submit(
+        resize_image_file, src_path, dst_img_folder, max_resolutions, divisible_by, interpolation, save_as_png, asoc_files, use_draft
+      )
+      futures[future] = filename
+
+    for future in concurrent.futures.as_completed(list(futures)):
+      handle_result(futures.pop(future), future)
+
+  # sizes of the skipped outputs are in the existing index, or read from the headers if the index does not have them
+  if skipped_outputs:
+    size_cache.get_sizes(skipped_outputs, desc="get image size of up-to-date outputs")
+  size_cache.save()
+
+  elapsed = time.perf_counter() - start_time
+  num_processed = num_resized + num_saved
+  logger.info(f"Done in {elapsed:.1f}s: {num_processed} images written ({num_resized} resized, {num_saved} saved without resizing), "
+              f"{num_skipped} source images up to date, {num_copied} files copied, {len(failed)} failed")
+  if num_processed > 0:
+    logger.info(f"{num_processed / max(elapsed, 1e-9):.2f} images/s with {max_workers} workers")
+  if failed:
+    logger.warning(f"Failed images / 失敗した画像: {', '.join(failed)}")
+  logger.info(f"Image size index / 画像サイズのインデックス: {ImageSizeCache.get_cache_path(dst_img_folder)}")
 
 
 def setup_parser() -> argparse.ArgumentParser:
@@ -118,6 +245,13 @@ def setup_parser() -> argparse.ArgumentParser:
   parser.add_argument('--save_as_png', action='store_true', help='Save as png format / png形式で保存')
   parser.add_argument('--copy_associated_files', action='store_true',
                       help='Copy files with same base name to images (captions etc) / 画像と同じファイル名（拡張子を除く）のファイルもコピーする')
+  parser.add_argument('--max_workers', type=int, default=None,
+                      help='Number of worker processes (default: number of CPUs) / ワーカープロセス数（デフォルト：CPU数）')
+  parser.add_argument('--force', action='store_true',
+                      help='Process all images even if the outputs are newer than the sources / 出力が元画像より新しい場合も全ての画像を処理する')
+  parser.add_argument('--no_jpeg_draft', action='store_true',
+                      help='Always decode JPEG in full size. By default JPEG is decoded at reduced size when the output is much smaller'
+                      ' / JPEGを常にフルサイズでデコードする。デフォルトでは出力が十分小さい場合、JPEGを縮小サイズでデコードする')
 
   return parser
 
@@ -127,7 +261,8 @@ def main():
 
   args = parser.parse_args()
   resize_images(args.src_img_folder, args.dst_img_folder, args.max_resolution,
-                args.divisible_by, args.interpolation, args.save_as_png, args.copy_associated_files)
+                args.divisible_by, args.interpolation, args.save_as_png, args.copy_associated_files,
+                args.max_workers, args.force, not args.no_jpeg_draft)
 
 
 if __name__ == '__main__':
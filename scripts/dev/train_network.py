@@ -34,6 +34,8 @@ from library.config_util import (
     BlueprintGenerator,
 )
 import library.huggingface_util as huggingface_util
+from library.checkpoint_writer import AsyncCheckpointWriter, NetworkSnapshot
+from library import step_profiler
 import library.custom_train_functions as custom_train_functions
 from library.custom_train_functions import (
     apply_snr_weight,
@@ -186,7 +188,7 @@ class NetworkTrainer:
 
     def get_latents_caching_strategy(self, args):
         latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(
-            True, args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check
+            True, args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check, args.latents_cache_backend
         )
         return latents_caching_strategy
 
@@ -224,7 +226,18 @@ class NetworkTrainer:
                 param.grad = accelerator.reduce(param.grad, reduction="mean")
 
     def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizers, text_encoder, unet):
-        train_util.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizers[0], text_encoder, unet)
+        train_util.sample_images(
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            device,
+            vae,
+            tokenizers[0],
+            text_encoder,
+            unet,
+            cache_prompt_embeddings=not self.is_train_text_encoder(args),
+        )
 
     # region SD/SDXL
 
@@ -382,7 +395,8 @@ class NetworkTrainer:
                 latents = typing.cast(torch.FloatTensor, batch["latents"].to(accelerator.device))
             else:
                 # latentに変換
-                latents = self.encode_images_to_latents(args, vae, batch["images"].to(accelerator.device, dtype=vae_dtype))
+                with step_profiler.span("vae_encode"):
+                    latents = self.encode_images_to_latents(args, vae, batch["images"].to(accelerator.device, dtype=vae_dtype))
 
                 # NaNが含まれていれば警告を表示し0に置き換える
                 if torch.any(torch.isnan(latents)):
@@ -398,7 +412,7 @@ class NetworkTrainer:
 
         if len(text_encoder_conds) == 0 or text_encoder_conds[0] is None or train_text_encoder:
             # TODO this does not work if 'some text_encoders are trained' and 'some are not and not cached'
-            with torch.set_grad_enabled(is_train and train_text_encoder), accelerator.autocast():
+            with step_profiler.span("text_encoding"), torch.set_grad_enabled(is_train and train_text_encoder), accelerator.autocast():
                 # Get the text embedding for conditioning
                 if args.weighted_captions:
                     input_ids_list, weights_list = tokenize_strategy.tokenize_with_weights(batch["captions"])
@@ -428,19 +442,20 @@ class NetworkTrainer:
                         text_encoder_conds[i] = encoded_text_encoder_conds[i]
 
         # sample noise, call unet, get target
-        noise_pred, target, timesteps, weighting = self.get_noise_pred_and_target(
-            args,
-            accelerator,
-            noise_scheduler,
-            latents,
-            batch,
-            text_encoder_conds,
-            unet,
-            network,
-            weight_dtype,
-            train_unet,
-            is_train=is_train,
-        )
+        with step_profiler.span("forward"):
+            noise_pred, target, timesteps, weighting = self.get_noise_pred_and_target(
+                args,
+                accelerator,
+                noise_scheduler,
+                latents,
+                batch,
+                text_encoder_conds,
+                unet,
+                network,
+                weight_dtype,
+                train_unet,
+                is_train=is_train,
+            )
 
         huber_c = train_util.get_huber_threshold_if_needed(args, timesteps, noise_scheduler)
         loss = train_util.conditional_loss(noise_pred.float(), target.float(), args.loss_type, "none", huber_c)
@@ -1246,6 +1261,14 @@ class NetworkTrainer:
             on_step_start_for_network = lambda *args, **kwargs: None
 
         # function for saving/removing
+        # with --async_save, weights are copied to CPU here and written by a background thread
+        checkpoint_writer = AsyncCheckpointWriter(args.async_save_queue_size) if args.async_save and is_main_process else None
+
+        def write_model(ckpt_file, ckpt_name, nw, metadata_to_save, force_sync_upload):
+            nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
+            if args.huggingface_repo_id is not None:
+                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+
         def save_model(ckpt_name, unwrapped_nw, steps, epoch_no, force_sync_upload=False):
             os.makedirs(args.output_dir, exist_ok=True)
             ckpt_file = os.path.join(args.output_dir, ckpt_name)
@@ -1259,16 +1282,25 @@ class NetworkTrainer:
             sai_metadata = self.get_sai_model_spec(args)
             metadata_to_save.update(sai_metadata)
 
-            unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
-            if args.huggingface_repo_id is not None:
-                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+            if checkpoint_writer is not None:
+                snapshot = NetworkSnapshot(unwrapped_nw)
+                checkpoint_writer.submit(write_model, ckpt_file, ckpt_name, snapshot, dict(metadata_to_save), force_sync_upload)
+            else:
+                write_model(ckpt_file, ckpt_name, unwrapped_nw, metadata_to_save, force_sync_upload)
 
-        def remove_model(old_ckpt_name):
-            old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
+        def delete_model(old_ckpt_file):
             if os.path.exists(old_ckpt_file):
                 accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
                 os.remove(old_ckpt_file)
 
+        def remove_model(old_ckpt_name):
+            old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
+            if checkpoint_writer is not None:
+                # after the checkpoints submitted before
+                checkpoint_writer.submit(delete_model, old_ckpt_file)
+            else:
+                delete_model(old_ckpt_file)
+
         # if text_encoder is not needed for training, delete it to save memory.
         # TODO this can be automated after SDXL sample prompt cache is implemented
         if self.is_text_encoder_not_needed_for_training(args):
@@ -1305,6 +1337,9 @@ class NetworkTrainer:
 
         clean_memory_on_device(accelerator.device)
 
+        # step profiler: spans are measured in this file, flux_train_network.py and the block swap
+        profiler = step_profiler.create_profiler(args, accelerator.device, accelerator.is_main_process)
+
         progress_bar = tqdm(
             range(args.max_train_steps - initial_step), smoothing=0, disable=not accelerator.is_local_main_process, desc="steps"
         )
@@ -1363,12 +1398,20 @@ class NetworkTrainer:
                 skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
                 initial_step = 1
 
-            for step, batch in enumerate(skipped_dataloader or train_dataloader):
+            epoch_dataloader = skipped_dataloader or train_dataloader
+            if profiler is not None:
+                epoch_dataloader = profiler.iterate(epoch_dataloader)  # measure the time waiting for the batch
+
+            for step, batch in enumerate(epoch_dataloader):
                 current_step.value = global_step
                 if initial_step > 0:
                     initial_step -= 1
                     continue
 
+                if profiler is not None:
+                    profiler.step_begin(global_step + 1)
+                    profiler.add_samples(len(batch["loss_weights"]) * accelerator.num_processes)
+
                 with accelerator.accumulate(training_model):
                     on_step_start_for_network(text_encoder, unet)
 
@@ -1393,16 +1436,19 @@ class NetworkTrainer:
                         train_unet=train_unet,
                     )
 
-                    accelerator.backward(loss)
-                    if accelerator.sync_gradients:
-                        self.all_reduce_network(accelerator, network)  # sync DDP grad manually
-                        if args.max_grad_norm != 0.0:
-                            params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
-                            accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+                    with step_profiler.span("backward"):
+                        accelerator.backward(loss)
+
+                    with step_profiler.span("optimizer"):
+                        if accelerator.sync_gradients:
+                            self.all_reduce_network(accelerator, network)  # sync DDP grad manually
+                            if args.max_grad_norm != 0.0:
+                                params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
+                                accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
 
-                    optimizer.step()
-                    lr_scheduler.step()
-                    optimizer.zero_grad(set_to_none=True)
+                        optimizer.step()
+                        lr_scheduler.step()
+                        optimizer.zero_grad(set_to_none=True)
 
                 if args.scale_weight_norms:
                     keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
@@ -1418,16 +1464,18 @@ class NetworkTrainer:
                     global_step += 1
 
                     optimizer_eval_fn()
-                    self.sample_images(
-                        accelerator, args, None, global_step, accelerator.device, vae, tokenizers, text_encoder, unet
-                    )
+                    with step_profiler.span("sample_images"):
+                        self.sample_images(
+                            accelerator, args, None, global_step, accelerator.device, vae, tokenizers, text_encoder, unet
+                        )
 
                     # 指定ステップごとにモデルを保存
                     if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
                         accelerator.wait_for_everyone()
                         if accelerator.is_main_process:
                             ckpt_name = train_util.get_step_ckpt_name(args, "." + args.save_model_as, global_step)
-                            save_model(ckpt_name, accelerator.unwrap_model(network), global_step, epoch)
+                            with step_profiler.span("checkpoint_save"):
+                                save_model(ckpt_name, accelerator.unwrap_model(network), global_step, epoch)
 
                             if args.save_state:
                                 train_util.save_and_remove_state_stepwise(args, accelerator, global_step)
@@ -1453,6 +1501,11 @@ class NetworkTrainer:
                     )
                     self.step_logging(accelerator, logs, global_step, epoch + 1)
 
+                if profiler is not None and accelerator.sync_gradients:
+                    profile_logs = profiler.step_end()
+                    if profile_logs is not None and args.profile_steps and is_tracking:
+                        self.step_logging(accelerator, profile_logs, global_step, epoch + 1)
+
                 # VALIDATION PER STEP: global_step is already incremented
                 # for example, if validate_every_n_steps=100, validate at step 100, 200, 300, ...
                 should_validate_step = args.validate_every_n_steps is not None and global_step % args.validate_every_n_steps == 0
@@ -1604,8 +1657,16 @@ class NetworkTrainer:
                 progress_bar.unpause()
 
             # END OF EPOCH
+            token_id_cache_stats = train_dataset_group.get_token_id_cache_stats()
+            if token_id_cache_stats is not None:
+                logger.info(
+                    f"token id cache: hits {token_id_cache_stats['hits']}, misses {token_id_cache_stats['misses']},"
+                    f" bypassed {token_id_cache_stats['bypassed']}, hit rate {token_id_cache_stats['hit_rate']:.3f}"
+                )
             if is_tracking:
                 logs = {"loss/epoch_average": loss_recorder.moving_average}
+                if token_id_cache_stats is not None:
+                    logs["data/token_id_cache_hit_rate"] = token_id_cache_stats["hit_rate"]
                 self.epoch_logging(accelerator, logs, global_step, epoch + 1)
 
             accelerator.wait_for_everyone()
@@ -1631,6 +1692,10 @@ class NetworkTrainer:
 
             # end of epoch
 
+        if profiler is not None:
+            profiler.close()
+            step_profiler.set_profiler(None)
+
         # metadata["ss_epoch"] = str(num_train_epochs)
         metadata["ss_training_finished_at"] = str(time.time())
 
@@ -1647,6 +1712,10 @@ class NetworkTrainer:
             ckpt_name = train_util.get_last_ckpt_name(args, "." + args.save_model_as)
             save_model(ckpt_name, network, global_step, num_train_epochs, force_sync_upload=True)
 
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
+
+        if is_main_process:
             logger.info("model saved.")
 
 
@@ -1679,6 +1748,21 @@ def setup_parser() -> argparse.ArgumentParser:
         choices=[None, "ckpt", "pt", "safetensors"],
         help="format to save the model (default is .safetensors) / モデル保存時の形式（デフォルトはsafetensors）",
     )
+    step_profiler.add_step_profiler_arguments(parser)
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="save the network weights in a background thread, weights are copied to CPU memory and training continues while"
+        " hashing, writing, removing old checkpoints and uploading / ネットワークの重みをバックグラウンドで保存する。重みをCPUメモリに"
+        "コピーした後、ハッシュ計算、書き込み、古いチェックポイントの削除、アップロード中も学習を続ける",
+    )
+    parser.add_argument(
+        "--async_save_queue_size",
+        type=int,
+        default=2,
+        help="max number of checkpoints waiting to be saved with --async_save, training waits when exceeded (default 2)"
+        " / --async_save時に保存待ちにできるチェックポイントの最大数、超えると学習が待機する（デフォルト2）",
+    )
 
     parser.add_argument("--unet_lr", type=float, default=None, help="learning rate for U-Net / U-Netの学習率")
     parser.add_argument(